@@ -1,18 +1,19 @@
-import os
-import shutil
-import tempfile
 import logging
-from typing import Optional
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Sequence
 
 from fastapi import FastAPI, File, UploadFile, HTTPException, Request
+from fastapi.responses import ORJSONResponse, Response
 from pydantic import BaseModel
 
 from services.ocr import MistralOCR, ExtractedInvoiceData
 from services.categorization import InvoiceCategorizer, CategorizationResult
-from config import settings # Ensure settings are loaded
+from config import get_settings
 
-import requests # Import requests
 import aiohttp # Add aiohttp import
+import orjson
 
 # Import Slack Bolt components
 from slack_bolt.adapter.fastapi.async_handler import AsyncSlackRequestHandler
@@ -24,7 +25,29 @@ from services.xero_service import get_xero_service, XeroService, XeroApiExceptio
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Invoice Processing API")
+# One cached Settings per process (built before fork under `gunicorn --preload`)
+settings = get_settings()
+settings.require_core() # Fail fast on missing Slack/Mistral/OpenAI config
+
+# Per-request access lines from aiohttp are noise at INFO; keep warnings and above
+logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+
+# orjson serializes the nested OCR payload considerably faster than the stdlib encoder
+app = FastAPI(title="Invoice Processing API", default_response_class=ORJSONResponse)
+
+# Slack downloads are streamed into memory in 256 KiB chunks
+SLACK_DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# OCR and categorization are blocking SDK calls; they run on this many worker threads
+BLOCKING_WORKERS = 32
+
+# Slack file jobs are queued by the event handler and drained by this many background workers
+# (MAX_CONCURRENT_INVOICES, default 16 in config.py)
+INVOICE_WORKERS = settings.MAX_CONCURRENT_INVOICES
+invoice_queue: asyncio.Queue = asyncio.Queue()
+# Process-wide cap on invoices in the download -> OCR -> categorize -> Xero pipeline, shared by Slack
+# jobs and /process-invoice to keep bursts from tripping Mistral/OpenAI/Slack rate limits. Sized to
+# the worker pool, so Slack jobs alone never wait on it; only /process-invoice uploads compete
+INVOICE_SEM = asyncio.Semaphore(INVOICE_WORKERS)
 
 class ProcessedInvoiceResponse(BaseModel):
     ocr_result: Optional[ExtractedInvoiceData] = None
@@ -32,10 +55,12 @@ class ProcessedInvoiceResponse(BaseModel):
     error: Optional[str] = None
 
 # Initialize services (consider dependency injection for larger apps)
+# Created at import so `gunicorn --preload` builds them once in the master and workers share them;
+# per-worker resources (HTTP session, executor) are created in the startup event below.
 try:
     ocr_service = MistralOCR()
 except Exception as e:
-    logger.error(f"Failed to initialize OCR service: {e}")
+    logger.error("Failed to initialize OCR service: %s", e)
     ocr_service = None
 
 # --- Initialize Categorization Service ---
@@ -51,8 +76,8 @@ try:
 except Exception as e:
     # Log exception type and message more explicitly
     logger.error("!!! EXCEPTION DURING InvoiceCategorizer INITIALIZATION !!!")
-    logger.error(f"Exception Type: {type(e).__name__}")
-    logger.error(f"Exception Args: {e.args}")
+    logger.error("Exception Type: %s", type(e).__name__)
+    logger.error("Exception Args: %s", e.args)
     logger.exception("Full traceback for Categorization service initialization failure:")
     categorization_service = None # Ensure it's None on failure
 
@@ -62,58 +87,136 @@ xero_service: Optional[XeroService] = None # Initialize to None
 try:
     # Check required config *before* attempting to create
     if settings.XERO_CLIENT_ID and settings.XERO_CLIENT_SECRET and settings.XERO_REDIRECT_URI:
-        xero_service = create_xero_service()
+        xero_service = get_xero_service()
         if xero_service:
              logger.info("XeroService initialized successfully.")
         else:
-            logger.warning("create_xero_service() returned None without raising exception?")
+            logger.warning("get_xero_service() returned None without raising exception?")
     else:
         logger.warning("Missing required Xero configuration (Client ID, Secret, Redirect URI). Xero service disabled.")
 except Exception as e:
     logger.error("!!! EXCEPTION DURING XeroService INITIALIZATION !!!")
-    logger.error(f"Exception Type: {type(e).__name__}")
-    logger.error(f"Exception Args: {e.args}")
+    logger.error("Exception Type: %s", type(e).__name__)
+    logger.error("Exception Args: %s", e.args)
     logger.exception("Full traceback for Xero service initialization failure:")
     xero_service = None # Ensure it's None on failure
 
+# --- Hot-path constants (bound once instead of per Slack event) ---
+# Service availability is fixed after import, so the /health body is serialized once
+_HEALTH_BYTES = orjson.dumps({
+    "status": "ok",
+    "ocr_service_available": ocr_service is not None,
+    "categorization_service_available": categorization_service is not None,
+    "xero_service_available": xero_service is not None,
+})
+_CAT_EMOJI = {"matched": "✅", "not_matched": "❓", "error": "❌"}
+_XERO_ACCT_MAP = settings.XERO_ACCOUNT_CODE_MAP
+_XERO_CATS = frozenset(settings.XERO_ACCOUNT_CODE_MAP or ())
+# Auth header for Slack file downloads. Passed per request rather than as a session default so the
+# bot token is never sent to any other host the shared session talks to.
+_SLACK_DL_HEADERS = {"Authorization": f"Bearer {settings.SLACK_BOT_TOKEN}"}
+# Slack filetypes / file extensions worth spending a files_info call (and a download) on
+SUPPORTED_FILETYPES = frozenset({"pdf", "png", "jpg", "jpeg"})
+_INVOICE_EXTS = tuple("." + ext for ext in SUPPORTED_FILETYPES)
+
+def _mrkdwn_section(text: str) -> dict:
+    return {"type": "section", "text": {"type": "mrkdwn", "text": text}}
+
+def _build_blocks(
+    ocr_data: Optional[ExtractedInvoiceData],
+    categorization_data: Optional[CategorizationResult],
+    xero_result_message: Optional[str],
+    original_filename: str,
+    status_lines: Sequence[str] = (),
+) -> list:
+    """Builds the Slack result message blocks. Pure function: no I/O, no settings access."""
+    header = [_mrkdwn_section(f"📄 Processed Invoice: *{original_filename}*")]
+
+    if ocr_data:
+        ocr_block = [_mrkdwn_section(
+            f"*Vendor:* {ocr_data.vendor_name or '_Not Found_'}\n"
+            f"*Amount:* {ocr_data.total_amount or '_Not Found_'}\n"
+            f"*Date:* {ocr_data.issue_date or '_Not Found_'}\n"
+            f"*Due Date:* {ocr_data.due_date or '_Not Found_'}"
+        )]
+    else:
+        ocr_block = [_mrkdwn_section("_OCR failed to extract details._")]
+
+    if categorization_data:
+        cat_block = [_mrkdwn_section(
+            f"{_CAT_EMOJI.get(categorization_data.status, '❓')} *Category:* {categorization_data.assigned_category or '_Not Assigned_'}\n"
+            f"*Notes:* {categorization_data.notes or '_None_'}"
+        )]
+    else:
+        cat_block = [_mrkdwn_section("_Categorization was not performed._")]
+
+    xero_block = [{"type": "divider"}, _mrkdwn_section(xero_result_message)] if xero_result_message else []
+
+    # Processing notices ride along in the result message instead of separate Slack posts
+    status_block = [{"type": "context", "elements": [{"type": "mrkdwn", "text": "\n".join(status_lines)}]}] if status_lines else []
+
+    return [*header, *status_block, *ocr_block, *cat_block, *xero_block]
+
+async def _warm_xero(loop: asyncio.AbstractEventLoop) -> None:
+    """Refreshes the Xero token and caches the tenant ID so the first create_draft_bill doesn't pay for it."""
+    try:
+        await loop.run_in_executor(None, xero_service.get_tenant_id)
+    except Exception as e:
+        # Non-fatal: create_draft_bill will retry the token/tenant lookup itself
+        logger.warning("Xero warm-up failed: %s", e)
+
 # --- Initialize Slack Bolt App ---
-# Ensure SLACK_BOT_TOKEN and SLACK_SIGNING_SECRET are loaded via settings
-if not settings.SLACK_BOT_TOKEN or not settings.SLACK_SIGNING_SECRET:
-    logger.warning("SLACK_BOT_TOKEN or SLACK_SIGNING_SECRET not found. Slack integration will be disabled.")
+# SLACK_BOT_TOKEN and SLACK_SIGNING_SECRET are guaranteed by settings.require_core() above
+try:
+    if not settings.SLACK_REQUEST_VERIFICATION_ENABLED:
+        logger.warning("Slack request signature verification is DISABLED; requests must be verified upstream.")
+    bolt_app = AsyncApp(
+        token=settings.SLACK_BOT_TOKEN,
+        signing_secret=settings.SLACK_SIGNING_SECRET,
+        request_verification_enabled=settings.SLACK_REQUEST_VERIFICATION_ENABLED
+    )
+    # Built exactly once; /slack/events reuses it for every request
+    app_handler = AsyncSlackRequestHandler(bolt_app)
+    logger.info("Slack Bolt app initialized successfully.")
+except Exception as e:
+    logger.error("Error initializing Slack Bolt app: %s", e, exc_info=True)
     bolt_app = None
     app_handler = None
-else:
-    try:
-        bolt_app = AsyncApp(
-            token=settings.SLACK_BOT_TOKEN,
-            signing_secret=settings.SLACK_SIGNING_SECRET
-        )
-        app_handler = AsyncSlackRequestHandler(bolt_app)
-        logger.info("Slack Bolt app initialized successfully.")
-    except Exception as e:
-        logger.error(f"Error initializing Slack Bolt app: {e}", exc_info=True)
-        bolt_app = None
-        app_handler = None
 
 # --- Slack Event Handlers ---
 if bolt_app:
     @bolt_app.event("file_shared")
-    async def handle_file_shared(body, say, logger):
-        """Handles the file_shared event when a file is uploaded to Slack."""
+    async def handle_file_shared(body, say, ack, logger):
+        """Acks the file_shared event immediately and queues the file for a background worker.
+
+        Slack expects an ack within 3 seconds, so download/OCR/categorization happen in
+        process_file_job, driven by the workers started in the startup event.
+        """
+        await ack()
         file_info = body.get('event', {}).get('file', {})
         file_id = file_info.get('id')
         file_name = file_info.get('name')
+        # Most file_shared payloads carry the full file object; when they do, the worker can
+        # skip the files_info roundtrip entirely
+        download_url = file_info.get('url_private_download')
         user_id = body.get('event', {}).get('user_id')
         channel_id = body.get('event', {}).get('channel_id')
         # Use event_ts as the primary identifier for threading if available, fallback to ts
         thread_ts = body.get('event', {}).get('event_ts', body.get('event', {}).get('ts'))
 
-        logger.info(f"Received file_shared event: File ID={file_id}, Name={file_name}, User={user_id}, Channel={channel_id}, ThreadTS={thread_ts}")
+        logger.info("Received file_shared event: File ID=%s, Name=%s, User=%s, Channel=%s, ThreadTS=%s", file_id, file_name, user_id, channel_id, thread_ts)
 
-        # Define target channel ID from settings
-        target_channel_id = settings.SLACK_TARGET_CHANNEL_ID
+        # Skip obvious non-invoices before spending a Slack API call. file_shared events don't
+        # always carry the filetype/name, so only filter on what is present.
+        file_type = file_info.get('filetype')
+        if file_type and file_type not in SUPPORTED_FILETYPES:
+            logger.info("Ignoring file %s (%s): unsupported file type '%s'.", file_id, file_name, file_type)
+            return
+        if file_name and not file_name.lower().endswith(_INVOICE_EXTS):
+            logger.info("Ignoring file %s (%s): not an invoice file type.", file_id, file_name)
+            return
 
-        # Validate services are available
+        # Validate services are available before queueing, so a misconfigured worker never downloads the file
         if not ocr_service:
             logger.error("OCR Service not available. Cannot process file.")
             await say(text="Sorry, the OCR service is currently unavailable.", thread_ts=thread_ts)
@@ -122,6 +225,15 @@ if bolt_app:
             logger.error("Categorization Service not available. Cannot process file.")
             await say(text="Sorry, the categorization service is currently unavailable.", thread_ts=thread_ts)
             return
+
+        invoice_queue.put_nowait({"file_id": file_id, "file_name": file_name, "download_url": download_url, "thread_ts": thread_ts, "say": say})
+        logger.info("Queued file %s for processing (queue depth: %d)", file_id, invoice_queue.qsize())
+
+    async def process_file_job(file_id: str, file_name: Optional[str], thread_ts: Optional[str], say, download_url: Optional[str] = None) -> None:
+        """Downloads, OCRs, categorizes and (optionally) posts a shared invoice to Xero, then reports to Slack."""
+        # Define target channel ID from settings
+        target_channel_id = settings.SLACK_TARGET_CHANNEL_ID
+
         # Xero service is optional for processing, but log if unavailable for this flow
         if not xero_service:
              logger.warning("Xero Service not available. Will skip Xero integration.")
@@ -130,147 +242,126 @@ if bolt_app:
 
 
         # --- Start Invoice Processing ---
-        temp_dir = None
-        file_path = None
         ocr_data: Optional[ExtractedInvoiceData] = None
         categorization_data: Optional[CategorizationResult] = None
         xero_result_message: Optional[str] = None
+        original_filename = file_name or file_id # Refined from files_info below
+        # Status notices are collected and folded into the single final Slack message
+        status_lines = []
 
         try:
-            # 1. Get file info using the client from the 'say' utility
-            # Use the bot token associated with the bolt app instance
-            file_info_resp = await bolt_app.client.files_info(file=file_id)
-            if not file_info_resp.get("ok"):
-                logger.error(f"Failed to get file info for {file_id}: {file_info_resp.get('error')}")
-                await say(text=f"Sorry, I couldn't get the details for file ID `{file_id}`. Error: `{file_info_resp.get('error')}`", thread_ts=thread_ts)
-                return
-
-            file_data = file_info_resp.get("file")
-            download_url = file_data.get("url_private_download")
-            original_filename = file_data.get("name", "downloaded_file") # Use original filename
+            # 1. Get file info, unless the event payload already gave us the download URL
+            if not download_url:
+                # Older/minimal event payloads only carry the file ID, so ask Slack for the rest
+                file_info_resp = await bolt_app.client.files_info(file=file_id)
+                if not file_info_resp.get("ok"):
+                    logger.error("Failed to get file info for %s: %s", file_id, file_info_resp.get('error'))
+                    await say(text=f"Sorry, I couldn't get the details for file ID `{file_id}`. Error: `{file_info_resp.get('error')}`", thread_ts=thread_ts)
+                    return
+
+                file_data = file_info_resp.get("file")
+                download_url = file_data.get("url_private_download")
+                original_filename = file_data.get("name", "downloaded_file") # Use original filename
+
+                # The event didn't tell us the type, so check it now before downloading anything
+                if file_data.get("filetype") not in SUPPORTED_FILETYPES:
+                    logger.info("Ignoring file %s (%s): unsupported file type '%s'.", file_id, original_filename, file_data.get("filetype"))
+                    return
 
             if not download_url:
-                logger.error(f"No download URL found for file {file_id}")
+                logger.error("No download URL found for file %s", file_id)
                 await say(text=f"Sorry, I couldn't find a download URL for file `{file_id}`.", thread_ts=thread_ts)
                 return
 
             # 2. Download the file using aiohttp
-            temp_dir = tempfile.mkdtemp()
-            # Use the original filename for the temporary file
-            file_path = os.path.join(temp_dir, original_filename)
-            logger.info(f"Attempting to download file to: {file_path}")
-
-            headers = {"Authorization": f"Bearer {settings.SLACK_BOT_TOKEN}"}
-            async with aiohttp.ClientSession() as session:
-                async with session.get(download_url, headers=headers) as resp:
-                    if resp.status == 200:
-                        with open(file_path, 'wb') as f:
-                            while True:
-                                chunk = await resp.content.read(1024)
-                                if not chunk:
-                                    break
-                                f.write(chunk)
-                        logger.info(f"Successfully downloaded file {file_id} to {file_path}")
-                    else:
-                        error_content = await resp.text()
-                        logger.error(f"Failed to download file {file_id}. Status: {resp.status}. Response: {error_content}")
-                        await say(text=f"Sorry, I couldn't download the file `{original_filename}` (Status: {resp.status}).", thread_ts=thread_ts)
-                        return # Stop processing if download fails
+            logger.info("Attempting to download file %s (%s)", file_id, original_filename)
+
+            # Reuse the shared session so downloads keep pooled keep-alive connections
+            session = app.state.http
+            async with session.get(download_url, headers=_SLACK_DL_HEADERS) as resp:
+                if resp.status == 200:
+                    # Accumulate straight into memory; OCR needs the full payload anyway. Size the
+                    # buffer from Content-Length so it isn't repeatedly reallocated as it grows
+                    buf = bytearray(resp.content_length or 0)
+                    pos = 0
+                    async for chunk in resp.content.iter_chunked(SLACK_DOWNLOAD_CHUNK_SIZE):
+                        end = pos + len(chunk)
+                        buf[pos:end] = chunk # Grows the buffer if Content-Length was missing or short
+                        pos = end
+                    del buf[pos:] # Trim if fewer bytes arrived than advertised
+                    file_content = bytes(buf)
+                    logger.info("Successfully downloaded file %s (%s bytes)", file_id, len(file_content))
+                else:
+                    error_content = await resp.text()
+                    logger.error("Failed to download file %s. Status: %s. Response: %s", file_id, resp.status, error_content)
+                    await say(text=f"Sorry, I couldn't download the file `{original_filename}` (Status: {resp.status}).", thread_ts=thread_ts)
+                    return # Stop processing if download fails
+
+            loop = asyncio.get_running_loop()
 
             # 3. Perform OCR
-            logger.info(f"Starting OCR process for {file_path}")
-            with open(file_path, "rb") as f:
-                file_content = f.read()
+            logger.info("Starting OCR process for %s", original_filename)
 
-            # Call OCR service extract method
-            ocr_data = ocr_service.extract(file_content=file_content, filename=original_filename)
+            # Awaited Mistral call; only the PDF parsing is pushed to a thread
+            ocr_data = await ocr_service.extract_async(file_content=file_content, filename=original_filename)
 
             if not ocr_data or not ocr_data.vendor_name: # Basic check if OCR yielded *something*
-                 logger.warning(f"OCR extraction yielded minimal or no data for {original_filename}.")
-                 await say(text=f"I couldn't extract much information from `{original_filename}` using OCR.", thread_ts=thread_ts)
+                 logger.warning("OCR extraction yielded minimal or no data for %s.", original_filename)
+                 status_lines.append(f"I couldn't extract much information from `{original_filename}` using OCR.")
                  # Decide if you want to stop or continue to categorization attempt
                  # return # Optional: Stop if OCR fails significantly
 
             # 4. Perform Categorization
             if ocr_data: # Only categorize if we have some OCR data
-                 logger.info(f"Starting categorization for {original_filename}...")
-                 categorization_data = categorization_service.categorize(ocr_data)
-                 logger.info(f"Categorization Result for {original_filename}: {categorization_data}")
+                 logger.info("Starting categorization for %s...", original_filename)
+                 categorization_data = await categorization_service.categorize_async(ocr_data) # Cached/rule-matched inside the service
+                 logger.info("Categorization Result for %s: %s", original_filename, categorization_data)
             else:
-                 logger.warning(f"Skipping categorization for {original_filename} due to lack of OCR data.")
+                 logger.warning("Skipping categorization for %s due to lack of OCR data.", original_filename)
 
 
             # 5. --- Xero Integration (Optional based on availability and results) ---
-            if xero_service and categorization_data and categorization_data.status == 'matched' and categorization_data.assigned_category:
-                logger.info(f"Attempting Xero integration for {original_filename}...")
+            # O(1) membership test first: categories without an account code skip the Xero path entirely
+            if xero_service and categorization_data and categorization_data.status == 'matched' and categorization_data.assigned_category in _XERO_CATS:
+                logger.info("Attempting Xero integration for %s...", original_filename)
                 assigned_category = categorization_data.assigned_category
-                account_code = settings.XERO_ACCOUNT_CODE_MAP.get(assigned_category)
+                account_code = _XERO_ACCT_MAP[assigned_category]
 
                 if account_code:
-                    logger.info(f"Found Xero account code '{account_code}' for category '{assigned_category}'.")
+                    logger.info("Found Xero account code '%s' for category '%s'.", account_code, assigned_category)
                     try:
-                        xero_result = await xero_service.create_draft_bill(
-                            invoice_data=ocr_data,
-                            account_code=account_code,
-                            contact_name=ocr_data.vendor_name # Use vendor name as contact
+                        # The Xero SDK is synchronous (urllib3 + requests-oauthlib); run it off the event loop.
+                        # The service resolves the account code and vendor contact itself.
+                        xero_result = await loop.run_in_executor(
+                            None, functools.partial(xero_service.create_draft_bill, invoice_data=ocr_data, category=assigned_category)
                         )
-                        if xero_result and xero_result.get("Id"):
-                            bill_id = xero_result["Id"]
+                        if xero_result and xero_result.get("invoice_id"):
+                            bill_id = xero_result["invoice_id"]
                             # Construct deep link (adjust URL based on actual Xero structure if needed)
                             # Assuming a standard pattern, but might need verification
                             deep_link_url = f"https://go.xero.com/organisationlogin/default.aspx?shortcode=!2Account&redirecturl=/AccountsPayable/Edit.aspx?InvoiceID={bill_id}"
                             xero_result_message = f"✅ Successfully created draft bill in Xero: {deep_link_url}"
-                            logger.info(f"Successfully created draft bill in Xero with ID: {bill_id}")
+                            logger.info("Successfully created draft bill in Xero with ID: %s", bill_id)
                         else:
                             xero_result_message = "⚠️ Created bill in Xero, but couldn't confirm details or get ID."
-                            logger.warning(f"Xero draft bill created for {original_filename}, but response format was unexpected: {xero_result}")
+                            logger.warning("Xero draft bill created for %s, but response format was unexpected: %s", original_filename, xero_result)
 
                     except XeroApiException as xe:
-                        logger.error(f"Xero API Error creating draft bill for {original_filename}: {xe.message} (Status: {xe.status_code}, Details: {xe.details})", exc_info=True)
+                        logger.error("Xero API Error creating draft bill for %s: %s (Status: %s, Details: %s)", original_filename, xe.message, xe.status_code, xe.details, exc_info=True)
                         xero_result_message = f"❌ Failed to create draft bill in Xero: {xe.message}"
                         # Optionally provide more details based on xe.details if safe
                     except Exception as e:
-                        logger.exception(f"Unexpected error during Xero draft bill creation for {original_filename}: {e}")
+                        logger.exception("Unexpected error during Xero draft bill creation for %s: %s", original_filename, e)
                         xero_result_message = f"❌ An unexpected error occurred while creating the Xero draft bill."
                 else:
-                    logger.warning(f"No Xero account code found in map for category '{assigned_category}'. Skipping Xero bill creation.")
+                    logger.warning("No Xero account code found in map for category '%s'. Skipping Xero bill creation.", assigned_category)
                     xero_result_message = f"ℹ️ Category '{assigned_category}' found, but no matching Xero account code is configured."
 
 
             # 6. Construct and Send Final Slack Message
             # Post results to the target channel, in a thread under the original file share message
             if target_channel_id:
-                message_blocks = [
-                    {"type": "section", "text": {"type": "mrkdwn", "text": f"📄 Processed Invoice: *{original_filename}*"}}
-                ]
-                # Add OCR details if available
-                if ocr_data:
-                    ocr_details = f"*Vendor:* {ocr_data.vendor_name or '_Not Found_'}\n" \
-                                  f"*Amount:* {ocr_data.total_amount or '_Not Found_'}\n" \
-                                  f"*Date:* {ocr_data.invoice_date or '_Not Found_'}\n" \
-                                  f"*Due Date:* {ocr_data.due_date or '_Not Found_'}"
-                    message_blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": ocr_details}})
-                else:
-                     message_blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": "_OCR failed to extract details._"}})
-
-                # Add Categorization details if available
-                if categorization_data:
-                    cat_status_emoji = {
-                        "matched": "✅",
-                        "not_matched": "❓",
-                        "error": "❌"
-                    }.get(categorization_data.status, "❓")
-                    cat_details = f"{cat_status_emoji} *Category:* {categorization_data.assigned_category or '_Not Assigned_'}\n" \
-                                  f"*Notes:* {categorization_data.notes or '_None_'}"
-                    message_blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": cat_details}})
-                else:
-                     message_blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": "_Categorization was not performed._"}})
-
-                # Add Xero result message if available
-                if xero_result_message:
-                    message_blocks.append({"type": "divider"})
-                    message_blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": xero_result_message}})
-
+                message_blocks = _build_blocks(ocr_data, categorization_data, xero_result_message, original_filename, status_lines)
 
                 # Send the message to the target channel, threaded to the original upload
                 try:
@@ -280,41 +371,70 @@ if bolt_app:
                         text=f"Invoice Processed: {original_filename}", # Fallback text
                         thread_ts=thread_ts # Thread the reply under the original file share event
                     )
-                    logger.info(f"Posted processing results for {original_filename} to channel {target_channel_id} in thread {thread_ts}")
+                    logger.info("Posted processing results for %s to channel %s in thread %s", original_filename, target_channel_id, thread_ts)
                 except Exception as slack_err:
-                    logger.error(f"Failed to post results message to Slack channel {target_channel_id}: {slack_err}", exc_info=True)
+                    logger.error("Failed to post results message to Slack channel %s: %s", target_channel_id, slack_err, exc_info=True)
                     # Maybe try a simpler message as fallback?
                     await say(text=f"Finished processing {original_filename}, but couldn't post detailed results to the target channel.", thread_ts=thread_ts)
 
             else:
                 logger.warning("SLACK_TARGET_CHANNEL_ID not configured. Cannot post results.")
+                if status_lines:
+                    await say(text="\n".join(status_lines), thread_ts=thread_ts)
                 # Optionally, reply in the original channel if no target is set, though this might be noisy.
                 # await say(text=f"Processed {original_filename}. Configure SLACK_TARGET_CHANNEL_ID to see detailed results.", thread_ts=thread_ts)
 
 
         except aiohttp.ClientError as e:
-             logger.error(f"Network error downloading file {file_id}: {e}", exc_info=True)
+             logger.error("Network error downloading file %s: %s", file_id, e, exc_info=True)
              await say(text=f"Sorry, there was a network error trying to download `{original_filename}`.", thread_ts=thread_ts)
         except Exception as e:
-            logger.exception(f"Unhandled error processing file {file_id} ({original_filename}): {e}")
+            logger.exception("Unhandled error processing file %s (%s): %s", file_id, original_filename, e)
             await say(text=f"Sorry, an unexpected error occurred while processing `{original_filename}`. Please check the logs.", thread_ts=thread_ts)
 
-        finally:
-            # Clean up the temporary file and directory
-            if file_path and os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                    logger.info(f"Removed temporary file: {file_path}")
-                except OSError as e:
-                    logger.error(f"Error removing temporary file {file_path}: {e}")
-            if temp_dir and os.path.exists(temp_dir):
-                try:
-                    shutil.rmtree(temp_dir)
-                    logger.info(f"Removed temporary directory: {temp_dir}")
-                except OSError as e:
-                    logger.error(f"Error removing temporary directory {temp_dir}: {e}")
 
-        # No ack() needed for events API
+# --- Background Workers ---
+async def _invoice_worker(worker_id: int) -> None:
+    """Pulls queued Slack file jobs and processes them one at a time."""
+    while True:
+        job = await invoice_queue.get()
+        try:
+            async with INVOICE_SEM:
+                await process_file_job(**job)
+        except Exception:
+            logger.exception("Invoice worker %d failed processing file %s", worker_id, job.get("file_id"))
+        finally:
+            invoice_queue.task_done()
+
+# --- Application Lifecycle ---
+@app.on_event("startup")
+async def startup():
+    """Creates the shared HTTP session and sizes the executor used for blocking service calls."""
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=BLOCKING_WORKERS))
+    app.state.http = aiohttp.ClientSession(
+        # Sized to the worker pool: every worker can hold a keep-alive connection to files.slack.com
+        connector=aiohttp.TCPConnector(
+            limit=max(32, 2 * INVOICE_WORKERS), limit_per_host=INVOICE_WORKERS, keepalive_timeout=75, ttl_dns_cache=300
+        ),
+        timeout=aiohttp.ClientTimeout(total=30, connect=5)
+    )
+    logger.info("Shared aiohttp ClientSession created.")
+    # Warmed once per worker process in the background, not per invoice: the token refresh and
+    # connections lookup don't depend on the invoice, and bills arriving first just wait on the service's lock
+    app.state.xero_warmup = asyncio.create_task(_warm_xero(asyncio.get_running_loop())) if xero_service else None
+    app.state.invoice_workers = [asyncio.create_task(_invoice_worker(i)) for i in range(INVOICE_WORKERS)] if bolt_app else []
+    logger.info("Started %d invoice workers.", len(app.state.invoice_workers))
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Stops the invoice workers and closes the shared HTTP session."""
+    for task in app.state.invoice_workers:
+        task.cancel()
+    if app.state.xero_warmup:
+        app.state.xero_warmup.cancel()
+    await asyncio.gather(*app.state.invoice_workers, return_exceptions=True)
+    await app.state.http.close()
+    logger.info("Shared aiohttp ClientSession closed.")
 
 # --- FastAPI Endpoints ---
 @app.post("/slack/events")
@@ -336,58 +456,45 @@ async def process_invoice(file: UploadFile = File(...)):
     if not categorization_service:
         raise HTTPException(status_code=500, detail="Categorization Service not available")
 
-    # Ensure temp directory exists
-    temp_dir = tempfile.mkdtemp()
-    file_path = os.path.join(temp_dir, file.filename)
     response = ProcessedInvoiceResponse()
 
     try:
-        # Save uploaded file temporarily
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        logger.info(f"Temporarily saved invoice to: {file_path}")
-
-        # 1. Perform OCR
-        logger.info("Starting OCR extraction...")
-        # Read file content as bytes
-        with open(file_path, "rb") as f:
-            file_content = f.read()
-
-        # Call extract with both content and filename
-        response.ocr_result = ocr_service.extract(file_content=file_content, filename=file.filename)
-
-        if not response.ocr_result:
-            logger.warning(f"OCR extraction returned no result for {file.filename}")
-        if not response.ocr_result or not response.ocr_result.vendor_name: # Check if OCR yielded data
-             logger.warning("OCR did not extract sufficient data.")
-             response.error = "OCR failed to extract sufficient data from the invoice."
-             # Decide if you want to stop here or still try categorization
-             # For now, let's attempt categorization even with partial data
-
-        # 2. Perform Categorization (only if OCR was somewhat successful)
-        if response.ocr_result:
-            logger.info("Starting categorization...")
-            response.categorization_result = categorization_service.categorize(response.ocr_result)
-            logger.info(f"Categorization Result: {response.categorization_result}")
-        else:
-             logger.warning("Skipping categorization due to lack of OCR data.")
-             if not response.error:
-                response.error = "Skipping categorization due to lack of OCR data."
+        # OCR consumes bytes, so read the upload straight into memory
+        file_content = await file.read()
+        logger.info("Received invoice upload %s (%s bytes)", file.filename, len(file_content))
+
+        # Shares the invoice-wide concurrency cap with the Slack workers
+        async with INVOICE_SEM:
+            # 1. Perform OCR
+            logger.info("Starting OCR extraction...")
+            # Call extract with both content and filename; the PDF parsing runs off the event loop
+            response.ocr_result = await ocr_service.extract_async(file_content=file_content, filename=file.filename)
+
+            if not response.ocr_result:
+                logger.warning("OCR extraction returned no result for %s", file.filename)
+            if not response.ocr_result or not response.ocr_result.vendor_name: # Check if OCR yielded data
+                 logger.warning("OCR did not extract sufficient data.")
+                 response.error = "OCR failed to extract sufficient data from the invoice."
+                 # Decide if you want to stop here or still try categorization
+                 # For now, let's attempt categorization even with partial data
+
+            # 2. Perform Categorization (only if OCR was somewhat successful)
+            if response.ocr_result:
+                logger.info("Starting categorization...")
+                response.categorization_result = await categorization_service.categorize_async(response.ocr_result)
+                logger.info("Categorization Result: %s", response.categorization_result)
+            else:
+                 logger.warning("Skipping categorization due to lack of OCR data.")
+                 if not response.error:
+                    response.error = "Skipping categorization due to lack of OCR data."
 
     except Exception as e:
-        logger.exception(f"Error processing invoice {file.filename}: {e}")
+        logger.exception("Error processing invoice %s: %s", file.filename, e)
         # Use HTTPException for client/server errors, keep generic error for unexpected ones
         response.error = f"An unexpected error occurred: {str(e)}"
         # Consider re-raising HTTPException for specific known errors
 
     finally:
-        # Clean up the temporary file and directory
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            logger.info(f"Removed temporary file: {file_path}")
-        if os.path.exists(temp_dir):
-            os.rmdir(temp_dir) # Only removes if empty
-            logger.info(f"Removed temporary directory: {temp_dir}")
         # Ensure file handle is closed
         await file.close()
 
@@ -395,15 +502,13 @@ async def process_invoice(file: UploadFile = File(...)):
 
 @app.get("/health")
 def health_check():
-    """Basic health check endpoint."""
-    return {"status": "ok",
-            "ocr_service_available": ocr_service is not None,
-            "categorization_service_available": categorization_service is not None,
-            "xero_service_available": xero_service is not None # Added Xero status
-            }
+    """Basic health check endpoint. Returns the precomputed body; liveness probes hit this constantly."""
+    return Response(content=_HEALTH_BYTES, media_type="application/json")
 
 if __name__ == "__main__":
     import uvicorn
     # Note: Running directly like this is mainly for simple testing.
-    # Production deployments usually use Gunicorn + Uvicorn workers.
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    # Production deployments usually use Gunicorn + Uvicorn workers (uvicorn.workers.UvicornWorker,
+    # which picks up uvloop/httptools automatically when installed).
+    # uvloop and httptools ship with uvicorn[standard]
+    uvicorn.run(app, host="127.0.0.1", port=8000, loop="uvloop", http="httptools")
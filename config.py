@@ -1,11 +1,28 @@
 import os
 from google.cloud import secretmanager
+from google.api_core import exceptions as gcp_exceptions
 from dotenv import load_dotenv
-import json
+import orjson
 import logging
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
-# Set up basic logging
-logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+# Set up logging once for the whole process. On Cloud Run / Cloud Functions (K_SERVICE is set),
+# prefer Cloud Logging's structured JSON handler, which adds severity and trace correlation.
+def _setup_logging() -> None:
+    if os.getenv("K_SERVICE") or os.getenv("FUNCTION_TARGET"):
+        try:
+            import google.cloud.logging
+            google.cloud.logging.Client().setup_logging(log_level=logging.INFO)
+            return
+        except Exception as e: # Library missing or no credentials: fall back to plain stderr logging
+            logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+            logging.warning("Cloud Logging setup failed, using basic logging: %s", e)
+            return
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+_setup_logging()
 
 # Load environment variables from .env file for local development
 load_dotenv()
@@ -32,153 +49,254 @@ XERO_ACCOUNT_CODE_MAP_SECRET_NAME = "XERO_ACCOUNT_CODE_MAP"
 # --- Helper Function to Get Secrets (Keep at module level) ---
 _secret_cache = {} # Simple in-memory cache for secrets
 
+# One Secret Manager client per process: construction does ADC discovery and opens a gRPC channel,
+# so it is created lazily on first use and shared (the client is thread-safe)
+_SM_CLIENT: secretmanager.SecretManagerServiceClient | None = None
+_SM_CLIENT_LOCK = threading.Lock()
+
+def _sm_client() -> secretmanager.SecretManagerServiceClient:
+    """Returns the shared Secret Manager client, creating it on first use."""
+    global _SM_CLIENT
+    if _SM_CLIENT is None:
+        with _SM_CLIENT_LOCK:
+            if _SM_CLIENT is None:
+                _SM_CLIENT = secretmanager.SecretManagerServiceClient()
+    return _SM_CLIENT
+
+def _access_secret(secret_version_name: str) -> str:
+    """Reads one secret version via the shared client, retrying once on a fresh client.
+
+    A stale or half-open gRPC channel surfaces as Unavailable/DeadlineExceeded; dropping the
+    shared client forces a new channel for the retry (and for everyone after it).
+    """
+    global _SM_CLIENT
+    try:
+        response = _sm_client().access_secret_version(request={"name": secret_version_name})
+    except (gcp_exceptions.ServiceUnavailable, gcp_exceptions.DeadlineExceeded) as e:
+        logging.warning("Secret Manager call failed (%s); retrying with a new client.", e)
+        with _SM_CLIENT_LOCK:
+            _SM_CLIENT = None
+        response = _sm_client().access_secret_version(request={"name": secret_version_name})
+    return response.payload.data.decode("UTF-8")
+
 def get_secret(secret_name: str, project_id: str = GCP_PROJECT_ID) -> str | None:
     """Retrieves a secret from Google Secret Manager or environment variables."""
-    _secret_cache.clear() # Ensure cache is clear for each call in this pattern
     if secret_name in _secret_cache:
         return _secret_cache[secret_name]
 
+    # One Secret Manager attempt (when enabled), then a single environment-variable fallback
     secret_value = None
     if SECRET_MANAGER_ENABLED:
         if not project_id:
             logging.warning("GCP_PROJECT_ID not set, cannot fetch from Secret Manager.")
-            secret_value = os.getenv(secret_name) # Fallback to env var
-        else:
-            if not _UNDER_TEST_SKIP_GCP:
-                try:
-                    client = secretmanager.SecretManagerServiceClient()
-                    secret_version_name = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
-                    response = client.access_secret_version(request={"name": secret_version_name})
-                    secret_value = response.payload.data.decode("UTF-8")
-                    logging.info(f"Successfully retrieved secret '{secret_name}' from Secret Manager.")
-                except Exception as e:
-                    logging.warning(f"Failed to retrieve secret '{secret_name}' from Secret Manager: {e}")
-                    logging.warning("Falling back to environment variable.")
-                    secret_value = os.getenv(secret_name)
-            # else: If skipping GCP, secret_value remains None initially
-            # We handle the fallback below
-    else:
-        # If Secret Manager is disabled, get directly from environment variables
-        secret_value = os.getenv(secret_name)
+        elif not _UNDER_TEST_SKIP_GCP:
+            try:
+                secret_version_name = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
+                secret_value = _access_secret(secret_version_name)
+                logging.info("Successfully retrieved secret '%s' from Secret Manager.", secret_name)
+            except Exception as e:
+                logging.warning("Failed to retrieve secret '%s' from Secret Manager: %s", secret_name, e)
+                logging.warning("Falling back to environment variable.")
 
-    # Common fallback/caching logic
     if not secret_value:
-        # If SM was enabled & skipped GCP, or SM disabled, or SM failed and fallback env var missing
-        # Try getting from env var one last time (handles SM disabled case cleanly)
         secret_value = os.getenv(secret_name)
 
     if secret_value:
         _secret_cache[secret_name] = secret_value
     else:
-         logging.warning(f"Secret/Environment variable '{secret_name}' not found.")
+         logging.warning("Secret/Environment variable '%s' not found.", secret_name)
 
     return secret_value
 
+# Every secret Settings loads; fetched concurrently since each is an independent Secret Manager round-trip
+_SETTINGS_SECRET_NAMES = (
+    SLACK_BOT_TOKEN_SECRET_NAME,
+    SLACK_SIGNING_SECRET_SECRET_NAME,
+    MISTRAL_API_KEY_SECRET_NAME,
+    OPENAI_API_KEY_SECRET_NAME,
+    XERO_CLIENT_ID_SECRET_NAME,
+    XERO_CLIENT_SECRET_SECRET_NAME,
+    XERO_REDIRECT_URI_SECRET_NAME,
+    XERO_REFRESH_TOKEN_SECRET_NAME,
+    XERO_TENANT_ID_SECRET_NAME,
+    XERO_ACCOUNT_CODE_MAP_SECRET_NAME,
+)
+
+# Settings attributes that must be non-empty; checked in this order so the log/error lists are stable.
+# Xero is optional (the apps disable it with a warning when its OAuth client isn't configured), and
+# XERO_REFRESH_TOKEN / XERO_TENANT_ID / XERO_ACCOUNT_CODE_MAP only exist after setup anyway.
+_REQUIRED_SETTINGS_SM = (
+    "GCP_PROJECT_ID",
+    "SLACK_BOT_TOKEN",
+    "SLACK_SIGNING_SECRET",
+    "SLACK_TARGET_CHANNEL_ID",
+    "TEMP_STORAGE_BUCKET_NAME",
+    "MISTRAL_API_KEY",
+    "OPENAI_API_KEY",
+    "ALLOWED_CATEGORIES",
+    "COMPANY_CONTEXT",
+)
+# Env-only (local) runs don't need the GCP project, target channel or temp bucket
+_REQUIRED_SETTINGS_ENV = (
+    "SLACK_BOT_TOKEN",
+    "SLACK_SIGNING_SECRET",
+    "MISTRAL_API_KEY",
+    "OPENAI_API_KEY",
+    "ALLOWED_CATEGORIES",
+    "COMPANY_CONTEXT",
+)
+# Without these no invoice can be received, read or categorized, so the entrypoints refuse to start
+_CORE_SETTINGS = (
+    "SLACK_BOT_TOKEN",
+    "SLACK_SIGNING_SECRET",
+    "MISTRAL_API_KEY",
+    "OPENAI_API_KEY",
+)
+
 # --- Settings Class --- 
 class Settings:
     def __init__(self):
+        # One snapshot of the environment, so every non-secret setting below reads a single
+        # consistent view (and skips os.environ's per-lookup key encoding/decoding)
+        env = os.environ.copy()
+
+        # --- Secrets (fan out so cold start pays ~1 RTT instead of one per secret) ---
+        if SECRET_MANAGER_ENABLED and not _UNDER_TEST_SKIP_GCP:
+            with ThreadPoolExecutor(max_workers=len(_SETTINGS_SECRET_NAMES)) as pool:
+                secrets = dict(zip(_SETTINGS_SECRET_NAMES, pool.map(get_secret, _SETTINGS_SECRET_NAMES)))
+        else:
+            # Env-only lookups are instant; spinning up threads would cost more than it saves
+            secrets = {name: get_secret(name) for name in _SETTINGS_SECRET_NAMES}
+
         # --- Google Cloud Settings ---
         self.GCP_PROJECT_ID = GCP_PROJECT_ID # Use module-level loaded value
-        self.GCP_REGION = os.getenv("GCP_REGION", "us-central1") # Default region
+        self.GCP_REGION = env.get("GCP_REGION", "us-central1") # Default region
 
         # --- Slack Settings ---
-        self.SLACK_BOT_TOKEN = get_secret(SLACK_BOT_TOKEN_SECRET_NAME)
-        self.SLACK_SIGNING_SECRET = get_secret(SLACK_SIGNING_SECRET_SECRET_NAME)
-        self.SLACK_TARGET_CHANNEL_ID = os.getenv("SLACK_TARGET_CHANNEL_ID")
+        self.SLACK_BOT_TOKEN = secrets[SLACK_BOT_TOKEN_SECRET_NAME]
+        self.SLACK_SIGNING_SECRET = secrets[SLACK_SIGNING_SECRET_SECRET_NAME]
+        self.SLACK_TARGET_CHANNEL_ID = env.get("SLACK_TARGET_CHANNEL_ID")
+        # Only disable when a trusted proxy in front of the app already verifies Slack signatures
+        self.SLACK_REQUEST_VERIFICATION_ENABLED = env.get("SLACK_REQUEST_VERIFICATION_ENABLED", "true").lower() == "true"
 
         # --- API Keys ---
-        self.MISTRAL_API_KEY = get_secret(MISTRAL_API_KEY_SECRET_NAME)
-        self.OPENAI_API_KEY = get_secret(OPENAI_API_KEY_SECRET_NAME)
+        self.MISTRAL_API_KEY = secrets[MISTRAL_API_KEY_SECRET_NAME]
+        self.OPENAI_API_KEY = secrets[OPENAI_API_KEY_SECRET_NAME]
         # --- Xero Credentials (Initial OAuth needs ID, Secret, Redirect, Scopes) ---
-        self.XERO_CLIENT_ID = get_secret(XERO_CLIENT_ID_SECRET_NAME)
-        self.XERO_CLIENT_SECRET = get_secret(XERO_CLIENT_SECRET_SECRET_NAME)
+        self.XERO_CLIENT_ID = secrets[XERO_CLIENT_ID_SECRET_NAME]
+        self.XERO_CLIENT_SECRET = secrets[XERO_CLIENT_SECRET_SECRET_NAME]
         # Redirect URI and Scopes might come from env var directly or secrets
-        self.XERO_REDIRECT_URI = get_secret(XERO_REDIRECT_URI_SECRET_NAME) or os.getenv("XERO_REDIRECT_URI")
-        self.XERO_SCOPES = os.getenv("XERO_SCOPES", "offline_access accounting.transactions accounting.contacts.read accounting.settings.read openid profile email")
+        self.XERO_REDIRECT_URI = secrets[XERO_REDIRECT_URI_SECRET_NAME] or env.get("XERO_REDIRECT_URI")
+        self.XERO_SCOPES = env.get("XERO_SCOPES", "offline_access accounting.transactions accounting.contacts.read accounting.settings.read openid profile email")
         # Refresh token and Tenant ID are obtained *after* initial auth, load if available
-        self.XERO_REFRESH_TOKEN = get_secret(XERO_REFRESH_TOKEN_SECRET_NAME)
-        self.XERO_TENANT_ID = get_secret(XERO_TENANT_ID_SECRET_NAME)
+        self.XERO_REFRESH_TOKEN = secrets[XERO_REFRESH_TOKEN_SECRET_NAME]
+        self.XERO_TENANT_ID = secrets[XERO_TENANT_ID_SECRET_NAME]
 
         # --- Service Selection (Add back) ---
-        self.OCR_SERVICE = os.getenv("OCR_SERVICE", "mistral").lower()
-        self.CATEGORIZATION_SERVICE = os.getenv("CATEGORIZATION_SERVICE", "openai").lower()
+        self.OCR_SERVICE = env.get("OCR_SERVICE", "mistral").lower()
+        # PDF text extraction backend for OCR: "pymupdf" (fast, native) or "pypdf2" (pure-Python fallback)
+        self.PDF_BACKEND = env.get("PDF_BACKEND", "pymupdf").lower()
+        # Directory for cached OCR extractions keyed by file hash (see services/ocr_cache.py); unset/"" disables.
+        # Entries hold vendor/amount data, and on Cloud Run/GCF /tmp is in-memory, so this is opt-in
+        self.OCR_CACHE_DIR = env.get("OCR_CACHE_DIR", "")
+        # Stream Mistral OCR replies, abandoning a reply as soon as it is clearly not a JSON object
+        self.OCR_STREAM_RESPONSES = env.get("OCR_STREAM_RESPONSES", "false").lower() == "true"
+        self.CATEGORIZATION_SERVICE = env.get("CATEGORIZATION_SERVICE", "openai").lower()
+        # Model used for expense categorization (short single-label task, so a small model by default)
+        self.CATEGORIZATION_MODEL = env.get("CATEGORIZATION_MODEL", "gpt-4o-mini")
+        # Stream categorization replies and stop reading once a matched category has arrived
+        # (drops the trailing notes, so off by default)
+        self.CATEGORIZATION_EARLY_EXIT = env.get("CATEGORIZATION_EARLY_EXIT", "false").lower() == "true"
 
         # --- Categorization Settings ---
-        _allowed_cats_str = os.getenv("ALLOWED_CATEGORIES", '["Software & Subscriptions", "Office Supplies", "Travel", "Marketing & Advertising", "Meals & Entertainment", "Utilities", "Professional Services"]')
+        _allowed_cats_str = env.get("ALLOWED_CATEGORIES", '["Software & Subscriptions", "Office Supplies", "Travel", "Marketing & Advertising", "Meals & Entertainment", "Utilities", "Professional Services"]')
         try:
-            self.ALLOWED_CATEGORIES = json.loads(_allowed_cats_str)
+            self.ALLOWED_CATEGORIES = orjson.loads(_allowed_cats_str)
             if not isinstance(self.ALLOWED_CATEGORIES, list):
-                logging.warning(f"ALLOWED_CATEGORIES was not a valid JSON list. Got: {_allowed_cats_str}. Using empty list.")
+                logging.warning("ALLOWED_CATEGORIES was not a valid JSON list. Got: %s. Using empty list.", _allowed_cats_str)
                 self.ALLOWED_CATEGORIES = []
             # Ensure all items are strings
             self.ALLOWED_CATEGORIES = [str(item) for item in self.ALLOWED_CATEGORIES]
-        except json.JSONDecodeError:
-            logging.warning(f"Failed to parse ALLOWED_CATEGORIES JSON: {_allowed_cats_str}. Attempting comma-separated fallback.")
+        except orjson.JSONDecodeError:
+            logging.warning("Failed to parse ALLOWED_CATEGORIES JSON: %s. Attempting comma-separated fallback.", _allowed_cats_str)
             # Fallback for simple comma-separated strings (optional, but might be useful)
             self.ALLOWED_CATEGORIES = [cat.strip() for cat in _allowed_cats_str.split(',') if cat.strip()]
             if not self.ALLOWED_CATEGORIES:
-                 logging.warning(f"Could not parse ALLOWED_CATEGORIES as JSON or comma-separated. Using empty list.")
+                 logging.warning("Could not parse ALLOWED_CATEGORIES as JSON or comma-separated. Using empty list.")
+
+        # Vendor name substring -> category for repeat vendors, e.g. {"aws": "Software & Subscriptions"};
+        # matching invoices are categorized locally without an LLM call
+        _vendor_rules_json = env.get("VENDOR_CATEGORY_RULES", "{}")
+        try:
+            self.VENDOR_CATEGORY_RULES = orjson.loads(_vendor_rules_json)
+            if not isinstance(self.VENDOR_CATEGORY_RULES, dict):
+                logging.warning("VENDOR_CATEGORY_RULES was not a valid JSON dictionary. Got: %s. Using no rules.", _vendor_rules_json)
+                self.VENDOR_CATEGORY_RULES = {}
+        except orjson.JSONDecodeError:
+            logging.warning("Failed to parse VENDOR_CATEGORY_RULES JSON: %s. Using no rules.", _vendor_rules_json)
+            self.VENDOR_CATEGORY_RULES = {}
 
         # --- Company Context --- 
-        self.COMPANY_CONTEXT = os.getenv("COMPANY_CONTEXT", "44pixels is a mobile app development studio focused on building utility apps. Key expense areas include software subscriptions, cloud services (AWS, GCP), and performance marketing (e.g., Facebook Ads, Google Ads).")
+        self.COMPANY_CONTEXT = env.get("COMPANY_CONTEXT", "44pixels is a mobile app development studio focused on building utility apps. Key expense areas include software subscriptions, cloud services (AWS, GCP), and performance marketing (e.g., Facebook Ads, Google Ads).")
+
+        # --- Processing Settings ---
+        # Upper bound on invoices processed concurrently by one worker (download -> OCR -> categorize -> Xero)
+        self.MAX_CONCURRENT_INVOICES = int(env.get("MAX_CONCURRENT_INVOICES", "16"))
+        # Upper bound on concurrent OpenAI categorization requests (InvoiceCategorizer.categorize_async)
+        self.OPENAI_MAX_CONCURRENCY = int(env.get("OPENAI_MAX_CONCURRENCY", "32"))
 
         # --- Storage Settings ---
-        self.TEMP_STORAGE_BUCKET_NAME = os.getenv("TEMP_STORAGE_BUCKET_NAME", 
+        self.TEMP_STORAGE_BUCKET_NAME = env.get("TEMP_STORAGE_BUCKET_NAME", 
                                                  f"{self.GCP_PROJECT_ID}-invoices-temp" if self.GCP_PROJECT_ID else None)
 
+        # Stage a copy of each invoice in the temp bucket while it is processed (off by default;
+        # OCR works from the downloaded bytes, so the copy only serves audit/retry)
+        self.KEEP_INVOICE_COPY = env.get("KEEP_INVOICE_COPY", "false").lower() == "true"
+
         # --- Xero Account Code Map ---
-        _xero_codes_json = get_secret(XERO_ACCOUNT_CODE_MAP_SECRET_NAME) or os.getenv("XERO_ACCOUNT_CODE_MAP", "{}")
+        _xero_codes_json = secrets[XERO_ACCOUNT_CODE_MAP_SECRET_NAME] or env.get("XERO_ACCOUNT_CODE_MAP", "{}")
         try:
-            self.XERO_ACCOUNT_CODE_MAP = json.loads(_xero_codes_json)
+            self.XERO_ACCOUNT_CODE_MAP = orjson.loads(_xero_codes_json)
             if not isinstance(self.XERO_ACCOUNT_CODE_MAP, dict):
-                logging.warning(f"XERO_ACCOUNT_CODE_MAP was not a valid JSON dictionary. Got: {_xero_codes_json}. Using empty map.")
+                logging.warning("XERO_ACCOUNT_CODE_MAP was not a valid JSON dictionary. Got: %s. Using empty map.", _xero_codes_json)
                 self.XERO_ACCOUNT_CODE_MAP = {}
-        except json.JSONDecodeError:
-            logging.warning(f"Failed to parse XERO_ACCOUNT_CODE_MAP JSON: {_xero_codes_json}. Using empty map.")
+        except orjson.JSONDecodeError:
+            logging.warning("Failed to parse XERO_ACCOUNT_CODE_MAP JSON: %s. Using empty map.", _xero_codes_json)
             self.XERO_ACCOUNT_CODE_MAP = {}
             
         # --- Validation ---
-        REQUIRED_CONFIG = {
-            "GCP_PROJECT_ID": self.GCP_PROJECT_ID,
-            "SLACK_BOT_TOKEN": self.SLACK_BOT_TOKEN,
-            "SLACK_SIGNING_SECRET": self.SLACK_SIGNING_SECRET,
-            "SLACK_TARGET_CHANNEL_ID": self.SLACK_TARGET_CHANNEL_ID,
-            "TEMP_STORAGE_BUCKET_NAME": self.TEMP_STORAGE_BUCKET_NAME,
-            "MISTRAL_API_KEY": self.MISTRAL_API_KEY,
-            "OPENAI_API_KEY": self.OPENAI_API_KEY,
-            "XERO_CLIENT_ID": self.XERO_CLIENT_ID, # Needed for OAuth flow
-            "XERO_CLIENT_SECRET": self.XERO_CLIENT_SECRET, # Needed for OAuth flow
-            "XERO_REDIRECT_URI": self.XERO_REDIRECT_URI, # Needed for OAuth flow
-            "ALLOWED_CATEGORIES": self.ALLOWED_CATEGORIES,
-            "COMPANY_CONTEXT": self.COMPANY_CONTEXT
-            # XERO_REFRESH_TOKEN and XERO_TENANT_ID are not required initially
-            # XERO_ACCOUNT_CODE_MAP is useful but might be empty initially
-        }
-        # COMPANY_CONTEXT is useful but not strictly required to run
-        # Add other strictly required ones here
-        if not SECRET_MANAGER_ENABLED:
-            REQUIRED_CONFIG = {
-                "SLACK_BOT_TOKEN",
-                "SLACK_SIGNING_SECRET",
-                "MISTRAL_API_KEY",
-                "OPENAI_API_KEY",
-                "ALLOWED_CATEGORIES",
-                "COMPANY_CONTEXT",
-                "XERO_CLIENT_ID", # Needed for OAuth flow
-                "XERO_CLIENT_SECRET", # Needed for OAuth flow
-                "XERO_REDIRECT_URI" # Needed for OAuth flow
-            }
-            missing_configs = {key for key in REQUIRED_CONFIG if not getattr(self, key)}
-        else:
-            missing_configs = [k for k, v in REQUIRED_CONFIG.items() if not v]
+        required = _REQUIRED_SETTINGS_SM if SECRET_MANAGER_ENABLED else _REQUIRED_SETTINGS_ENV
+        missing_configs = [key for key in required if not getattr(self, key)]
+        self.MISSING_CONFIGS = sorted(missing_configs)
         if missing_configs:
-            logging.critical(f"Missing required configuration(s): {', '.join(missing_configs)}")
+            logging.critical("Missing required configuration(s): %s", ', '.join(missing_configs))
         
-        logging.info(f"Configuration loaded. OCR: {self.OCR_SERVICE}, Categorization: {self.CATEGORIZATION_SERVICE}")
+        logging.info("Configuration loaded. OCR: %s, Categorization: %s", self.OCR_SERVICE, self.CATEGORIZATION_SERVICE)
         if SECRET_MANAGER_ENABLED:
             logging.info("Using Google Secret Manager.")
         else:
             logging.info("Using Environment Variables for secrets.")
 
+    def require_core(self) -> None:
+        """
+        Raises RuntimeError if any core setting is missing, so a misconfigured deployment crashes at
+        boot instead of on its first invoice. Called by app.py and main.py at import; skipped under
+        TEST_SKIP_GCP. Settings itself doesn't raise, so config stays importable for tests and tooling.
+        """
+        missing_core = [key for key in _CORE_SETTINGS if not getattr(self, key)]
+        if missing_core and not _UNDER_TEST_SKIP_GCP:
+            raise RuntimeError(f"Missing required config: {', '.join(missing_core)}")
+
 # --- Instantiate Settings --- 
-settings = Settings()
+@functools.lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Returns the process-wide Settings instance, building it (and fetching secrets) only once."""
+    return Settings()
+
+def __getattr__(name: str):
+    """Resolves `config.settings` lazily, so importing config alone never fetches secrets."""
+    # Module-level alias kept for existing `from config import settings` imports; the
+    # Secret Manager round-trips now happen on first access instead of at import time
+    if name == "settings":
+        return get_settings()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
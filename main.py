@@ -1,7 +1,16 @@
 # main.py
 import os
+import io
 import logging
+import functools
 import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import Future, ThreadPoolExecutor
 from slack_bolt import App
 from slack_bolt.adapter.google_cloud_functions import SlackRequestHandler # For GCF deployment
 from google.cloud import storage
@@ -13,37 +22,72 @@ from services.categorize import get_categorization_service
 from services.xero import get_xero_service
 
 # --- Logging Setup ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Handlers are configured once in config.py (imported above)
 logger = logging.getLogger(__name__)
 
 # --- Initialize Services ---
-# Use factory functions which handle configuration checks internally
-ocr_service = get_ocr_service()
-categorization_service = get_categorization_service()
-xero_service = get_xero_service()
-storage_client = None
-if config.TEMP_STORAGE_BUCKET_NAME:
+# Built lazily on first use (after the PDF filetype check), so URL verification requests and
+# non-invoice uploads never pay for OCR/categorization/Xero/GCS client setup on a cold start
+def _ocr():
+    # Not memoized here: the factory keeps a built service itself and retries after a failed init
+    return get_ocr_service()
+
+def _cat():
+    # Not memoized here: the factory keeps a built service itself and retries after a failed init
+    return get_categorization_service()
+
+@functools.lru_cache(maxsize=1)
+def _xero():
+    return get_xero_service()
+
+@functools.lru_cache(maxsize=1)
+def _gcs():
+    """Returns the GCS client, or None if no temp bucket is configured or init fails."""
+    bucket_name = config.get_settings().TEMP_STORAGE_BUCKET_NAME
+    if not bucket_name:
+        logger.warning("TEMP_STORAGE_BUCKET_NAME not configured. File handling might be limited.")
+        return None
     try:
         storage_client = storage.Client()
-        logger.info(f"Google Cloud Storage client initialized for bucket: {config.TEMP_STORAGE_BUCKET_NAME}")
+        logger.info("Google Cloud Storage client initialized for bucket: %s", bucket_name)
+        return storage_client
     except Exception as e:
-        logger.error(f"Failed to initialize Google Cloud Storage client: {e}", exc_info=True)
+        logger.error("Failed to initialize Google Cloud Storage client: %s", e, exc_info=True)
         # Bot might still function if GCS isn't strictly required, but log critical error
         # Depending on requirements, might want to raise an exception here
-else:
-    logger.warning("TEMP_STORAGE_BUCKET_NAME not configured. File handling might be limited.")
+        return None
+
+
+# Background pool for the optional GCS copy, so the upload runs alongside OCR instead of before it
+_gcs_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="gcs")
 
 
 # --- Initialize Slack App ---
-# Use secrets loaded via config module
+config.get_settings().require_core() # Fail fast on missing Slack/Mistral/OpenAI config, before a cold start serves anything
+# Use secrets loaded via config module (values live on Settings; config has no module-level copies)
 app = App(
-    token=config.SLACK_BOT_TOKEN,
-    signing_secret=config.SLACK_SIGNING_SECRET,
+    token=config.get_settings().SLACK_BOT_TOKEN,
+    signing_secret=config.get_settings().SLACK_SIGNING_SECRET,
     process_before_response=True # Important for Function-as-a-Service environments
 )
 
 # --- Helper Functions ---
-def download_file_from_slack(file_info: dict, token: str) -> Optional[bytes]:
+SLACK_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# One pooled session for Slack downloads so warm instances reuse the TLS connection to files.slack.com
+_slack_session = requests.Session()
+_slack_session.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+@functools.lru_cache(maxsize=8)
+def _bucket(bucket_name: str):
+    """Returns the (cached) Bucket handle for bucket_name; assumes _gcs() is available."""
+    return _gcs().bucket(bucket_name)
+
+def download_file_from_slack(file_info: dict, token: str) -> Optional[bytearray]:
     """Downloads file content from Slack given file info."""
     url_private = file_info.get('url_private_download')
     if not url_private:
@@ -52,46 +96,105 @@ def download_file_from_slack(file_info: dict, token: str) -> Optional[bytes]:
 
     headers = {'Authorization': f'Bearer {token}'}
     try:
-        import requests # Add requests to requirements.txt
-        response = requests.get(url_private, headers=headers, stream=True)
-        response.raise_for_status() # Raise exception for bad status codes
-        logger.info(f"Successfully initiated download for file: {file_info.get('name')}")
-        return response.content
+        with _slack_session.get(url_private, headers=headers, stream=True, timeout=(5, 30)) as response:
+            response.raise_for_status() # Raise exception for bad status codes
+            logger.info("Successfully initiated download for file: %s", file_info.get('name'))
+            # Fill one buffer sized from Content-Length instead of letting response.content
+            # join a list of chunks (an extra full-size copy)
+            buf = bytearray(int(response.headers.get('Content-Length') or 0))
+            pos = 0
+            for chunk in response.iter_content(chunk_size=SLACK_DOWNLOAD_CHUNK_SIZE):
+                end = pos + len(chunk)
+                buf[pos:end] = chunk # Grows the buffer if Content-Length was missing or short
+                pos = end
+            del buf[pos:] # Trim if fewer bytes arrived than advertised
+            return buf
     except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to download file from Slack: {e}", exc_info=True)
+        logger.error("Failed to download file from Slack: %s", e, exc_info=True)
         return None
     except Exception as e:
-        logger.error(f"An unexpected error occurred during file download: {e}", exc_info=True)
+        logger.error("An unexpected error occurred during file download: %s", e, exc_info=True)
         return None
 
 def upload_to_gcs(bucket_name: str, file_content: bytes, destination_blob_name: str) -> Optional[str]:
     """Uploads file content to Google Cloud Storage."""
+    storage_client = _gcs()
     if not storage_client or not bucket_name:
         logger.error("GCS client or bucket name not configured. Cannot upload.")
         return None
     try:
-        bucket = storage_client.bucket(bucket_name)
+        bucket = _bucket(bucket_name)
         blob = bucket.blob(destination_blob_name)
-        blob.upload_from_string(file_content, content_type='application/pdf')
-        logger.info(f"File uploaded to gs://{bucket_name}/{destination_blob_name}")
+        # Invoices are well under the 8MB multipart threshold, so with chunk_size unset this is a
+        # single POST; skip the client-side checksum pass since TLS already covers integrity
+        blob.chunk_size = None
+        blob.upload_from_file(io.BytesIO(file_content), size=len(file_content), content_type='application/pdf', checksum=None)
+        logger.info("File uploaded to gs://%s/%s", bucket_name, destination_blob_name)
         # Return the GCS URI
         return f"gs://{bucket_name}/{destination_blob_name}"
     except Exception as e:
-        logger.error(f"Failed to upload file to GCS: {e}", exc_info=True)
+        logger.error("Failed to upload file to GCS: %s", e, exc_info=True)
         return None
 
-def delete_from_gcs(bucket_name: str, blob_name: str):
-    """Deletes a blob from Google Cloud Storage."""
+def delete_from_gcs(bucket_name: str, blob_name: str, after: Optional[Future] = None):
+    """Deletes a blob from Google Cloud Storage, first waiting for its background upload if given."""
+    if after is not None:
+        after.result() # upload_to_gcs logs and swallows its own errors
+    storage_client = _gcs()
     if not storage_client or not bucket_name:
         logger.warning("GCS client or bucket name not configured. Cannot delete.")
         return
     try:
-        bucket = storage_client.bucket(bucket_name)
+        bucket = _bucket(bucket_name)
         blob = bucket.blob(blob_name)
         blob.delete()
-        logger.info(f"File gs://{bucket_name}/{blob_name} deleted.")
+        logger.info("File gs://%s/%s deleted.", bucket_name, blob_name)
     except Exception as e:
-        logger.error(f"Failed to delete file from GCS: {e}", exc_info=True)
+        logger.error("Failed to delete file from GCS: %s", e, exc_info=True)
+
+
+# --- Slack Message Templates ---
+_MSG_NO_FILE_INFO = "Sorry <@{u}>, I couldn't get the details for that file."
+_MSG_NO_FILE_OBJECT = "Sorry <@{u}>, I couldn't get the file object details."
+_MSG_PROCESSING = "Processing invoice `{f}` for you <@{u}>..."
+_MSG_DOWNLOAD_FAIL = "Sorry <@{u}>, I couldn't download the file `{f}`."
+_MSG_SERVICE_DOWN = "Sorry <@{u}>, the {service} service isn't configured correctly. Please contact an admin."
+_MSG_OCR_FAIL = "Sorry <@{u}>, I couldn't extract data from `{f}`. The OCR process failed."
+_MSG_CATEGORIZE_FAIL = "Sorry <@{u}>, I couldn't categorize the invoice `{f}`."
+_MSG_XERO_FAIL = "Sorry <@{u}>, I couldn't create the draft expense in Xero for `{f}`."
+_MSG_UNEXPECTED = "Sorry <@{u}>, an unexpected error occurred while processing `{f}`. Please check the logs or contact an admin."
+_MSG_SUCCESS = (
+    "Success! :tada: I've processed `{f}` for you <@{u}>.\n"
+    "- Vendor: `{vendor}`\n"
+    "- Amount: `{amount}` {currency}\n"
+    "- Category: `{category}`\n"
+    "- A draft bill has been created in Xero (ID: `{bill_id}`). Please review and approve it."
+)
+
+
+# --- Recently Seen Files ---
+# Bounded LRU of file IDs being processed or already handled (skipped or processed), so Slack
+# retries and duplicate file_shared events return before any API call. A failed attempt drops
+# its claim, so re-sharing the file tries again.
+_SEEN_FILES_MAX = 1024
+_seen_files: "OrderedDict[str, None]" = OrderedDict()
+_seen_files_lock = threading.Lock()
+
+def _mark_seen(file_id: str) -> bool:
+    """Records file_id as seen; returns False if it was already there."""
+    with _seen_files_lock:
+        if file_id in _seen_files:
+            _seen_files.move_to_end(file_id)
+            return False
+        _seen_files[file_id] = None
+        if len(_seen_files) > _SEEN_FILES_MAX:
+            _seen_files.popitem(last=False)
+        return True
+
+def _release_seen(file_id: str) -> None:
+    """Drops the claim on file_id (processing failed), so a later event for it is handled again."""
+    with _seen_files_lock:
+        _seen_files.pop(file_id, None)
 
 
 # --- Slack Event Handlers ---
@@ -109,128 +212,146 @@ def handle_file_shared(body: dict, client, ack, say):
         logger.error("Received file_shared event with missing data.")
         return
 
-    logger.info(f"Received file_shared event for file_id: {file_id} from user: {user_id} in channel: {channel_id}")
+    # Claim the file before any slow work so a concurrent retry of this event backs off
+    if not _mark_seen(file_id):
+        logger.info("Ignoring already-seen file_id: %s", file_id)
+        return
+
+    logger.info("Received file_shared event for file_id: %s from user: %s in channel: %s", file_id, user_id, channel_id)
+
+    # Some payloads carry the file object inline; reject non-PDFs without a files.info call
+    event_filetype = event.get('file', {}).get('filetype')
+    if event_filetype and event_filetype != 'pdf':
+        logger.info("Ignoring non-PDF file_id: %s (%s)", file_id, event_filetype)
+        return
+
+    # GCS copy state; the finally block below is the single place the copy gets cleaned up
+    file_name = 'the file'
+    gcs_bucket_name = None
+    gcs_blob_name = None
+    gcs_upload = None
+    gcs_delete = None
+    keep_claim = False # Set once the file is handled for good (processed, or not an invoice)
 
     # 1. Get File Info & Check Type
     try:
         file_info_response = client.files_info(file=file_id)
         if not file_info_response.get('ok'):
-            logger.error(f"Failed to get file info for {file_id}: {file_info_response.get('error')}")
-            say(text=f"Sorry <@{user_id}>, I couldn't get the details for that file.", channel=channel_id)
+            logger.error("Failed to get file info for %s: %s", file_id, file_info_response.get('error'))
+            say(text=_MSG_NO_FILE_INFO.format(u=user_id), channel=channel_id)
             return
 
         file_info = file_info_response.get('file')
         if not file_info:
-             logger.error(f"File object missing in files.info response for {file_id}")
-             say(text=f"Sorry <@{user_id}>, I couldn't get the file object details.", channel=channel_id)
+             logger.error("File object missing in files.info response for %s", file_id)
+             say(text=_MSG_NO_FILE_OBJECT.format(u=user_id), channel=channel_id)
              return
 
         # Ensure it's a PDF
         if file_info.get('filetype') != 'pdf':
-            logger.info(f"Ignoring non-PDF file: {file_info.get('name')} ({file_info.get('filetype')})")
+            keep_claim = True
+            logger.info("Ignoring non-PDF file: %s (%s)", file_info.get('name'), file_info.get('filetype'))
             # Optionally inform the user, but might be noisy if many files are shared.
             # say(text=f"<@{user_id}>, I can only process PDF invoices.", channel=channel_id)
             return
 
         file_name = file_info.get('name', 'unknown_invoice.pdf')
-        logger.info(f"Processing PDF file: {file_name}")
-        say(text=f"Processing invoice `{file_name}` for you <@{user_id}>...", channel=channel_id)
+        logger.info("Processing PDF file: %s", file_name)
+        say(text=_MSG_PROCESSING.format(u=user_id, f=file_name), channel=channel_id)
 
         # 2. Download File Content
         file_content = download_file_from_slack(file_info, client.token)
         if not file_content:
-            say(text=f"Sorry <@{user_id}>, I couldn't download the file `{file_name}`.", channel=channel_id)
+            say(text=_MSG_DOWNLOAD_FAIL.format(u=user_id, f=file_name), channel=channel_id)
             return
 
-        # 3. (Optional but Recommended) Upload to Temp Storage (GCS)
-        gcs_blob_name = None
-        if storage_client and config.TEMP_STORAGE_BUCKET_NAME:
+        # 3. (Optional) Keep a copy in Temp Storage (GCS) for audit/retry
+        # OCR reads the in-memory bytes, so the copy is opt-in and uploaded in the background
+        settings = config.get_settings()
+        if settings.KEEP_INVOICE_COPY and settings.TEMP_STORAGE_BUCKET_NAME and _gcs():
             # Create a unique blob name, e.g., using file_id or timestamp
+            gcs_bucket_name = settings.TEMP_STORAGE_BUCKET_NAME
             gcs_blob_name = f"invoices/{user_id}/{file_id}-{file_name}"
-            gcs_uri = upload_to_gcs(config.TEMP_STORAGE_BUCKET_NAME, file_content, gcs_blob_name)
-            if not gcs_uri:
-                say(text=f"Sorry <@{user_id}>, I encountered an issue storing the file temporarily.", channel=channel_id)
-                # Decide whether to proceed without GCS or stop
-                return # Stop processing if GCS upload fails
+            gcs_upload = _gcs_executor.submit(upload_to_gcs, gcs_bucket_name, file_content, gcs_blob_name)
 
         # 4. OCR Extraction
+        ocr_service = _ocr()
         if not ocr_service:
             logger.critical("OCR Service is not available. Cannot process file.")
-            say(text=f"Sorry <@{user_id}>, the OCR service isn't configured correctly. Please contact an admin.", channel=channel_id)
-            # Clean up GCS file if it was uploaded
-            if gcs_blob_name and config.TEMP_STORAGE_BUCKET_NAME:
-                delete_from_gcs(config.TEMP_STORAGE_BUCKET_NAME, gcs_blob_name)
+            say(text=_MSG_SERVICE_DOWN.format(u=user_id, service="OCR"), channel=channel_id)
             return
 
-        logger.info(f"Starting OCR extraction for '{file_name}'...")
+        logger.info("Starting OCR extraction for '%s'...", file_name)
         extracted_data = ocr_service.extract(file_content, file_name)
         if not extracted_data:
-            logger.error(f"OCR extraction failed for file: {file_name}")
-            say(text=f"Sorry <@{user_id}>, I couldn't extract data from `{file_name}`. The OCR process failed.", channel=channel_id)
-            if gcs_blob_name and config.TEMP_STORAGE_BUCKET_NAME: delete_from_gcs(config.TEMP_STORAGE_BUCKET_NAME, gcs_blob_name)
+            logger.error("OCR extraction failed for file: %s", file_name)
+            say(text=_MSG_OCR_FAIL.format(u=user_id, f=file_name), channel=channel_id)
             return
-        logger.info(f"OCR extraction successful for '{file_name}'. Vendor: {extracted_data.vendor_name}")
+        logger.info("OCR extraction successful for '%s'. Vendor: %s", file_name, extracted_data.vendor_name)
 
         # 5. Categorization
+        categorization_service = _cat()
         if not categorization_service:
             logger.critical("Categorization Service is not available. Cannot process file.")
-            say(text=f"Sorry <@{user_id}>, the categorization service isn't configured correctly. Please contact an admin.", channel=channel_id)
-            if gcs_blob_name and config.TEMP_STORAGE_BUCKET_NAME: delete_from_gcs(config.TEMP_STORAGE_BUCKET_NAME, gcs_blob_name)
+            say(text=_MSG_SERVICE_DOWN.format(u=user_id, service="categorization"), channel=channel_id)
             return
 
-        logger.info(f"Starting categorization for '{file_name}'...")
+        logger.info("Starting categorization for '%s'...", file_name)
         categorized_data = categorization_service.categorize(extracted_data)
         if not categorized_data:
-            logger.error(f"Categorization failed for file: {file_name}")
+            logger.error("Categorization failed for file: %s", file_name)
             # Inform user, maybe include extracted data if helpful?
-            say(text=f"Sorry <@{user_id}>, I couldn't categorize the invoice `{file_name}`.", channel=channel_id)
-            if gcs_blob_name and config.TEMP_STORAGE_BUCKET_NAME: delete_from_gcs(config.TEMP_STORAGE_BUCKET_NAME, gcs_blob_name)
+            say(text=_MSG_CATEGORIZE_FAIL.format(u=user_id, f=file_name), channel=channel_id)
             return
-        logger.info(f"Categorization successful for '{file_name}'. Category: {categorized_data.category}")
+        logger.info("Categorization successful for '%s'. Category: %s", file_name, categorized_data.category)
 
         # 6. Xero Integration
+        xero_service = _xero()
         if not xero_service:
             logger.critical("Xero Service is not available. Cannot create draft expense.")
-            say(text=f"Sorry <@{user_id}>, the Xero service isn't configured correctly. Please contact an admin.", channel=channel_id)
-            if gcs_blob_name and config.TEMP_STORAGE_BUCKET_NAME: delete_from_gcs(config.TEMP_STORAGE_BUCKET_NAME, gcs_blob_name)
+            say(text=_MSG_SERVICE_DOWN.format(u=user_id, service="Xero"), channel=channel_id)
             return
 
-        logger.info(f"Creating draft expense in Xero for '{file_name}'...")
+        logger.info("Creating draft expense in Xero for '%s'...", file_name)
         bill_id = xero_service.create_draft_expense(categorized_data, file_content, file_name)
         if not bill_id:
-            logger.error(f"Failed to create draft expense in Xero for file: {file_name}")
-            say(text=f"Sorry <@{user_id}>, I couldn't create the draft expense in Xero for `{file_name}`.", channel=channel_id)
-            if gcs_blob_name and config.TEMP_STORAGE_BUCKET_NAME: delete_from_gcs(config.TEMP_STORAGE_BUCKET_NAME, gcs_blob_name)
+            logger.error("Failed to create draft expense in Xero for file: %s", file_name)
+            say(text=_MSG_XERO_FAIL.format(u=user_id, f=file_name), channel=channel_id)
             return
 
-        logger.info(f"Successfully created draft bill in Xero (ID: {bill_id}) for file: {file_name}")
-
-        # 7. Report Success
-        # Construct a success message, potentially with a link to the draft bill if possible
-        # Basic success message:
-        success_message = (
-            f"Success! :tada: I've processed `{file_name}` for you <@{user_id}>.\n"
-            f"- Vendor: `{categorized_data.vendor_name}`\n"
-            f"- Amount: `{categorized_data.total_amount}` {categorized_data.currency or ''}\n"
-            f"- Category: `{categorized_data.category}`\n"
-            f"- A draft bill has been created in Xero (ID: `{bill_id}`). Please review and approve it."
-        )
-        say(text=success_message, channel=channel_id)
-
-        # 8. Clean up temporary file from GCS
-        if gcs_blob_name and config.TEMP_STORAGE_BUCKET_NAME:
-            delete_from_gcs(config.TEMP_STORAGE_BUCKET_NAME, gcs_blob_name)
+        logger.info("Successfully created draft bill in Xero (ID: %s) for file: %s", bill_id, file_name)
+        keep_claim = True
+
+        # 7. Report Success, overlapping the GCS delete with the Slack reply
+        if gcs_blob_name:
+            gcs_delete = _gcs_executor.submit(delete_from_gcs, gcs_bucket_name, gcs_blob_name, after=gcs_upload)
+        say(text=_MSG_SUCCESS.format(
+            u=user_id,
+            f=file_name,
+            vendor=categorized_data.vendor_name,
+            amount=categorized_data.total_amount,
+            currency=categorized_data.currency or '',
+            category=categorized_data.category,
+            bill_id=bill_id,
+        ), channel=channel_id)
 
     except Exception as e:
-        logger.error(f"An unexpected error occurred in handle_file_shared for file_id {file_id}: {e}", exc_info=True)
+        logger.error("An unexpected error occurred in handle_file_shared for file_id %s: %s", file_id, e, exc_info=True)
         try:
             # Try to notify the user about the unexpected error
-            say(text=f"Sorry <@{user_id}>, an unexpected error occurred while processing `{file_info.get('name', 'the file')}`. Please check the logs or contact an admin.", channel=channel_id)
+            say(text=_MSG_UNEXPECTED.format(u=user_id, f=file_name), channel=channel_id)
         except Exception as slack_err:
-            logger.error(f"Failed to send error message to Slack: {slack_err}", exc_info=True)
-        # Attempt cleanup if possible
-        if 'gcs_blob_name' in locals() and gcs_blob_name and config.TEMP_STORAGE_BUCKET_NAME:
-             delete_from_gcs(config.TEMP_STORAGE_BUCKET_NAME, gcs_blob_name)
+            logger.error("Failed to send error message to Slack: %s", slack_err, exc_info=True)
+
+    finally:
+        if not keep_claim:
+            _release_seen(file_id)
+        # 8. Clean up the temporary GCS copy on every exit path. Wait for it before returning:
+        # GCF may throttle the instance once the handler exits.
+        if gcs_delete is not None:
+            gcs_delete.result()
+        elif gcs_blob_name:
+            delete_from_gcs(gcs_bucket_name, gcs_blob_name, after=gcs_upload)
 
 
 # --- Google Cloud Functions Entrypoint ---
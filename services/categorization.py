@@ -2,18 +2,166 @@
 Service responsible for categorizing invoices based on extracted data.
 """
 
+import asyncio
+import hashlib
+import io
 import logging
-from typing import Optional, Literal
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Awaitable, Callable, Dict, Optional, Literal, List, Sequence, Tuple
 import json
 
-from pydantic import BaseModel, ValidationError
+from pydantic import BaseModel, TypeAdapter, ValidationError
+import httpx
 import openai
 
-from .ocr import ExtractedInvoiceData
+from .ocr import ExtractedInvoiceData, LineItem
 from config import settings
 
 logger = logging.getLogger(__name__)
 
+# Completed top-level values in a partially streamed reply (see InvoiceCategorizer._early_result)
+_STREAMED_STATUS_RE = re.compile(r'"status"\s*:\s*"(matched|not_matched|error)"')
+_STREAMED_CATEGORY_RE = re.compile(r'"assigned_category"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+# Output caps for one categorization reply (see _chat_request_body)
+CATEGORIZATION_MAX_TOKENS = 200
+CATEGORIZATION_STOP = ["```", "\n\n\n"]
+# Per-invoice share of max_tokens in a multi-invoice reply (entries also carry an id)
+CATEGORIZATION_GROUP_TOKENS_PER_INVOICE = 120
+
+# CATEGORIZATION_SERVICE values served by the OpenAI path ("openai" is the config default)
+_OPENAI_PROVIDERS = frozenset({"openai", "openaicategorizer"})
+
+# --- Result cache ---
+# Repeat invoices (same vendor, same line-item descriptions, similar total) categorize identically,
+# so successful LLM results are memoized process-wide by a fingerprint of those features. Keys are
+# namespaced by model/categories/context so a settings change never serves stale answers. Error
+# results are not cached so transient failures can retry.
+RESULT_CACHE_SIZE = 10_000
+_result_cache: "OrderedDict[str, CategorizationResult]" = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+# --- Shared OpenAI clients ---
+# Each OpenAI client owns an httpx connection pool; sharing one per API key across every categorizer
+# instance keeps TCP/TLS connections warm instead of fragmenting them per instance
+_OPENAI_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+_openai_clients: Dict[str, openai.OpenAI] = {}
+_async_openai_clients: Dict[str, openai.AsyncOpenAI] = {}
+_openai_clients_lock = threading.Lock()
+
+
+def get_openai_client(api_key: str) -> openai.OpenAI:
+    """Returns the process-wide OpenAI client for api_key, creating it on first use."""
+    client = _openai_clients.get(api_key)
+    if client is None:
+        with _openai_clients_lock:
+            client = _openai_clients.get(api_key)
+            if client is None:
+                # max_retries=0: create_with_backoff below owns the retry policy
+                client = openai.OpenAI(api_key=api_key, max_retries=0,
+                                       http_client=openai.DefaultHttpxClient(limits=_OPENAI_HTTP_LIMITS))
+                _openai_clients[api_key] = client
+    return client
+
+
+def get_async_openai_client(api_key: str) -> openai.AsyncOpenAI:
+    """Async twin of get_openai_client. Its pool binds to the event loop that first uses it (the app's only loop)."""
+    client = _async_openai_clients.get(api_key)
+    if client is None:
+        with _openai_clients_lock:
+            client = _async_openai_clients.get(api_key)
+            if client is None:
+                client = openai.AsyncOpenAI(api_key=api_key, max_retries=0,
+                                            http_client=openai.DefaultAsyncHttpxClient(limits=_OPENAI_HTTP_LIMITS))
+                _async_openai_clients[api_key] = client
+    return client
+
+
+# --- Retry helpers ---
+# Statuses worth retrying: timeouts, rate limits and transient server-side failures
+_RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0 # Seconds; doubles per attempt
+RETRY_MAX_DELAY = 30.0 # Cap on any single wait, including server-sent retry-after
+
+
+def _retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """Seconds to wait before retrying after `error`, or None if the error isn't transient."""
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code not in _RETRYABLE_STATUS_CODES:
+            return None
+        retry_after = error.response.headers.get("retry-after") if error.response is not None else None
+        if retry_after:
+            try:
+                return min(RETRY_MAX_DELAY, max(0.0, float(retry_after)))
+            except ValueError:
+                pass # HTTP-date form; fall back to our own backoff
+    elif not isinstance(error, openai.APIConnectionError): # Includes APITimeoutError
+        return None
+    # "Full jitter": spreads retries from concurrent callers instead of having them stampede together
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def create_with_backoff(create: Callable[..., Any], **request) -> Any:
+    """Calls create(**request), retrying rate-limit/transient OpenAI errors with jittered exponential backoff.
+
+    Gives up after RETRY_MAX_ATTEMPTS attempts and re-raises the last error; other errors are raised immediately.
+    """
+    for attempt in range(RETRY_MAX_ATTEMPTS):
+        try:
+            return create(**request)
+        except openai.OpenAIError as e:
+            delay = _retry_delay(e, attempt)
+            if delay is None or attempt == RETRY_MAX_ATTEMPTS - 1:
+                raise
+            logger.warning("OpenAI request failed (%s); retrying in %.1fs (attempt %s/%s).", e, delay, attempt + 1, RETRY_MAX_ATTEMPTS)
+            time.sleep(delay)
+
+
+async def acreate_with_backoff(create: Callable[..., Awaitable[Any]], **request) -> Any:
+    """Async twin of create_with_backoff (sleeps without blocking the event loop)."""
+    for attempt in range(RETRY_MAX_ATTEMPTS):
+        try:
+            return await create(**request)
+        except openai.OpenAIError as e:
+            delay = _retry_delay(e, attempt)
+            if delay is None or attempt == RETRY_MAX_ATTEMPTS - 1:
+                raise
+            logger.warning("OpenAI request failed (%s); retrying in %.1fs (attempt %s/%s).", e, delay, attempt + 1, RETRY_MAX_ATTEMPTS)
+            await asyncio.sleep(delay)
+
+
+def compact_line_items(items: Optional[Sequence[LineItem]], max_items: int = 10, desc_chars: int = 80) -> List[str]:
+    """Condenses line items into at most max_items short "description (amount)" strings for prompts.
+
+    Items without a description or with a zero amount are dropped, descriptions are truncated,
+    duplicates are merged (amounts summed) and only the largest by absolute amount are kept;
+    whatever is cut is summarized by a trailing "... +M more" entry. Quantity and unit price carry
+    little signal for picking an expense category, so they are left out.
+    """
+    merged: Dict[str, Optional[float]] = {}
+    for item in items or []:
+        description = (item.description or "").strip()[:desc_chars]
+        if not description or item.amount == 0:
+            continue
+        if description in merged and merged[description] is not None:
+            merged[description] += item.amount or 0
+        else:
+            merged[description] = item.amount
+
+    ranked = sorted(merged.items(), key=lambda entry: abs(entry[1] or 0), reverse=True)
+    compact = [description if amount is None else f"{description} ({round(amount, 2)})"
+               for description, amount in ranked[:max_items]]
+    if len(ranked) > max_items:
+        compact.append(f"... +{len(ranked) - max_items} more")
+    return compact
+
 
 class CategorizationResult(BaseModel):
     """Represents the outcome of the LLM categorization process."""
@@ -24,6 +172,10 @@ class CategorizationResult(BaseModel):
     notes: Optional[str] = None # General notes or error details
 
 
+# Built once at import: validates raw LLM JSON straight into CategorizationResult without a json.loads hop
+_RESULT_ADAPTER = TypeAdapter(CategorizationResult)
+
+
 class InvoiceCategorizer:
     """Categorizes invoices using predefined rules or potentially an LLM."""
 
@@ -32,62 +184,123 @@ class InvoiceCategorizer:
         self.logger = logging.getLogger(__name__)
         self.settings = settings
         self.provider = self.settings.CATEGORIZATION_SERVICE
-        self.allowed_categories = self.settings.ALLOWED_CATEGORIES
+        # Tuple keeps prompt rendering stable; the frozenset gives O(1) validation of LLM answers
+        self.allowed_categories_list = tuple(self.settings.ALLOWED_CATEGORIES)
+        self.allowed_categories_set = frozenset(self.allowed_categories_list)
+        # Known vendor -> category rules, checked before (and instead of) any LLM call
+        self._vendor_rules, self._vendor_rule_re = self._compile_vendor_rules(getattr(self.settings, "VENDOR_CATEGORY_RULES", None))
         self.company_context = self.settings.COMPANY_CONTEXT
+        # Single-label classification over a short prompt: a small model is plenty and far cheaper/faster.
+        # Override via CATEGORIZATION_MODEL (e.g. gpt-4o) for very large or ambiguous category lists.
+        self.model = self.settings.CATEGORIZATION_MODEL
+        # Prefix for result-cache keys: anything that changes the answer for the same invoice
+        self._cache_namespace = hashlib.blake2b(
+            "\x1f".join(map(str, (self.model, self.allowed_categories_list, self.company_context))).encode("utf-8"),
+            digest_size=8,
+        ).hexdigest()
         self.client = None # Initialize client to None
+        self.async_client = None # AsyncOpenAI twin of self.client for categorize_async
+        # Cap on in-flight categorize_async calls; the semaphore is created on first use so it
+        # binds to the running event loop rather than whichever loop existed at import time
+        self.max_concurrency = int(getattr(self.settings, "OPENAI_MAX_CONCURRENCY", None) or 32)
+        self._async_sem: Optional[asyncio.Semaphore] = None
+        # Stream replies and stop once a matched category is in; `is True` so an unset/mocked setting stays off
+        self.early_exit = getattr(self.settings, "CATEGORIZATION_EARLY_EXIT", False) is True
+        # Prompt preambles only depend on settings, so render them once rather than per invoice
+        self._system_prompt = self._render_system_prompt()
+        self._multi_invoice_system_prompt = self._render_multi_invoice_system_prompt()
 
         # Check for the correct provider name from settings
-        if not self.provider or self.provider == "openaicategorizer": 
+        self.uses_openai = not self.provider or self.provider in _OPENAI_PROVIDERS
+        if self.uses_openai:
             if not self.settings.OPENAI_API_KEY:
                 logger.error("OpenAI API key is missing. OpenAI categorizer disabled.")
             else:
                 try:
-                    self.client = openai.OpenAI(api_key=self.settings.OPENAI_API_KEY)
+                    self.client = get_openai_client(self.settings.OPENAI_API_KEY)
+                    self.async_client = get_async_openai_client(self.settings.OPENAI_API_KEY)
                     logger.info("OpenAI client initialized for categorization.")
                 except Exception as e:
-                    logger.error(f"Failed to initialize OpenAI client: {e}")
-        elif self.provider == "rules": # Example for future expansion
-            logger.info("Using rule-based categorization (placeholder). ")
-            # Load rules here if implementing rule-based logic
+                    logger.error("Failed to initialize OpenAI client: %s", e)
+        elif self.provider == "rules":
+            # Rules only: vendors without a rule come back as not_matched (see _unavailable_result)
+            logger.info("Using rule-based categorization with %s vendor rule(s).", len(self._vendor_rules))
         else:
-            logger.warning(f"Unsupported categorization provider: {self.provider}. Categorization disabled.")
-
-    def _build_openai_prompt(self, invoice_data: ExtractedInvoiceData) -> str:
-        """Builds the prompt for the OpenAI API call."""
-        invoice_details = f"Vendor: {invoice_data.vendor_name}\n" \
-                          f"Invoice Number: {invoice_data.invoice_number}\n" \
-                          f"Issue Date: {invoice_data.issue_date}\n" \
-                          f"Total Amount: {invoice_data.total_amount}\n"
-        
-        # Add line item details, handling missing optional fields
-        invoice_details += "Line Items:\n"
-        if invoice_data.line_items:
-            for item in invoice_data.line_items:
-                item_desc = f"  - Description: {item.description}"
-                if item.quantity is not None:
-                    item_desc += f", Quantity: {item.quantity}"
-                # Safely access unit_price - check existence/None before using
-                unit_price = getattr(item, 'unit_price', None)
-                if unit_price is not None:
-                    item_desc += f", Unit Price: {unit_price}"
-                if item.amount is not None:
-                    item_desc += f", Amount: {item.amount}"
-                invoice_details += item_desc + "\n"
-        else:
-            invoice_details += "  (No line items extracted)\n"
+            logger.warning("Unsupported categorization provider: %s. Categorization disabled.", self.provider)
+
+    def _compile_vendor_rules(self, rules) -> Tuple[Dict[str, str], Optional[re.Pattern]]:
+        """Normalizes VENDOR_CATEGORY_RULES and compiles all vendor patterns into one regex.
+
+        One alternation regex scans a vendor name for every pattern in a single pass. Patterns are
+        ordered longest first so that e.g. "amazon web services" wins over "amazon", and only match
+        whole words, so "uber" doesn't claim "Huber Consulting". The guards are lookarounds rather
+        than \\b so patterns that start or end with punctuation ("at&t", "(uk)") still match.
+        """
+        if not isinstance(rules, dict):
+            return {}, None
+        vendor_rules: Dict[str, str] = {}
+        for pattern, category in rules.items():
+            if category not in self.allowed_categories_set:
+                logger.warning("Ignoring vendor rule '%s' -> '%s': category is not in ALLOWED_CATEGORIES.", pattern, category)
+                continue
+            normalized = str(pattern).strip().lower()
+            if normalized:
+                vendor_rules[normalized] = category
+        if not vendor_rules:
+            return {}, None
+        alternation = "|".join(re.escape(pattern) for pattern in sorted(vendor_rules, key=len, reverse=True))
+        return vendor_rules, re.compile(rf"(?<!\w)(?:{alternation})(?!\w)")
+
+    def _rule_lookup(self, invoice_data: ExtractedInvoiceData) -> Optional[CategorizationResult]:
+        """Returns a 'matched' result if a vendor rule covers this invoice, else None."""
+        if self._vendor_rule_re is None or not invoice_data.vendor_name:
+            return None
+        match = self._vendor_rule_re.search(invoice_data.vendor_name.lower())
+        if not match:
+            return None
+        category = self._vendor_rules[match.group(0)]
+        logger.info("Vendor rule '%s' matched '%s' -> '%s'; skipping LLM.", match.group(0), invoice_data.vendor_name, category)
+        return CategorizationResult(status='matched', assigned_category=category, notes=f"Matched vendor rule '{match.group(0)}'.")
+
+    def _fingerprint(self, invoice_data: ExtractedInvoiceData) -> str:
+        """Cache key for an invoice: normalized vendor, sorted line-item descriptions and total rounded to tens."""
+        features = json.dumps({
+            "v": (invoice_data.vendor_name or "").strip().lower(),
+            "items": sorted((item.description or "").strip().lower() for item in invoice_data.line_items or []),
+            "amt_bucket": round(float(invoice_data.total_amount or 0), -1),
+        }, sort_keys=True)
+        return hashlib.blake2b(f"{self._cache_namespace}|{features}".encode("utf-8"), digest_size=16).hexdigest()
+
+    @staticmethod
+    def _cache_get(key: str) -> Optional[CategorizationResult]:
+        with _result_cache_lock:
+            cached = _result_cache.get(key)
+            if cached is None:
+                return None
+            _result_cache.move_to_end(key)
+        return cached.model_copy() # Callers may annotate their result; keep the cached one pristine
+
+    @staticmethod
+    def _cache_put(key: str, result: CategorizationResult) -> None:
+        if result.status == "error":
+            return
+        with _result_cache_lock:
+            _result_cache[key] = result.model_copy()
+            _result_cache.move_to_end(key)
+            if len(_result_cache) > RESULT_CACHE_SIZE:
+                _result_cache.popitem(last=False)
 
-        allowed_categories_str = ", ".join(self.allowed_categories)
+    def _render_system_prompt(self) -> str:
+        """Builds the invariant part of the prompt (role, allowed categories, output format) once."""
+        allowed_categories_str = ", ".join(self.allowed_categories_list)
 
-        prompt = f"""\
+        return f"""\
 You are an accounts payable assistant for '{self.company_context}'.
-Your task is to categorize the following invoice data based on the provided list of allowed expense categories.
+Your task is to categorize the invoice data in the user's message based on the provided list of allowed expense categories.
 
 Allowed Expense Categories:
 {allowed_categories_str}
 
-Invoice Data:
-{invoice_details}
-
 Please analyze the invoice data and respond ONLY with a JSON object containing the categorization result. The JSON object must have the following structure:
 {{
   "status": "<status>",                // Required. Must be 'matched', 'not_matched', or 'error'.
@@ -102,84 +315,456 @@ Instructions:
 - If you encounter an error processing the request, set status to 'error' and provide details in notes.
 - Do NOT include any text outside the JSON object in your response.
 """
-        return prompt
 
-    def categorize(self, invoice_data: ExtractedInvoiceData) -> CategorizationResult:
-        """Determines the expense category for the given invoice data using the configured provider."""
-        logger.info(f"Starting categorization for vendor: {invoice_data.vendor_name} using provider: {self.provider}")
+    def _render_invoice_block(self, invoice_data: ExtractedInvoiceData) -> str:
+        """Builds the per-invoice user message."""
+        # Collected as parts and joined once, rather than growing a string with += per line
+        parts = [
+            "Invoice Data:",
+            f"Vendor: {invoice_data.vendor_name}",
+            f"Invoice Number: {invoice_data.invoice_number}",
+            f"Issue Date: {invoice_data.issue_date}",
+            f"Total Amount: {invoice_data.total_amount}",
+            "Line Items:",
+        ]
+        # Large invoices are condensed so prompt size stays flat regardless of line count
+        line_items = compact_line_items(invoice_data.line_items)
+        if line_items:
+            parts.extend(f"  - {line}" for line in line_items)
+        else:
+            parts.append("  (No line items extracted)")
+        parts.append("") # Trailing newline, as before
+        return "\n".join(parts)
 
+    def _chat_request_body(self, invoice_data: ExtractedInvoiceData) -> dict:
+        """Returns the chat.completions.create arguments for one invoice (shared by sync and batch calls)."""
+        return {
+            "model": self.model,
+            # The system prompt is identical on every call, which also makes it eligible for OpenAI's prompt caching
+            "messages": [
+                {"role": "system", "content": self._system_prompt},
+                {"role": "user", "content": self._render_invoice_block(invoice_data)},
+            ],
+            "temperature": 0.2, # Lower temperature for more deterministic results
+            "response_format": {"type": "json_object"}, # API guarantees a JSON object, no fence stripping needed
+            # Hard bound on generation: the JSON object plus short notes fits well inside this,
+            # so a rambling "notes" field can't stretch latency/cost (a truncated reply surfaces as 'error')
+            "max_tokens": CATEGORIZATION_MAX_TOKENS,
+            "stop": CATEGORIZATION_STOP,
+        }
+
+    def _unavailable_result(self) -> Optional[CategorizationResult]:
+        """Returns an error result if the OpenAI provider isn't usable, else None."""
+        if self.provider == "rules":
+            # Only reached after _rule_lookup missed
+            return CategorizationResult(status='not_matched', notes="No vendor rule matched.")
         # Check for the correct provider name and ensure client is initialized
-        if self.provider != "openaicategorizer" or not self.client:
-            logger.warning(f"Categorization skipped: Provider is '{self.provider}' or client not initialized.")
+        if not self.uses_openai or not self.client:
+            logger.warning("Categorization skipped: Provider is '%s' or client not initialized.", self.provider)
             return CategorizationResult(status='error', notes=f"Categorization provider '{self.provider}' not supported or not initialized.")
+        return None
 
-        prompt = self._build_openai_prompt(invoice_data)
+    def _parse_llm_response(self, response_content: Optional[str]) -> CategorizationResult:
+        """Parses and validates one raw LLM reply into a CategorizationResult."""
+        logger.debug("Received raw response from OpenAI: %s", response_content)
 
+        if not response_content:
+             logger.error("OpenAI returned an empty response.")
+             return CategorizationResult(status='error', notes="LLM returned empty response.")
+        
+        # pydantic-core parses and validates the raw string in one pass, with no intermediate dict.
+        # JSON mode means this normally succeeds; the json_invalid branch stays for truncated (max-token) replies
         try:
-            logger.debug(f"Sending prompt to OpenAI: {prompt}")
-            # Consider using gpt-3.5-turbo for cost/speed if sufficient
-            # Use response_format for guaranteed JSON if using compatible models (e.g., gpt-4-turbo-preview)
-            completion = self.client.chat.completions.create(
-                model="gpt-4o", # Or another suitable model like gpt-4-turbo
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.2, # Lower temperature for more deterministic results
-                # response_format={ "type": "json_object" } # Enable if model supports it
-            )
+            result = _RESULT_ADAPTER.validate_json(response_content)
+        except ValidationError as e:
+            if any(error["type"] == "json_invalid" for error in e.errors()):
+                logger.error("Failed to decode JSON response from OpenAI: %s", e)
+                logger.debug("Non-JSON response content: %s", response_content)
+                return CategorizationResult(status='error', notes=f"LLM response was not valid JSON: {response_content[:100]}...")
+            logger.error("LLM response failed Pydantic validation: %s", e)
+            logger.debug("Invalid JSON structure received: %s", response_content)
+            return CategorizationResult(status='error', notes=f"LLM response structure invalid: {e}")
 
-            response_content = completion.choices[0].message.content
-            logger.debug(f"Received raw response from OpenAI: {response_content}")
+        return self._checked_result(result)
 
-            if not response_content:
-                 logger.error("OpenAI returned an empty response.")
-                 return CategorizationResult(status='error', notes="LLM returned empty response.")
-            
-            # Attempt to parse the JSON (LLM might sometimes add extra text/markdown)
-            try:
-                # Basic cleanup: strip leading/trailing whitespace and potential markdown code fences
-                response_content = response_content.strip()
-                if response_content.startswith("```json"):
-                    response_content = response_content[7:]
-                if response_content.endswith("```"):
-                    response_content = response_content[:-3]
-                response_content = response_content.strip()
-
-                parsed_json = json.loads(response_content)
-            except json.JSONDecodeError as json_e:
-                logger.error(f"Failed to decode JSON response from OpenAI: {json_e}")
-                logger.debug(f"Non-JSON response content: {response_content}")
-                return CategorizationResult(status='error', notes=f"LLM response was not valid JSON: {response_content[:100]}...")
+    def _result_from_json(self, parsed_json) -> CategorizationResult:
+        """Validates one already-decoded LLM result object (e.g. an entry of a multi-invoice reply)."""
+        try:
+            result = _RESULT_ADAPTER.validate_python(parsed_json)
+        except ValidationError as e:
+            logger.error("LLM response failed Pydantic validation: %s", e)
+            logger.debug("Invalid JSON structure received: %s", parsed_json)
+            return CategorizationResult(status='error', notes=f"LLM response structure invalid: {e}")
 
-            # Validate the parsed JSON against our Pydantic model
-            try:
-                result = CategorizationResult.model_validate(parsed_json)
-                logger.info(f"Successfully parsed and validated LLM response: Status='{result.status}', Category='{result.assigned_category}'")
-
-                # Additional check: If matched, ensure category is allowed
-                if result.status == 'matched':
-                    if result.assigned_category not in self.allowed_categories:
-                        logger.warning(f"LLM assigned category '{result.assigned_category}' which is not in the allowed list: {self.allowed_categories}. Treating as 'not_matched'.")
-                        result.notes = f"LLM suggested invalid category '{result.assigned_category}'. Original Notes: {result.notes}"
-                        result.assigned_category = None
-                        result.status = 'not_matched'
-                        # Optionally try to capture the bad category as a suggestion?
-                        # result.suggested_new_category = result.assigned_category 
-                        
-                return result
-                
-            except ValidationError as e:
-                logger.error(f"LLM response failed Pydantic validation: {e}")
-                logger.debug(f"Invalid JSON structure received: {parsed_json}")
-                return CategorizationResult(status='error', notes=f"LLM response structure invalid: {e}")
+        return self._checked_result(result)
+
+    def _checked_result(self, result: CategorizationResult) -> CategorizationResult:
+        """Demotes a 'matched' result whose category is outside the allowed list to 'not_matched'."""
+        logger.info("Successfully parsed and validated LLM response: Status='%s', Category='%s'", result.status, result.assigned_category)
+
+        # Additional check: If matched, ensure category is allowed
+        if result.status == 'matched':
+            if result.assigned_category not in self.allowed_categories_set:
+                logger.warning("LLM assigned category '%s' which is not in the allowed list: %s. Treating as 'not_matched'.", result.assigned_category, self.allowed_categories_list)
+                result.notes = f"LLM suggested invalid category '{result.assigned_category}'. Original Notes: {result.notes}"
+                result.assigned_category = None
+                result.status = 'not_matched'
+                # Optionally try to capture the bad category as a suggestion?
+                # result.suggested_new_category = result.assigned_category 
+
+        return result
+
+    def _early_result(self, partial_content: str) -> Optional[CategorizationResult]:
+        """Returns a result once a streamed reply holds a 'matched' status and its category, else None.
+
+        Only matched replies short-circuit; for not_matched/error the suggestion and notes are what
+        the user needs, so those are read to the end.
+        """
+        status = _STREAMED_STATUS_RE.search(partial_content)
+        if not status or status.group(1) != 'matched':
+            return None
+        category = _STREAMED_CATEGORY_RE.search(partial_content)
+        if not category:
+            return None
+        try:
+            assigned_category = json.loads(f'"{category.group(1)}"') # Undo JSON string escapes
+        except json.JSONDecodeError:
+            return None # Let the full parse deal with it
+        logger.debug("Stream short-circuited after category '%s'.", assigned_category)
+        return self._result_from_json({"status": "matched", "assigned_category": assigned_category})
+
+    def _stream_llm_response(self, request_body: dict) -> CategorizationResult:
+        """Streams one completion, closing it as soon as _early_result has an answer."""
+        stream = create_with_backoff(self.client.chat.completions.create, **request_body, stream=True)
+        content = ""
+        try:
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                content += delta
+                early = self._early_result(content)
+                if early:
+                    return early
+        finally:
+            stream.close() # Drops the connection mid-generation on early exit, so the rest isn't generated/billed
+        return self._parse_llm_response(content)
+
+    async def _stream_llm_response_async(self, request_body: dict) -> CategorizationResult:
+        """Async twin of _stream_llm_response."""
+        stream = await acreate_with_backoff(self.async_client.chat.completions.create, **request_body, stream=True)
+        content = ""
+        try:
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                content += delta
+                early = self._early_result(content)
+                if early:
+                    return early
+        finally:
+            await stream.close()
+        return self._parse_llm_response(content)
+
+    def categorize(self, invoice_data: ExtractedInvoiceData) -> CategorizationResult:
+        """Determines the expense category for the given invoice data using the configured provider."""
+        logger.info("Starting categorization for vendor: %s using provider: %s", invoice_data.vendor_name, self.provider)
+
+        rule_result = self._rule_lookup(invoice_data)
+        if rule_result:
+            return rule_result
+        unavailable = self._unavailable_result()
+        if unavailable:
+            return unavailable
+        cache_key = self._fingerprint(invoice_data)
+        cached = self._cache_get(cache_key)
+        if cached:
+            logger.info("Categorization cache hit for vendor %s", invoice_data.vendor_name)
+            return cached
+
+        request_body = self._chat_request_body(invoice_data)
+
+        try:
+            logger.debug("Sending prompt to OpenAI: %s", request_body["messages"])
+            if self.early_exit:
+                result = self._stream_llm_response(request_body)
+            else:
+                completion = create_with_backoff(self.client.chat.completions.create, **request_body)
+                result = self._parse_llm_response(completion.choices[0].message.content)
+            self._cache_put(cache_key, result)
+            return result
 
         except openai.APIError as e:
-            logger.error(f"OpenAI API returned an API Error: {e}")
+            logger.error("OpenAI API returned an API Error: %s", e)
             return CategorizationResult(status='error', notes=f"OpenAI API Error: {e}")
         except openai.APIConnectionError as e:
-            logger.error(f"Failed to connect to OpenAI API: {e}")
+            logger.error("Failed to connect to OpenAI API: %s", e)
             return CategorizationResult(status='error', notes=f"OpenAI Connection Error: {e}")
         except openai.RateLimitError as e:
-            logger.error(f"OpenAI API request exceeded rate limit: {e}")
+            logger.error("OpenAI API request exceeded rate limit: %s", e)
             return CategorizationResult(status='error', notes=f"OpenAI Rate Limit Error: {e}")
         except Exception as e:
-            logger.exception(f"An unexpected error occurred during categorization: {e}") # Use logger.exception to include traceback
+            logger.exception("An unexpected error occurred during categorization: %s", e) # Use logger.exception to include traceback
             return CategorizationResult(status='error', notes=f"Unexpected error: {e}")
+
+    async def categorize_async(self, invoice_data: ExtractedInvoiceData) -> CategorizationResult:
+        """Async variant of categorize(): awaits the OpenAI call instead of blocking a thread.
+
+        At most max_concurrency calls are in flight at once across the process.
+        """
+        logger.info("Starting async categorization for vendor: %s using provider: %s", invoice_data.vendor_name, self.provider)
+
+        rule_result = self._rule_lookup(invoice_data)
+        if rule_result:
+            return rule_result
+        unavailable = self._unavailable_result()
+        if unavailable:
+            return unavailable
+        if self.async_client is None:
+            # Client injected/mocked without an async twin; fall back to the blocking path off-loop
+            return await asyncio.to_thread(self.categorize, invoice_data)
+        cache_key = self._fingerprint(invoice_data)
+        cached = self._cache_get(cache_key)
+        if cached:
+            logger.info("Categorization cache hit for vendor %s", invoice_data.vendor_name)
+            return cached
+        if self._async_sem is None:
+            self._async_sem = asyncio.Semaphore(self.max_concurrency)
+
+        request_body = self._chat_request_body(invoice_data)
+
+        try:
+            async with self._async_sem:
+                if self.early_exit:
+                    result = await self._stream_llm_response_async(request_body)
+                else:
+                    completion = await acreate_with_backoff(self.async_client.chat.completions.create, **request_body)
+                    result = self._parse_llm_response(completion.choices[0].message.content)
+            self._cache_put(cache_key, result)
+            return result
+
+        except openai.APIError as e:
+            logger.error("OpenAI API returned an API Error: %s", e)
+            return CategorizationResult(status='error', notes=f"OpenAI API Error: {e}")
+        except Exception as e:
+            logger.exception("An unexpected error occurred during categorization: %s", e)
+            return CategorizationResult(status='error', notes=f"Unexpected error: {e}")
+
+    async def categorize_many_async(self, invoices: Sequence[ExtractedInvoiceData]) -> List[CategorizationResult]:
+        """Categorizes invoices concurrently (bounded by max_concurrency); results are in input order."""
+        return list(await asyncio.gather(*(self.categorize_async(invoice_data) for invoice_data in invoices)))
+
+    def categorize_many_threaded(self, invoices: Sequence[ExtractedInvoiceData], max_workers: int = 16) -> List[CategorizationResult]:
+        """Categorizes invoices with blocking categorize() calls spread over a thread pool.
+
+        For synchronous callers (scripts, main.py-style handlers) that can't use categorize_many_async:
+        the OpenAI call is network-bound and releases the GIL, so threads overlap the round-trips,
+        all sharing the process-wide client's connection pool. Results are in input order.
+        """
+        if not invoices:
+            return []
+        results: List[Optional[CategorizationResult]] = [None] * len(invoices)
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(invoices)), thread_name_prefix="categorize") as pool:
+            futures = {pool.submit(self.categorize, invoice_data): index for index, invoice_data in enumerate(invoices)}
+            for future in as_completed(futures):
+                # categorize() turns its own failures into 'error' results, so this doesn't raise in practice
+                results[futures[future]] = future.result()
+        return results
+
+    @staticmethod
+    def _invoice_payload(invoice_data: ExtractedInvoiceData) -> dict:
+        """Compact JSON-able view of the fields the categorization prompt uses."""
+        return {
+            "vendor": invoice_data.vendor_name,
+            "invoice_number": invoice_data.invoice_number,
+            "issue_date": invoice_data.issue_date,
+            "total_amount": invoice_data.total_amount,
+            "line_items": compact_line_items(invoice_data.line_items),
+        }
+
+    def _render_multi_invoice_system_prompt(self) -> str:
+        """System prompt for categorizing several invoices in one request."""
+        allowed_categories_str = ", ".join(self.allowed_categories_list)
+        return f"""\
+You are an accounts payable assistant for '{self.company_context}'.
+Your task is to categorize each invoice in the user's JSON message based on the provided list of allowed expense categories.
+
+Allowed Expense Categories:
+{allowed_categories_str}
+
+The user message is a JSON object {{"invoices": [{{"id": ..., "vendor": ..., "line_items": [...], ...}}, ...]}}.
+Respond ONLY with a JSON object of the form {{"results": [...]}} containing exactly one entry per invoice:
+{{
+  "id": "<id>",                       // Required. The id of the invoice this result is for.
+  "status": "<status>",                // Required. Must be 'matched', 'not_matched', or 'error'.
+  "assigned_category": "<category>",    // Required if status is 'matched', otherwise null. Must be EXACTLY one of the allowed categories listed above.
+  "suggested_new_category": "<text>", // Optional. Suggest a new category if status is 'not_matched' and you have a suggestion, otherwise null.
+  "notes": "<text>"                   // Optional. Add brief notes or explanation for the categorization or error.
+}}
+
+Instructions:
+- If an invoice clearly matches one of the allowed categories, set status to 'matched' and assigned_category to the EXACT category name.
+- If an invoice does not clearly match any allowed category, set status to 'not_matched' and assigned_category to null. You may suggest a new category in suggested_new_category if appropriate.
+- Categorize every invoice independently.
+"""
+
+    def categorize_batch_in_one_call(self, invoices: Sequence[ExtractedInvoiceData], k: int = 20) -> List[CategorizationResult]:
+        """Categorizes invoices k at a time, sending each group in a single chat completion.
+
+        The instructions, category list and company context are sent once per group instead of once
+        per invoice, cutting prompt tokens and round-trips roughly k-fold. Returns one result per
+        input invoice, in order; invoices the model leaves out come back as 'error'. Invoices covered
+        by a vendor rule are answered locally and never sent.
+        """
+        results: List[Optional[CategorizationResult]] = [self._rule_lookup(invoice_data) for invoice_data in invoices]
+        pending = [index for index, result in enumerate(results) if result is None]
+        if not pending:
+            return results
+        unavailable = self._unavailable_result()
+        if unavailable:
+            for index in pending:
+                results[index] = unavailable.model_copy()
+            return results
+
+        for start in range(0, len(pending), k):
+            group = pending[start:start + k]
+            for index, result in zip(group, self._categorize_group([invoices[i] for i in group])):
+                results[index] = result
+        return results
+
+    def _categorize_group(self, group: Sequence[ExtractedInvoiceData]) -> List[CategorizationResult]:
+        """One chat completion for up to k invoices; see categorize_batch_in_one_call."""
+        user_message = json.dumps({
+            "invoices": [{"id": str(index), **self._invoice_payload(invoice_data)} for index, invoice_data in enumerate(group)]
+        })
+        try:
+            completion = create_with_backoff(
+                self.client.chat.completions.create,
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": self._multi_invoice_system_prompt},
+                    {"role": "user", "content": user_message},
+                ],
+                temperature=0.2,
+                response_format={"type": "json_object"},
+                max_tokens=CATEGORIZATION_GROUP_TOKENS_PER_INVOICE * len(group) + 50, # + the {"results": [...]} wrapper
+                stop=CATEGORIZATION_STOP,
+            )
+            entries = json.loads(completion.choices[0].message.content or "{}").get("results")
+        except (openai.OpenAIError, json.JSONDecodeError, AttributeError) as e:
+            logger.error("Multi-invoice categorization request failed: %s", e)
+            return [CategorizationResult(status='error', notes=f"Batched categorization failed: {e}") for _ in group]
+
+        by_id = {str(entry.get("id")): entry for entry in entries or [] if isinstance(entry, dict)}
+        results = []
+        for index in range(len(group)):
+            entry = by_id.get(str(index))
+            if entry is None:
+                results.append(CategorizationResult(status='error', notes="Invoice missing from batched LLM response."))
+                continue
+            results.append(self._result_from_json({key: value for key, value in entry.items() if key != "id"}))
+        return results
+
+    def categorize_many(
+        self,
+        invoices: Sequence[ExtractedInvoiceData],
+        poll_interval: float = 5.0,
+        max_poll_interval: float = 60.0,
+        timeout: float = 24 * 60 * 60,
+    ) -> List[CategorizationResult]:
+        """Categorizes many invoices with one OpenAI Batch API job.
+
+        Batch jobs are billed at roughly half the per-token price and draw on a separate rate-limit
+        pool, but complete asynchronously (up to 24h), so this is meant for backfills and bulk runs,
+        not the interactive Slack flow. Blocks until the job finishes, polling with exponential
+        backoff. Returns one result per input invoice, in order. Invoices covered by a vendor rule
+        or the result cache are answered locally and left out of the job; the job's results are
+        cached like categorize()'s.
+        """
+        if not invoices:
+            return []
+        local_results = [self._rule_lookup(invoice_data) for invoice_data in invoices]
+        pending = [index for index, result in enumerate(local_results) if result is None]
+        if not pending:
+            return local_results
+        unavailable = self._unavailable_result()
+        if unavailable:
+            return [result or unavailable.model_copy() for result in local_results]
+        cache_keys = {index: self._fingerprint(invoices[index]) for index in pending}
+        for index in pending:
+            local_results[index] = self._cache_get(cache_keys[index])
+        pending = [index for index in pending if local_results[index] is None]
+        if not pending:
+            return local_results
+
+        def _all_failed(notes: str) -> List[CategorizationResult]:
+            # Rule and cache hits stand; only the invoices sent to the batch get the failure
+            return [result or CategorizationResult(status='error', notes=notes) for result in local_results]
+
+        # One JSONL request per pending invoice; custom_id is the input index so results map back in order
+        batch_input = "\n".join(
+            json.dumps({
+                "custom_id": str(index),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": self._chat_request_body(invoices[index]),
+            })
+            for index in pending
+        ).encode("utf-8")
+
+        try:
+            input_file = create_with_backoff(self.client.files.create, file=("categorization_batch.jsonl", io.BytesIO(batch_input)), purpose="batch")
+            batch = create_with_backoff(self.client.batches.create, input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+            logger.info("Submitted categorization batch %s for %s invoices.", batch.id, len(pending))
+
+            deadline = time.monotonic() + timeout
+            delay = poll_interval
+            while batch.status not in ("completed", "failed", "expired", "cancelled"):
+                if time.monotonic() >= deadline:
+                    logger.error("Categorization batch %s did not finish within %ss (status: %s); cancelling it.", batch.id, timeout, batch.status)
+                    try:
+                        self.client.batches.cancel(batch.id) # Don't leave an orphaned job running (and billed)
+                    except openai.OpenAIError as e:
+                        logger.error("Could not cancel categorization batch %s: %s", batch.id, e)
+                    return _all_failed(f"Batch {batch.id} timed out (status: {batch.status}).")
+                time.sleep(delay)
+                delay = min(delay * 2, max_poll_interval)
+                batch = create_with_backoff(self.client.batches.retrieve, batch_id=batch.id)
+
+            if batch.status != "completed" or not batch.output_file_id:
+                logger.error("Categorization batch %s ended with status '%s'.", batch.id, batch.status)
+                return _all_failed(f"Batch {batch.id} ended with status '{batch.status}'.")
+
+            output = create_with_backoff(self.client.files.content, file_id=batch.output_file_id).text
+        except openai.OpenAIError as e:
+            logger.error("OpenAI Batch API error during categorization: %s", e)
+            return _all_failed(f"OpenAI Batch API Error: {e}")
+
+        results = _all_failed("No result returned for this invoice in the batch.")
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            # One bad line only costs its own invoice; the rest of the batch's results still count
+            try:
+                record = json.loads(line)
+                index = int(record["custom_id"])
+                if index not in cache_keys or local_results[index] is not None:
+                    raise ValueError(f"unexpected custom_id {record['custom_id']!r}")
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error("Skipping unreadable line in categorization batch %s output: %s", batch.id, e)
+                continue
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                logger.error("Batch request %s failed: %s", record["custom_id"], record.get("error") or response.get("body"))
+                results[index] = CategorizationResult(status='error', notes=f"Batch request failed: {record.get('error') or response.get('status_code')}")
+                continue
+            try:
+                content = response["body"]["choices"][0]["message"]["content"]
+            except (KeyError, IndexError, TypeError) as e:
+                logger.error("Batch request %s returned an unexpected body: %s", record["custom_id"], e)
+                results[index] = CategorizationResult(status='error', notes="Batch request returned an unexpected response body.")
+                continue
+            results[index] = self._parse_llm_response(content)
+            self._cache_put(cache_keys[index], results[index])
+        return results
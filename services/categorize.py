@@ -1,5 +1,6 @@
 import logging
 import json
+import threading
 from abc import ABC, abstractmethod
 from typing import Optional, Dict, Any
 from pydantic import BaseModel, ValidationError
@@ -10,7 +11,7 @@ import openai # Ensure openai is imported
 
 # Import the OCR data model and config
 from services.ocr import ExtractedInvoiceData
-import config
+from services.categorization import compact_line_items, create_with_backoff, get_openai_client # Shared prompt formatter, retry policy and client
 
 logger = logging.getLogger(__name__)
 
@@ -59,17 +60,17 @@ class OpenAICategorizer(CategorizationService):
 
         self.api_key = api_key
         try:
-            # Initialize the OpenAI client with the resolved API key
-            self.client = openai.OpenAI(api_key=self.api_key)
+            # Process-wide client for this key, so instances share one connection pool
+            self.client = get_openai_client(self.api_key)
             self.logger.info("OpenAI client initialized successfully.")
         except Exception as e:
-            self.logger.error(f"Failed to initialize OpenAI client: {e}")
+            self.logger.error("Failed to initialize OpenAI client: %s", e)
             self.client = None # Ensure client is None if initialization fails
             raise ConnectionError(f"Failed to initialize OpenAI client: {e}") from e
 
-        self.model = "gpt-4-turbo-preview" # Or "gpt-4" - check availability/cost
+        self.model = settings.CATEGORIZATION_MODEL # Defaults to gpt-4o-mini; see config.py
         # Define allowed categories based on config/requirements
-        self.allowed_categories = list(config.XERO_ACCOUNT_CODES.keys())
+        self.allowed_categories = list(settings.XERO_ACCOUNT_CODE_MAP.keys())
         self.system_prompt = f"""
 You are an AI assistant helping categorize business invoices. Based on the provided invoice details (vendor name, line items), determine the most appropriate expense category.
 The allowed categories are: {', '.join(self.allowed_categories)}.
@@ -83,21 +84,17 @@ Respond ONLY with the single most fitting category name from the allowed list. D
              return None
 
         # Create a concise representation of the invoice data for the prompt
-        prompt_data = f"Vendor: {invoice_data.vendor_name}\n"
-        prompt_data += f"Total Amount: {invoice_data.total_amount}\n"
-        if invoice_data.line_items:
-            items_str = "; ".join([
-                f"{item.description} ({item.amount})"
-                for item in invoice_data.line_items
-                if item.description or item.amount # Only include items with some info
-            ])
-            if items_str: # Add line items only if they contain useful info
-                 prompt_data += f"Line Items: {items_str}"
-
-        logger.info(f"Requesting categorization for invoice data: {prompt_data[:200]}...") # Log snippet
+        prompt_parts = [f"Vendor: {invoice_data.vendor_name}", f"Total Amount: {invoice_data.total_amount}"]
+        items_str = "; ".join(compact_line_items(invoice_data.line_items))
+        # Add line items only if they contain useful info; otherwise keep the trailing newline as before
+        prompt_parts.append(f"Line Items: {items_str}" if items_str else "")
+        prompt_data = "\n".join(prompt_parts)
+
+        logger.info("Requesting categorization for invoice data: %s...", prompt_data[:200]) # Log snippet
 
         try:
-            response = self.client.chat.completions.create(
+            response = create_with_backoff( # Retries rate limits / transient server errors
+                self.client.chat.completions.create,
                 model=self.model,
                 messages=[
                     {"role": "system", "content": self.system_prompt},
@@ -111,11 +108,11 @@ Respond ONLY with the single most fitting category name from the allowed list. D
 
             if response.choices and response.choices[0].message:
                 category = response.choices[0].message.content.strip()
-                logger.info(f"OpenAI suggested category: {category}")
+                logger.info("OpenAI suggested category: %s", category)
 
                 # Validate the category against the allowed list
                 if category not in self.allowed_categories:
-                    logger.warning(f"OpenAI returned an invalid category '{category}'. Defaulting to 'Other'.")
+                    logger.warning("OpenAI returned an invalid category '%s'. Defaulting to 'Other'.", category)
                     category = "Other" # Fallback to default category
 
                 # Create the output object by copying input and adding the category
@@ -129,17 +126,32 @@ Respond ONLY with the single most fitting category name from the allowed list. D
                 return None
 
         except OpenAIError as e:
-            logger.error(f"OpenAI API error during categorization: {e}", exc_info=True)
+            logger.error("OpenAI API error during categorization: %s", e, exc_info=True)
             return None
         except Exception as e:
-            logger.error(f"Unexpected error during categorization: {e}", exc_info=True)
+            logger.error("Unexpected error during categorization: %s", e, exc_info=True)
             return None
 
 # --- Factory Function ---
+# The service (client, prompt, category list) only depends on process-wide settings, so every caller
+# shares one instance instead of rebuilding it per request. Only a successful init is kept: a
+# failure (None) may be transient, so the next call tries again.
+_categorization_service: Optional[CategorizationService] = None
+_categorization_service_lock = threading.Lock()
+
 def get_categorization_service() -> Optional[CategorizationService]:
-    """Returns an instance of the configured categorization service."""
-    service_name = config.CATEGORIZATION_SERVICE
-    logger.info(f"Attempting to initialize Categorization service: {service_name}")
+    """Returns the process-wide instance of the configured categorization service, or None if init fails."""
+    global _categorization_service
+    if _categorization_service is None:
+        with _categorization_service_lock:
+            if _categorization_service is None:
+                _categorization_service = _create_categorization_service()
+    return _categorization_service
+
+def _create_categorization_service() -> Optional[CategorizationService]:
+    """Builds the configured categorization service, or returns None if it can't be initialized."""
+    service_name = settings.CATEGORIZATION_SERVICE # Lives on Settings; config has no module-level copy
+    logger.info("Attempting to initialize Categorization service: %s", service_name)
     try:
         if service_name == "openai":
             return OpenAICategorizer()
@@ -147,11 +159,11 @@ def get_categorization_service() -> Optional[CategorizationService]:
         # elif service_name == "custom":
         #     return CustomCategorizer(...)
         else:
-            logger.error(f"Unsupported Categorization service configured: {service_name}")
+            logger.error("Unsupported Categorization service configured: %s", service_name)
             return None
     except ValueError as e: # Catch config errors like missing API keys
-        logger.error(f"Failed to initialize Categorization service '{service_name}': {e}")
+        logger.error("Failed to initialize Categorization service '%s': %s", service_name, e)
         return None
     except Exception as e:
-        logger.error(f"Unexpected error initializing Categorization service '{service_name}': {e}", exc_info=True)
+        logger.error("Unexpected error initializing Categorization service '%s': %s", service_name, e, exc_info=True)
         return None
@@ -1,17 +1,94 @@
 # services/ocr.py
+import asyncio
+import functools
+import hashlib
 import logging
 import re
-import io # Needed for PyPDF2
+import threading
+import time
+from collections import OrderedDict
+import io # In-memory PDF stream for the PyPDF2 backend
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Sequence, Tuple
+import httpx
+import orjson
 from pydantic import BaseModel, Field, ValidationError, AliasChoices
 from mistralai import Mistral # Corrected import path
 from PyPDF2 import PdfReader # Import PdfReader
+try:
+    import pymupdf # PyMuPDF: text extraction runs in the MuPDF C library, far faster than PyPDF2
+except ImportError: # Without it, only the PyPDF2 backend is available
+    pymupdf = None
 
 import config # Use loaded config
+from .ocr_cache import OCRCache, cache_key
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO) # Basic logging config for now
+
+# --- PDF text backends ---
+PDF_BACKENDS = ("pymupdf", "pypdf2")
+DEFAULT_PDF_BACKEND = "pymupdf" if pymupdf is not None else "pypdf2"
+# Cap on PDF text sent to Mistral, in tokens: leaves room for the prompt template and the JSON reply.
+# Characters are a poor proxy (~4 chars/token for prose, under 2 for numbers and tables).
+MAX_PDF_TEXT_TOKENS = 8000
+# Used instead when no tokenizer is available: ~2 chars/token keeps even number-heavy text in budget
+MAX_PDF_TEXT_CHARS = 2 * MAX_PDF_TEXT_TOKENS
+# Page extraction stops at this many characters; no realistic text needs more than ~5 chars/token,
+# so pages past it would be truncated away anyway and aren't even extracted
+PDF_EXTRACT_CHAR_LIMIT = 5 * MAX_PDF_TEXT_TOKENS
+# Recently extracted PDF texts kept in memory per OCR instance (retries/previews of the same file)
+PDF_TEXT_CACHE_SIZE = 128
+# Invoices sent per extract_batch request; each carries up to MAX_PDF_TEXT_TOKENS of text
+EXTRACTION_BATCH_SIZE = 5
+# Field schema shared by the single- and multi-invoice extraction prompts
+_INVOICE_FIELDS = (
+    "vendor_name (string), vendor_address (string|null), invoice_number (string|null), "
+    "issue_date (YYYY-MM-DD|null), due_date (YYYY-MM-DD|null), total_amount (number), currency (ISO code|null), "
+    "line_items (array of {description (string), quantity (number|null), unit_price (number|null), amount (number)})"
+)
+# Markdown code fence (with or without a json tag) around a reply, stripped in one regex pass
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+# ASCII control characters (0-31) except \t, \n, \r, removed from replies via str.translate
+_CTRL_STRIP = dict.fromkeys([*range(0, 9), 11, 12, *range(14, 32)], None)
+# Re-prompts after a reply fails validation, each carrying the validation error back to the model
+EXTRACTION_FEEDBACK_RETRIES = 2
+
+@functools.lru_cache(maxsize=1)
+def _text_tokenizer() -> Optional[Any]:
+    """
+    Mistral's tekken tokenizer, loaded once per process on first use (~1s).
+
+    Returns None when mistral-common isn't installed or can't load; callers then budget by characters.
+    """
+    try:
+        from mistral_common.tokens.tokenizers.mistral import MistralTokenizer # Imported lazily: ~0.3s at startup
+        return MistralTokenizer.v3(is_tekken=True).instruct_tokenizer.tokenizer
+    except Exception as e:
+        logger.warning("Mistral tokenizer unavailable (%s); truncating PDF text by characters.", e)
+        return None
+
+# --- Shared Mistral clients ---
+# One client (and connection pool) per API key for the whole process: service instances and
+# concurrent uploads reuse warm keep-alive connections instead of paying TCP + TLS setup each time
+_MISTRAL_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=20)
+_mistral_clients: Dict[str, Mistral] = {}
+_mistral_clients_lock = threading.Lock()
+
+
+def get_mistral_client(api_key: str) -> Mistral:
+    """Returns the process-wide Mistral client for api_key, creating it on first use."""
+    client = _mistral_clients.get(api_key)
+    if client is None:
+        with _mistral_clients_lock:
+            client = _mistral_clients.get(api_key)
+            if client is None:
+                client = Mistral(
+                    api_key=api_key,
+                    client=httpx.Client(limits=_MISTRAL_HTTP_LIMITS),
+                    async_client=httpx.AsyncClient(limits=_MISTRAL_HTTP_LIMITS),
+                )
+                _mistral_clients[api_key] = client
+    return client
 
 # --- Pydantic Models for Structured Output ---
 class LineItem(BaseModel):
@@ -48,9 +125,16 @@ class OCRService(ABC):
 
 # --- Mistral OCR Implementation ---
 class MistralOCR(OCRService):
-    def __init__(self, api_key: Optional[str] = None):
+    # Part of every cache key: bump PROMPT_VERSION whenever the prompt or parsing changes so stale
+    # cached extractions are never served
+    PROMPT_VERSION = "v3"
+    MODEL_ID = "mistral-large-latest" # Confirm this is the best model choice
+
+    def __init__(self, api_key: Optional[str] = None, pdf_backend: Optional[str] = None, cache_dir: Optional[str] = None,
+                 stream_responses: Optional[bool] = None):
         # Fetch API key from config if not provided explicitly
         effective_api_key = api_key
+        settings = None
         if effective_api_key is None:
             try:
                 # Instantiate settings to access the value
@@ -68,162 +152,452 @@ class MistralOCR(OCRService):
             logger.critical("Mistral API key is not configured. OCR service cannot be initialized.")
             raise ValueError("Mistral API key is not configured.")
             
-        self.client = Mistral(api_key=effective_api_key) # Use the determined key
-        # Define the expected JSON structure for Mistral
+        # Process-wide client for this key, so instances share one connection pool
+        self.client = get_mistral_client(effective_api_key)
+        # PDF -> text backend: explicit argument, else PDF_BACKEND from settings, else the default
+        self.pdf_backend = pdf_backend or getattr(settings, "PDF_BACKEND", None) or DEFAULT_PDF_BACKEND
+        if self.pdf_backend not in PDF_BACKENDS or (self.pdf_backend == "pymupdf" and pymupdf is None):
+            logger.warning("PDF backend '%s' is unavailable; using '%s'.", self.pdf_backend, DEFAULT_PDF_BACKEND)
+            self.pdf_backend = DEFAULT_PDF_BACKEND
+        # blake2b(pdf bytes) -> extracted text, LRU-bounded; the executor threads share it, hence the lock
+        self._text_cache: "OrderedDict[bytes, str]" = OrderedDict()
+        self._text_cache_lock = threading.Lock()
+        # Streamed replies: explicit argument, else OCR_STREAM_RESPONSES from settings (off by default)
+        if stream_responses is None:
+            stream_responses = getattr(settings, "OCR_STREAM_RESPONSES", False) is True
+        self.stream_responses = stream_responses
+        # Extraction cache: explicit argument, else OCR_CACHE_DIR from settings; empty/unset disables it
+        cache_dir = cache_dir or getattr(settings, "OCR_CACHE_DIR", None)
+        self.cache: Optional[OCRCache] = None
+        if isinstance(cache_dir, str) and cache_dir:
+            try:
+                self.cache = OCRCache(cache_dir)
+            except OSError as e:
+                logger.warning("OCR cache directory %s is unusable (%s); running without a cache.", cache_dir, e)
+        # Compact schema description (~100 tokens instead of ~600 with the worked example): JSON mode
+        # already forces an object, and ExtractedInvoiceData validation enforces the structure
         self.extraction_prompt_template = (
-            "Extract the key information from the following invoice text and provide it ONLY as a valid JSON object. "
-            "Ensure all monetary values are represented as numbers (float or int), not strings. \n"
-            "Use the EXACT JSON key names specified below (e.g., 'vendor_name', 'invoice_number', 'issue_date').\n"
-            "Required fields:\n"
-            "- vendor_name (string, required): The name of the company issuing the invoice.\n"
-            "- vendor_address (string, optional): The full address of the vendor.\n"
-            "- invoice_number (string, optional): The unique identifier for the invoice.\n"
-            "- issue_date (string, optional): The date the invoice was issued (YYYY-MM-DD format preferred).\n"
-            "- due_date (string, optional): The date the invoice payment is due (YYYY-MM-DD format preferred).\n"
-            "- total_amount (float, required): The final total amount due on the invoice.\n"
-            "- currency (string, optional): The currency code (e.g., USD, GBP, EUR).\n"
-            "- line_items (array of objects, required): A list of items or services billed. Each object MUST contain:\n"
-            "    - description (string, required): Description of the line item.\n"
-            "    - quantity (float, optional): The quantity of the item.\n"
-            "    - unit_price (float, optional): The price per unit of the item.\n"
-            "    - amount (float, required): The total amount for the line item (quantity * unit_price).\n\n"
-            "Example JSON structure (use these keys):\n"
-            "```json\n"
-            "{{\n"
-            "  \"vendor_name\": \"Example Corp\",\n"
-            "  \"vendor_address\": \"123 Example St, Example City, EX 12345\",\n"
-            "  \"invoice_number\": \"INV-123\",\n"
-            "  \"issue_date\": \"2024-01-15\",\n"
-            "  \"due_date\": \"2024-01-30\",\n"
-            "  \"total_amount\": 150.75,\n"
-            "  \"currency\": \"USD\",\n"
-            "  \"line_items\": [\n"
-            "    {{\n"
-            "      \"description\": \"Product A\",\n"
-            "      \"quantity\": 2,\n"
-            "      \"unit_price\": 50.00,\n"
-            "      \"amount\": 100.00\n"
-            "    }},\n"
-            "    {{\n"
-            "      \"description\": \"Service B\",\n"
-            "      \"quantity\": null,\n"
-            "      \"unit_price\": null,\n"
-            "      \"amount\": 50.75\n"
-            "    }}\n"
-            "  ]\n"
-            "}}\n"
-            "```\n\n"
-            "Here is the invoice text:\n"
-            "---------------------\n"
-            "{invoice_text}\n"
-            "---------------------\n"
-            "JSON Output Only (using specified keys):"
+            "Extract the invoice fields from the text below as ONE JSON object with exactly these keys: "
+            + _INVOICE_FIELDS.replace("{", "{{").replace("}", "}}") + ". "
+            "Monetary values must be numbers, not strings. Return JSON only.\n\n"
+            "{invoice_text}"
+        )
+        # Split once at the single placeholder (unescaping the literal braces), so building a prompt is a
+        # plain concatenation instead of str.format re-scanning the template on every call
+        self._prompt_prefix, self._prompt_suffix = (
+            part.replace("{{", "{").replace("}}", "}") for part in self.extraction_prompt_template.split("{invoice_text}")
+        )
+        # Several invoices per request (extract_batch): the instructions are sent once per group
+        self.batch_prompt_prefix = (
+            "Each invoice below starts with a line 'Invoice <id>:'. Extract the fields of every invoice and return ONE JSON "
+            'object {"results": [...]} with one entry per invoice, in input order, each with exactly these keys: '
+            "id (the invoice's id, string), " + _INVOICE_FIELDS + ". "
+            "Monetary values must be numbers, not strings. Return JSON only.\n\n"
         )
 
+    @staticmethod
+    def _pdf_text_pymupdf(pdf_content: bytes, max_chars: int) -> str:
+        """Page text via PyMuPDF (parsing and text decoding happen in native code), stopping once max_chars is reached."""
+        parts: List[str] = []
+        total_len = 0
+        with pymupdf.open(stream=pdf_content, filetype="pdf") as doc:
+            for page in doc: # Pages load lazily, so breaking early skips the rest entirely
+                page_text = page.get_text("text")
+                parts.append(page_text)
+                total_len += len(page_text) + 1
+                if total_len >= max_chars:
+                    break
+        return "\n".join(parts)
+
+    @staticmethod
+    def _pdf_text_pypdf2(pdf_content: bytes, max_chars: int) -> str:
+        """Page text via PyPDF2 (pure Python; kept as a fallback backend), stopping once max_chars is reached."""
+        reader = PdfReader(io.BytesIO(pdf_content))
+        # Collected and joined once: += would re-copy all prior text on every page (O(n^2) bytes moved)
+        parts: List[str] = []
+        total_len = 0
+        for page in reader.pages:
+            page_text = page.extract_text()
+            if page_text: # Check if text extraction returned something
+                parts.append(page_text)
+                total_len += len(page_text) + 1 # + the newline between pages
+                if total_len >= max_chars: # The rest would be truncated away anyway
+                    break
+        return "\n".join(parts)
+
     def _extract_text_from_pdf(self, pdf_content: bytes, filename: str) -> Optional[str]:
-        """Extracts text from PDF content using PyPDF2."""
+        """Extracts text from PDF content using the configured backend (PyMuPDF, or PyPDF2).
+
+        Results are memoized by content hash, so the same bytes are only parsed once.
+        """
+        # BLAKE2b hashes far faster than PDF parsing; 16 bytes is plenty for an in-process key
+        digest = hashlib.blake2b(pdf_content, digest_size=16).digest()
+        with self._text_cache_lock:
+            cached = self._text_cache.get(digest)
+            if cached is not None:
+                self._text_cache.move_to_end(digest)
+        if cached is not None:
+            logger.info("Reusing extracted PDF text for %s.", filename)
+            return cached
+
+        text = self._extract_text_uncached(pdf_content, filename)
+        if text:
+            with self._text_cache_lock:
+                self._text_cache[digest] = text
+                if len(self._text_cache) > PDF_TEXT_CACHE_SIZE:
+                    self._text_cache.popitem(last=False)
+        return text
+
+    def _extract_text_uncached(self, pdf_content: bytes, filename: str) -> Optional[str]:
+        """One PDF -> text pass with the configured backend, truncated to MAX_PDF_TEXT_TOKENS."""
+        backend_name = "PyMuPDF" if self.pdf_backend == "pymupdf" else "PyPDF2"
         try:
-            reader = PdfReader(io.BytesIO(pdf_content))
-            text = ""
-            for page in reader.pages:
-                page_text = page.extract_text()
-                if page_text: # Check if text extraction returned something
-                    text += page_text + "\n" # Add newline between pages
-            if not text:
-                 logger.warning(f"PyPDF2 extracted no text from {filename}. It might be image-based or corrupted.")
-                 return None # Indicate no text could be extracted
-            logger.info(f"Successfully extracted text from {filename} using PyPDF2.")
             # Limit text length to avoid excessive token usage with Mistral
-            max_chars = 15000 # Adjust as needed based on token limits/cost
-            if len(text) > max_chars:
-                logger.warning(f"Extracted text truncated to {max_chars} characters for {filename}.")
-                text = text[:max_chars]
-            return text
+            max_chars = PDF_EXTRACT_CHAR_LIMIT
+            if self.pdf_backend == "pymupdf":
+                text = self._pdf_text_pymupdf(pdf_content, max_chars)
+            else:
+                text = self._pdf_text_pypdf2(pdf_content, max_chars)
+            if not text.strip(): # Image-only pages come back as empty strings/newlines
+                 logger.warning("%s extracted no text from %s. It might be image-based or corrupted.", backend_name, filename)
+                 return None # Indicate no text could be extracted
+            logger.info("Successfully extracted text from %s using %s.", filename, backend_name)
+            return self._truncate_to_token_budget(text, filename)
         except Exception as e:
-            logger.error(f"PyPDF2 failed to process {filename}: {e}")
+            logger.error("%s failed to process %s: %s", backend_name, filename, e)
             return None
 
+    @staticmethod
+    def _truncate_to_token_budget(text: str, filename: str) -> str:
+        """Trims text to MAX_PDF_TEXT_TOKENS tokens (or MAX_PDF_TEXT_CHARS characters without a tokenizer)."""
+        tokenizer = _text_tokenizer()
+        if tokenizer is None:
+            if len(text) > MAX_PDF_TEXT_CHARS:
+                logger.warning("Extracted text truncated to %s characters for %s.", MAX_PDF_TEXT_CHARS, filename)
+                text = text[:MAX_PDF_TEXT_CHARS]
+            return text
+        token_ids = tokenizer.encode(text, bos=False, eos=False)
+        if len(token_ids) > MAX_PDF_TEXT_TOKENS:
+            logger.warning("Extracted text truncated to %s tokens for %s.", MAX_PDF_TEXT_TOKENS, filename)
+            # Decoding whole tokens never splits a multi-byte character the way slicing bytes could
+            text = tokenizer.decode(token_ids[:MAX_PDF_TEXT_TOKENS])
+        return text
+
 
-    def _parse_response(self, response_content: str, filename: str) -> Optional[ExtractedInvoiceData]:
-        """Attempts to parse the LLM response into the Pydantic model."""
+    def _parse_response(self, response_content: str, filename: str) -> Tuple[Optional[ExtractedInvoiceData], Optional[str]]:
+        """Attempts to parse the LLM response into the Pydantic model.
+
+        Returns (data, None) on success, (None, error) when the reply failed validation (worth
+        re-prompting with the error), or (None, None) on an unexpected failure.
+        """
         try:
-            # Clean up potential markdown code blocks
-            response_content = response_content.strip()
-            if response_content.startswith("```json"):
-                response_content = response_content[7:]
-            if response_content.endswith("```"):
-                response_content = response_content[:-3]
-            response_content = response_content.strip()
-
-            # --- Add this line ---
-            # Remove ASCII control characters (0-31) except \n, \r, \t
-            response_content = re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F]', '', response_content)
-            # --------------------
+            # Clean up potential markdown code blocks, ```json or a bare ``` fence
+            response_content = _FENCE_RE.sub("", response_content).strip()
+
+            # Remove ASCII control characters (0-31) except \n, \r, \t (a single C-level pass, no regex engine)
+            response_content = response_content.translate(_CTRL_STRIP)
 
             # Handle potential variations if model doesn't strictly follow JSON format
             # Basic check if it looks like JSON
             if not response_content.startswith("{") or not response_content.endswith("}"):
-                logger.warning(f"Mistral response for {filename} does not appear to be valid JSON: {response_content[:100]}...")
+                logger.warning("Mistral response for %s does not appear to be valid JSON: %s...", filename, response_content[:100])
                 # Attempt parsing anyway, might fail
 
-            data = ExtractedInvoiceData.model_validate_json(response_content)
-            logger.info(f"Successfully parsed Mistral OCR response for {filename}: {data.model_dump(exclude_none=True)}")
-            return data
+            # orjson first: the usual failure is prose instead of JSON, and its one-line error is cheaper
+            # to build than a ValidationError and reads better as re-prompt feedback
+            try:
+                raw = orjson.loads(response_content)
+            except orjson.JSONDecodeError as e:
+                logger.error("Mistral OCR response for %s is not valid JSON: %s", filename, e)
+                logger.debug("Raw response content for %s: %s", filename, response_content)
+                return None, f"not valid JSON ({e})"
+            data = ExtractedInvoiceData.model_validate(raw)
+            # model_dump walks the whole model; only pay for it when the line will actually be emitted
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Successfully parsed Mistral OCR response for %s: %s", filename, data.model_dump(exclude_none=True))
+            return data, None
         except ValidationError as e:
-            logger.error(f"Failed to validate Mistral OCR JSON response for {filename}: {e}")
-            logger.debug(f"Raw response content for {filename}: {response_content}")
-            return None
+            logger.error("Failed to validate Mistral OCR JSON response for %s: %s", filename, e)
+            logger.debug("Raw response content for %s: %s", filename, response_content)
+            return None, str(e)
         except Exception as e:
-            logger.error(f"Unexpected error parsing Mistral response for {filename}: {e}")
-            logger.debug(f"Raw response content for {filename}: {response_content}")
-            return None
+            logger.error("Unexpected error parsing Mistral response for %s: %s", filename, e)
+            logger.debug("Raw response content for %s: %s", filename, response_content)
+            return None, None
 
     def extract(self, file_content: bytes, filename: str) -> Optional[ExtractedInvoiceData]:
         """
-        Extracts data using Mistral's API after text extraction via PyPDF2.
+        Extracts data using Mistral's API after text extraction with the configured PDF backend (PyMuPDF or PyPDF2).
         """
-        logger.info(f"Starting Mistral OCR extraction process for: {filename}")
+        logger.info("Starting Mistral OCR extraction process for: %s", filename)
+
+        # Step 0: Identical bytes + prompt + model means an identical answer; skip parsing and the API call
+        key, data = self._cached_extraction(file_content, filename)
+        if data:
+            return data
 
         # Step 1: Extract text from PDF
         invoice_text = self._extract_text_from_pdf(file_content, filename)
         if not invoice_text:
-             logger.error(f"Failed to extract text from {filename}. Cannot proceed with Mistral OCR.")
+             logger.error("Failed to extract text from %s. Cannot proceed with Mistral OCR.", filename)
              return None
 
         # Step 2: Prepare prompt for Mistral
-        prompt = self.extraction_prompt_template.format(invoice_text=invoice_text)
+        prompt = self._prompt_prefix + invoice_text + self._prompt_suffix
 
-        # Step 3: Call Mistral API
+        # Step 3: Call Mistral API, re-prompting with the validation error if the reply doesn't fit the schema
+        messages = [{"role": "user", "content": prompt}] # Pass message as dict
         try:
-            logger.info(f"Sending request to Mistral API for {filename}...")
-            # Updated API call: Use chat.complete and pass messages as dicts
-            chat_response = self.client.chat.complete(
-                model="mistral-large-latest", # Confirm this is the best model choice
-                messages=[{"role": "user", "content": prompt}], # Pass message as dict
-                temperature=0.1, # Lower temperature for more deterministic extraction
-                response_format={"type": "json_object"} # Added to enforce JSON output
-            )
+            for attempt in range(EXTRACTION_FEEDBACK_RETRIES + 1):
+                logger.info("Sending request to Mistral API for %s...", filename)
+                if self.stream_responses:
+                    response_content = self._stream_reply(messages, filename)
+                else:
+                    # Updated API call: Use chat.complete and pass messages as dicts
+                    response_content = self._reply_content(self.client.chat.complete(**self._chat_request(messages)), filename)
+                # Step 4: Parse the response (and remember it for re-submissions of the same file)
+                data, messages = self._handle_reply(response_content, messages, attempt, key, filename)
+                if messages is None:
+                    return data
+                time.sleep(1.0 * (attempt + 1))
 
-            if chat_response.choices and chat_response.choices[0].message:
-                response_content = chat_response.choices[0].message.content
-                logger.info(f"Received Mistral response for {filename}.")
-                # Step 4: Parse the response
-                return self._parse_response(response_content, filename)
-            else:
-                logger.error(f"Mistral API returned no choices or message content for {filename}.")
-                # Log relevant details from the response if available
-                # logger.debug(f"Mistral API full response: {chat_response}")
-                return None
+        except Exception as e:
+            logger.error("Error calling Mistral API for %s: %s", filename, e, exc_info=True) # Log traceback
+            return None
+
+    async def extract_async(self, file_content: bytes, filename: str) -> Optional[ExtractedInvoiceData]:
+        """
+        Async variant of extract(): same steps, but the Mistral call is awaited (complete_async) and the
+        CPU-bound PDF parsing runs in a worker thread, so many invoices can be in flight on one event loop.
+        """
+        key, data = self._cached_extraction(file_content, filename)
+        if data:
+            return data
+
+        invoice_text = await asyncio.to_thread(self._extract_text_from_pdf, file_content, filename)
+        if not invoice_text:
+             logger.error("Failed to extract text from %s. Cannot proceed with Mistral OCR.", filename)
+             return None
+
+        prompt = self._prompt_prefix + invoice_text + self._prompt_suffix
+
+        messages = [{"role": "user", "content": prompt}]
+        try:
+            for attempt in range(EXTRACTION_FEEDBACK_RETRIES + 1):
+                logger.info("Sending async request to Mistral API for %s...", filename)
+                if self.stream_responses:
+                    response_content = await self._stream_reply_async(messages, filename)
+                else:
+                    response_content = self._reply_content(await self.client.chat.complete_async(**self._chat_request(messages)), filename)
+                data, messages = self._handle_reply(response_content, messages, attempt, key, filename)
+                if messages is None:
+                    return data
+                await asyncio.sleep(1.0 * (attempt + 1))
 
         except Exception as e:
-            logger.error(f"Error calling Mistral API for {filename}: {e}", exc_info=True) # Log traceback
+            logger.error("Error calling Mistral API for %s: %s", filename, e, exc_info=True)
+            return None
+
+    def extract_batch(self, items: Sequence[Tuple[bytes, str]], k: int = EXTRACTION_BATCH_SIZE) -> List[Optional[ExtractedInvoiceData]]:
+        """
+        Extracts several invoices, sending up to k of them per Mistral request.
+
+        Cache hits are answered locally. Invoices the batched reply leaves out or gets wrong are
+        retried one at a time through extract(). Returns one result per (file_content, filename)
+        item, in order.
+        """
+        results: List[Optional[ExtractedInvoiceData]] = [None] * len(items)
+        keys: List[Optional[str]] = [None] * len(items)
+        texts: Dict[int, str] = {}
+        for index, (file_content, filename) in enumerate(items):
+            keys[index], results[index] = self._cached_extraction(file_content, filename)
+            if results[index] is None:
+                invoice_text = self._extract_text_from_pdf(file_content, filename)
+                if invoice_text:
+                    texts[index] = invoice_text
+                else:
+                    logger.error("Failed to extract text from %s. Cannot proceed with Mistral OCR.", filename)
+
+        pending = list(texts)
+        for start in range(0, len(pending), k):
+            group = pending[start:start + k]
+            extracted = self._extract_group([texts[index] for index in group]) if len(group) > 1 else [None]
+            for index, data in zip(group, extracted):
+                file_content, filename = items[index]
+                if data is None:
+                    # Not (validly) in the batched reply; extract() re-prompts on its own and reuses the parsed text
+                    results[index] = self.extract(file_content, filename)
+                    continue
+                if keys[index]:
+                    self.cache.set(keys[index], data)
+                results[index] = data
+        return results
+
+    def _extract_group(self, group_texts: Sequence[str]) -> List[Optional[ExtractedInvoiceData]]:
+        """One Mistral request for several invoice texts; see extract_batch. None marks an invoice to retry alone."""
+        prompt = self.batch_prompt_prefix + "\n\n".join(
+            f"Invoice {index}:\n{invoice_text}" for index, invoice_text in enumerate(group_texts)
+        )
+        try:
+            logger.info("Sending batched request to Mistral API for %d invoices...", len(group_texts))
+            response_content = self._reply_content(
+                self.client.chat.complete(**self._chat_request([{"role": "user", "content": prompt}])), "invoice batch"
+            )
+            response_content = _FENCE_RE.sub("", response_content or "").strip().translate(_CTRL_STRIP)
+            entries = orjson.loads(response_content).get("results")
+        except Exception as e: # API errors, non-JSON or non-object replies
+            logger.error("Batched Mistral extraction failed; extracting the invoices one by one: %s", e)
+            return [None] * len(group_texts)
+
+        by_id = {str(entry.get("id")): entry for entry in entries or [] if isinstance(entry, dict)}
+        extracted: List[Optional[ExtractedInvoiceData]] = []
+        for index in range(len(group_texts)):
+            entry = by_id.get(str(index))
+            try:
+                extracted.append(ExtractedInvoiceData.model_validate(entry) if entry is not None else None)
+            except ValidationError as e:
+                logger.warning("Batched Mistral entry %d failed validation: %s", index, e)
+                extracted.append(None)
+        return extracted
+
+    def _cached_extraction(self, file_content: bytes, filename: str) -> Tuple[Optional[str], Optional[ExtractedInvoiceData]]:
+        """Returns (cache key, cached result); the key is None when caching is off, the result None on a miss."""
+        if not self.cache:
+            return None, None
+        key = cache_key(self.PROMPT_VERSION.encode(), self.MODEL_ID.encode(), file_content)
+        cached = self.cache.get(key)
+        if cached:
+            try:
+                data = ExtractedInvoiceData.model_validate_json(cached)
+                logger.info("OCR cache hit for %s.", filename)
+                return key, data
+            except ValidationError as e:
+                logger.warning("Ignoring unreadable OCR cache entry for %s: %s", filename, e)
+        return key, None
+
+    def _chat_request(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        """Keyword arguments for chat.complete / chat.stream and their async twins."""
+        return {
+            "model": self.MODEL_ID,
+            "messages": messages,
+            "temperature": 0.1, # Lower temperature for more deterministic extraction
+            "response_format": {"type": "json_object"}, # Added to enforce JSON output
+        }
+
+    @staticmethod
+    def _reply_content(chat_response: Any, filename: str) -> Optional[str]:
+        """Text of a chat.complete reply, or None if it came back empty."""
+        if not (chat_response.choices and chat_response.choices[0].message):
+            logger.error("Mistral API returned no choices or message content for %s.", filename)
+            # Log relevant details from the response if available
+            # logger.debug("Mistral API full response: %s", chat_response)
+            return None
+        return chat_response.choices[0].message.content
+
+    @staticmethod
+    def _stream_delta(event: Any) -> Optional[str]:
+        """Text carried by one streamed completion event, if any."""
+        choices = event.data.choices
+        delta = choices[0].delta.content if choices else None
+        return delta if isinstance(delta, str) else None
+
+    @staticmethod
+    def _opens_as_json(delta: str) -> Optional[bool]:
+        """None while a reply is still only whitespace, else whether its first visible character can open a JSON object."""
+        head = delta.lstrip()
+        if not head:
             return None
+        # JSON mode replies open with "{" (or a ``` fence, which _parse_response strips); prose is hopeless
+        return head[0] in "{`"
+
+    def _stream_reply(self, messages: List[Dict[str, str]], filename: str) -> Optional[str]:
+        """
+        Streams one completion and returns its text.
+
+        A reply that opens with prose is cut off right there; the partial text then fails parsing and
+        goes through the usual validation re-prompt without waiting for the rest to be generated.
+        """
+        parts: List[str] = []
+        opened = False
+        with self.client.chat.stream(**self._chat_request(messages)) as stream: # Closing drops the connection
+            for event in stream:
+                delta = self._stream_delta(event)
+                if not delta:
+                    continue
+                parts.append(delta)
+                if not opened:
+                    opens_json = self._opens_as_json(delta)
+                    if opens_json is False:
+                        logger.warning("Mistral reply for %s is not a JSON object; abandoning the stream.", filename)
+                        break
+                    opened = opens_json is True
+        return "".join(parts) or None
+
+    async def _stream_reply_async(self, messages: List[Dict[str, str]], filename: str) -> Optional[str]:
+        """Async twin of _stream_reply."""
+        parts: List[str] = []
+        opened = False
+        async with await self.client.chat.stream_async(**self._chat_request(messages)) as stream:
+            async for event in stream:
+                delta = self._stream_delta(event)
+                if not delta:
+                    continue
+                parts.append(delta)
+                if not opened:
+                    opens_json = self._opens_as_json(delta)
+                    if opens_json is False:
+                        logger.warning("Mistral reply for %s is not a JSON object; abandoning the stream.", filename)
+                        break
+                    opened = opens_json is True
+        return "".join(parts) or None
+
+    def _handle_reply(self, response_content: Optional[str], messages: List[Dict[str, str]], attempt: int, key: Optional[str],
+                      filename: str) -> Tuple[Optional[ExtractedInvoiceData], Optional[List[Dict[str, str]]]]:
+        """
+        Parses one Mistral reply.
+
+        Returns (data, None) when extraction is finished (data is None if it failed), or
+        (None, messages) with the validation error appended when the model should be re-prompted.
+        """
+        if response_content is None:
+            return None, None
+
+        logger.info("Received Mistral response for %s.", filename)
+        data, validation_error = self._parse_response(response_content, filename)
+        if data:
+            if key:
+                self.cache.set(key, data)
+            return data, None
+        if validation_error is None or attempt == EXTRACTION_FEEDBACK_RETRIES:
+            return None, None
+
+        logger.warning("Re-prompting Mistral for %s with the validation error (retry %s/%s).", filename, attempt + 1, EXTRACTION_FEEDBACK_RETRIES)
+        return None, [
+            *messages,
+            {"role": "assistant", "content": response_content},
+            {"role": "user", "content": f"Your JSON failed validation: {validation_error}. Return a corrected JSON object only."},
+        ]
 
 # --- Factory Function ---
+# Shared like get_categorization_service: the service only depends on process-wide settings, so
+# callers share one instance (and its text cache) instead of rebuilding it per request. Only a
+# successful init is kept; after a failure (None) the next call tries again.
+_ocr_service: Optional[OCRService] = None
+_ocr_service_lock = threading.Lock()
+
 def get_ocr_service() -> Optional[OCRService]:
-    """Returns an instance of the configured OCR service, or None if config fails."""
-    service_name = config.OCR_SERVICE
-    logger.info(f"Attempting to initialize OCR service: {service_name}")
+    """Returns the process-wide instance of the configured OCR service, or None if init fails."""
+    global _ocr_service
+    if _ocr_service is None:
+        with _ocr_service_lock:
+            if _ocr_service is None:
+                _ocr_service = _create_ocr_service()
+    return _ocr_service
+
+def _create_ocr_service() -> Optional[OCRService]:
+    """Builds the configured OCR service, or returns None if it can't be initialized."""
+    service_name = config.settings.OCR_SERVICE # Lives on Settings; config has no module-level copy
+    logger.info("Attempting to initialize OCR service: %s", service_name)
     try:
         if service_name == "mistral":
             return MistralOCR()
@@ -231,11 +605,11 @@ def get_ocr_service() -> Optional[OCRService]:
         # elif service_name == "azure":
         #     return AzureOCR(...)
         else:
-            logger.error(f"Unsupported OCR service configured: {service_name}")
+            logger.error("Unsupported OCR service configured: %s", service_name)
             return None
     except ValueError as e: # Catch config errors like missing API keys
-         logger.error(f"Failed to initialize OCR service '{service_name}': {e}")
+         logger.error("Failed to initialize OCR service '%s': %s", service_name, e)
          return None
     except Exception as e:
-        logger.error(f"Unexpected error initializing OCR service '{service_name}': {e}", exc_info=True)
+        logger.error("Unexpected error initializing OCR service '%s': %s", service_name, e, exc_info=True)
         return None
@@ -0,0 +1,123 @@
+# services/ocr_cache.py
+"""
+Content-addressed cache of OCR extraction results.
+
+Re-submitted invoices (duplicate uploads, retries, re-ingests) hash to the same key, so the PDF
+parse and the Mistral call are skipped entirely. Entries are the extracted JSON, one small
+<key>.json file per document under a cache directory.
+
+Entries hold vendor and amount data, so the directory and files are owner-only, and the cache is
+bounded: entries older than max_age are dropped, and beyond max_entries the oldest go first.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+# Defaults for the cache bounds
+OCR_CACHE_MAX_ENTRIES = 1000
+OCR_CACHE_MAX_AGE = 7 * 24 * 60 * 60 # Seconds
+# Writes between prune passes (each pass lists the directory once)
+OCR_CACHE_PRUNE_EVERY = 100
+
+
+def cache_key(*parts: bytes) -> str:
+    """SHA-256 over the parts, each prefixed with its 8-byte length so boundaries can't be shifted to collide."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class OCRCache:
+    """Extraction results on local disk, keyed by cache_key(...)."""
+
+    def __init__(self, cache_dir: str, max_entries: int = OCR_CACHE_MAX_ENTRIES, max_age: float = OCR_CACHE_MAX_AGE):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_age = max_age
+        # Raises OSError if unusable; callers then run uncached. chmod too: makedirs' mode is masked
+        # by the umask and doesn't apply to a directory that already exists
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        os.chmod(cache_dir, 0o700)
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+        self.prune()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the cached JSON for key, or None on a miss (or an expired or unreadable entry)."""
+        path = self._path(key)
+        try:
+            if time.time() - os.stat(path).st_mtime > self.max_age:
+                self._remove(path)
+                return None
+            with open(path, encoding="utf-8") as cache_file:
+                return cache_file.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning("Could not read OCR cache entry %s: %s", key, e)
+            return None
+
+    def set(self, key: str, data: BaseModel) -> None:
+        """Stores data under key. Written to a temp file and renamed, so readers never see a partial entry."""
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            # Owner-only from the start, regardless of umask
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, "w", encoding="utf-8") as cache_file:
+                cache_file.write(data.model_dump_json())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Could not write OCR cache entry %s: %s", key, e)
+            self._remove(tmp_path)
+            return
+
+        with self._writes_lock:
+            self._writes += 1
+            due = self._writes % OCR_CACHE_PRUNE_EVERY == 0
+        if due:
+            self.prune()
+
+    def prune(self) -> None:
+        """Drops expired entries, then the oldest ones until at most max_entries remain."""
+        now = time.time()
+        entries = []
+        try:
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if not entry.name.endswith(".json"):
+                        continue
+                    try:
+                        mtime = entry.stat().st_mtime
+                    except OSError:
+                        continue # Removed concurrently
+                    if now - mtime > self.max_age:
+                        self._remove(entry.path)
+                    else:
+                        entries.append((mtime, entry.path))
+        except OSError as e:
+            logger.warning("Could not prune OCR cache %s: %s", self.cache_dir, e)
+            return
+        if len(entries) > self.max_entries:
+            entries.sort()
+            for _, path in entries[:len(entries) - self.max_entries]:
+                self._remove(path)
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
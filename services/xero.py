@@ -40,7 +40,7 @@ class XeroService:
             # Note: Access token will be fetched/refreshed automatically by the library when needed
             logger.info("Xero OAuth2 credentials configured.")
         except Exception as e:
-            logger.error(f"Failed to configure Xero credentials: {e}", exc_info=True)
+            logger.error("Failed to configure Xero credentials: %s", e, exc_info=True)
             raise
 
     def _setup_api_client(self):
@@ -56,7 +56,7 @@ class XeroService:
             self._accounting_api = AccountingApi(api_client)
             logger.info("Xero Accounting API client initialized.")
         except Exception as e:
-            logger.error(f"Failed to initialize Xero API client: {e}", exc_info=True)
+            logger.error("Failed to initialize Xero API client: %s", e, exc_info=True)
             raise
 
     def _get_tenant_id(self) -> Optional[str]:
@@ -80,24 +80,24 @@ class XeroService:
             contacts = self._accounting_api.get_contacts(tenant_id, where=where_filter)
 
             if contacts and contacts.contacts:
-                logger.info(f"Found existing Xero contact for '{vendor_name}'.")
+                logger.info("Found existing Xero contact for '%s'.", vendor_name)
                 return contacts.contacts[0]
             else:
                 # Contact not found, create a new one
-                logger.info(f"Xero contact for '{vendor_name}' not found. Creating new contact.")
+                logger.info("Xero contact for '%s' not found. Creating new contact.", vendor_name)
                 new_contact = Contact(name=vendor_name)
                 created_contacts = self._accounting_api.create_contacts(tenant_id, contacts={"contacts": [new_contact]})
                 if created_contacts and created_contacts.contacts:
-                    logger.info(f"Successfully created new Xero contact for '{vendor_name}'.")
+                    logger.info("Successfully created new Xero contact for '%s'.", vendor_name)
                     return created_contacts.contacts[0]
                 else:
-                    logger.error(f"Failed to create Xero contact for '{vendor_name}'. API response empty.")
+                    logger.error("Failed to create Xero contact for '%s'. API response empty.", vendor_name)
                     return None
         except AccountingBadRequestException as e:
-             logger.error(f"Xero API Bad Request finding/creating contact '{vendor_name}': {e.body}", exc_info=True)
+             logger.error("Xero API Bad Request finding/creating contact '%s': %s", vendor_name, e.body, exc_info=True)
              return None
         except ApiException as e:
-            logger.error(f"Xero API error finding/creating contact '{vendor_name}': {e}", exc_info=True)
+            logger.error("Xero API error finding/creating contact '%s': %s", vendor_name, e, exc_info=True)
             return None
 
     def create_draft_expense(self, invoice_data: CategorizedInvoiceData, pdf_content: bytes, pdf_filename: str) -> Optional[str]:
@@ -119,13 +119,13 @@ class XeroService:
 
         contact = self._find_or_create_contact(invoice_data.vendor_name)
         if not contact or not contact.contact_id:
-            logger.error(f"Failed to find or create Xero contact for vendor '{invoice_data.vendor_name}'. Cannot create Bill.")
+            logger.error("Failed to find or create Xero contact for vendor '%s'. Cannot create Bill.", invoice_data.vendor_name)
             return None
 
         # Map category to Xero Account Code
         account_code = config.XERO_ACCOUNT_CODES.get(invoice_data.category, config.XERO_ACCOUNT_CODES.get("Other"))
         if not account_code:
-             logger.error(f"Could not find Xero account code for category '{invoice_data.category}' or 'Other'. Check config.")
+             logger.error("Could not find Xero account code for category '%s' or 'Other'. Check config.", invoice_data.category)
              return None # Or potentially raise an error
 
 
@@ -156,7 +156,7 @@ class XeroService:
         )
 
         try:
-            logger.info(f"Attempting to create draft Bill in Xero for vendor '{invoice_data.vendor_name}'...")
+            logger.info("Attempting to create draft Bill in Xero for vendor '%s'...", invoice_data.vendor_name)
             created_bills = self._accounting_api.create_bills(
                 tenant_id,
                 bills={"bills": [bill_to_create]},
@@ -169,11 +169,11 @@ class XeroService:
 
             created_bill = created_bills.bills[0]
             bill_id = created_bill.bill_id
-            logger.info(f"Successfully created draft Bill in Xero with ID: {bill_id}")
+            logger.info("Successfully created draft Bill in Xero with ID: %s", bill_id)
 
             # Attach the PDF
             try:
-                logger.info(f"Attempting to attach PDF '{pdf_filename}' to Bill ID: {bill_id}")
+                logger.info("Attempting to attach PDF '%s' to Bill ID: %s", pdf_filename, bill_id)
                 self._accounting_api.create_bill_attachment_by_file_name(
                     tenant_id,
                     bill_id,
@@ -182,26 +182,26 @@ class XeroService:
                     # include_online=True # Optional: Make attachment viewable online
                     _headers={'Content-Type': 'application/pdf'} # Important header
                 )
-                logger.info(f"Successfully attached PDF '{pdf_filename}' to Bill ID: {bill_id}")
+                logger.info("Successfully attached PDF '%s' to Bill ID: %s", pdf_filename, bill_id)
             except AccountingBadRequestException as e:
-                logger.error(f"Xero API Bad Request attaching PDF to Bill {bill_id}: {e.body}", exc_info=True)
+                logger.error("Xero API Bad Request attaching PDF to Bill %s: %s", bill_id, e.body, exc_info=True)
                 # Continue even if attachment fails? For MVP, maybe log and return bill ID.
             except ApiException as e:
-                logger.error(f"Xero API error attaching PDF to Bill {bill_id}: {e}", exc_info=True)
+                logger.error("Xero API error attaching PDF to Bill %s: %s", bill_id, e, exc_info=True)
                  # Continue even if attachment fails? For MVP, maybe log and return bill ID.
 
 
             return bill_id
 
         except AccountingBadRequestException as e:
-             logger.error(f"Xero API Bad Request creating Bill for '{invoice_data.vendor_name}': {e.body}", exc_info=True)
+             logger.error("Xero API Bad Request creating Bill for '%s': %s", invoice_data.vendor_name, e.body, exc_info=True)
              # Try to parse specific validation errors if possible from e.body
              return None
         except ApiException as e:
-            logger.error(f"Xero API error creating Bill for '{invoice_data.vendor_name}': {e}", exc_info=True)
+            logger.error("Xero API error creating Bill for '%s': %s", invoice_data.vendor_name, e, exc_info=True)
             return None
         except Exception as e:
-             logger.error(f"Unexpected error creating Xero Bill: {e}", exc_info=True)
+             logger.error("Unexpected error creating Xero Bill: %s", e, exc_info=True)
              return None
 
 # --- Factory Function ---
@@ -215,8 +215,8 @@ def get_xero_service() -> Optional[XeroService]:
              return None
         return XeroService()
     except ValueError as e: # Catch config errors
-        logger.error(f"Failed to initialize Xero service: {e}")
+        logger.error("Failed to initialize Xero service: %s", e)
         return None
     except Exception as e:
-        logger.error(f"Unexpected error initializing Xero service: {e}", exc_info=True)
+        logger.error("Unexpected error initializing Xero service: %s", e, exc_info=True)
         return None
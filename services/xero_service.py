@@ -3,6 +3,9 @@ import os
 import sys
 import json
 import base64
+import threading
+import time
+from datetime import date, datetime
 from abc import ABC, abstractmethod
 from typing import Dict, Any, Tuple, Optional
 
@@ -85,6 +88,10 @@ class XeroPythonService(XeroService):
         self._refresh_token = settings.XERO_REFRESH_TOKEN
         self._tenant_id = settings.XERO_TENANT_ID
         self._access_token_data: Optional[Dict[str, Any]] = None # To hold the full token dict {access_token, refresh_token, expires_at, ...}
+        # One service is shared by the invoice worker threads. Xero refresh tokens rotate on use, so the
+        # check-then-refresh and the tenant lookup must not run concurrently. Reentrant: get_tenant_id
+        # refreshes the token and fetch_token fetches the tenant while holding it.
+        self._token_lock = threading.RLock()
 
         if not all([self.client_id, self.client_secret, self.redirect_uri, self.scopes]):
             logger.error("Xero credentials (ID, Secret, Redirect URI, Scopes) not fully configured.")
@@ -117,7 +124,7 @@ class XeroPythonService(XeroService):
         """Generate the Xero authorization URL and state."""
         session = self._get_oauth_session()
         authorization_url, state = session.authorization_url(XERO_AUTH_URL)
-        logger.info(f"Generated Xero authorization URL with state: {state}")
+        logger.info("Generated Xero authorization URL with state: %s", state)
         # TODO: Store the 'state' temporarily (e.g., in user session, cache, or db) to verify on callback
         return authorization_url, state
 
@@ -135,77 +142,80 @@ class XeroPythonService(XeroService):
                 authorization_response=authorization_response_url
             )
             logger.info("Successfully fetched Xero OAuth token.")
-            self._access_token_data = token
-            self._refresh_token = token.get('refresh_token')
-            self._tenant_id = None # Reset tenant ID, needs fetching with new token
+            with self._token_lock:
+                self._access_token_data = token
+                self._refresh_token = token.get('refresh_token')
+                self._tenant_id = None # Reset tenant ID, needs fetching with new token
             # TODO: Persist the new full token dict (self._access_token_data) securely!
-            logger.debug(f"New Token Data: {self._access_token_data}")
+            logger.debug("New Token Data: %s", self._access_token_data)
             # Fetch and store tenant ID immediately after getting token
             self.get_tenant_id() # Fetch and potentially store tenant ID
             return token
         except Exception as e:
-            logger.exception(f"Error fetching Xero OAuth token: {e}")
+            logger.exception("Error fetching Xero OAuth token: %s", e)
             raise # Re-raise the exception
 
     def refresh_oauth_token(self) -> Optional[Dict[str, Any]]:
         """Refresh the OAuth access token using the refresh token."""
-        if not self._refresh_token:
-            logger.error("Cannot refresh token: No refresh token available.")
-            # raise ValueError("Missing refresh token") # Or return None
-            return None
+        with self._token_lock:
+            if not self._refresh_token:
+                logger.error("Cannot refresh token: No refresh token available.")
+                # raise ValueError("Missing refresh token") # Or return None
+                return None
 
-        # Create a basic session for refreshing
-        session = OAuth2Session(self.client_id, token=self._access_token_data) 
+            # Create a basic session for refreshing
+            session = OAuth2Session(self.client_id, token=self._access_token_data) 
 
-        try:
-            logger.info("Attempting to refresh Xero OAuth token...")
-            # Use requests-oauthlib's refresh mechanism
-            new_token = session.refresh_token(
-                XERO_TOKEN_URL,
-                refresh_token=self._refresh_token,
-                client_id=self.client_id,
-                client_secret=self.client_secret
-            )
-            logger.info("Successfully refreshed Xero OAuth token.")
-            self._access_token_data = new_token
-            self._refresh_token = new_token.get('refresh_token')
-            # Tenant ID should remain the same, but clear just in case if needed
-            # self._tenant_id = None 
-            # TODO: Persist the refreshed token securely!
-            logger.debug(f"Refreshed Token Data: {self._access_token_data}")
-            return new_token
-        except Exception as e:
-            logger.exception(f"Error refreshing Xero OAuth token: {e}")
-            # Clear potentially invalid token data on failure?
-            # self._access_token_data = None
-            # self._refresh_token = None # Be careful not to lose the refresh token if it might still work
-            return None # Indicate failure
+            try:
+                logger.info("Attempting to refresh Xero OAuth token...")
+                # Use requests-oauthlib's refresh mechanism
+                new_token = session.refresh_token(
+                    XERO_TOKEN_URL,
+                    refresh_token=self._refresh_token,
+                    client_id=self.client_id,
+                    client_secret=self.client_secret
+                )
+                logger.info("Successfully refreshed Xero OAuth token.")
+                self._access_token_data = new_token
+                self._refresh_token = new_token.get('refresh_token')
+                # Tenant ID should remain the same, but clear just in case if needed
+                # self._tenant_id = None 
+                # TODO: Persist the refreshed token securely!
+                logger.debug("Refreshed Token Data: %s", self._access_token_data)
+                return new_token
+            except Exception as e:
+                logger.exception("Error refreshing Xero OAuth token: %s", e)
+                # Clear potentially invalid token data on failure?
+                # self._access_token_data = None
+                # self._refresh_token = None # Be careful not to lose the refresh token if it might still work
+                return None # Indicate failure
 
     def _ensure_token_valid(self) -> bool:
         """Checks if the token exists and attempts refresh if expired. Returns True if valid/refreshed, False otherwise."""
-        if not self._access_token_data:
-            logger.warning("No Xero access token data available.")
-            # Can we get one using a refresh token?
-            if self._refresh_token:
-                logger.info("Attempting initial token refresh using stored refresh token.")
-                refreshed_token = self.refresh_oauth_token()
-                return refreshed_token is not None
-            else:
-                logger.error("Authentication needed: No access token and no refresh token.")
-                return False
+        with self._token_lock:
+            if not self._access_token_data:
+                logger.warning("No Xero access token data available.")
+                # Can we get one using a refresh token?
+                if self._refresh_token:
+                    logger.info("Attempting initial token refresh using stored refresh token.")
+                    refreshed_token = self.refresh_oauth_token()
+                    return refreshed_token is not None
+                else:
+                    logger.error("Authentication needed: No access token and no refresh token.")
+                    return False
         
-        # Check expiry time (add buffer, e.g., 60 seconds)
-        expires_at = self._access_token_data.get('expires_at', 0)
-        if time.time() > expires_at - 60:
-            logger.info("Xero access token expired or nearing expiry, attempting refresh.")
-            refreshed_token = self.refresh_oauth_token()
-            if not refreshed_token:
-                logger.error("Token refresh failed.")
-                return False
-            else:
-                 logger.info("Token refresh successful.")
+            # Check expiry time (add buffer, e.g., 60 seconds)
+            expires_at = self._access_token_data.get('expires_at', 0)
+            if time.time() > expires_at - 60:
+                logger.info("Xero access token expired or nearing expiry, attempting refresh.")
+                refreshed_token = self.refresh_oauth_token()
+                if not refreshed_token:
+                    logger.error("Token refresh failed.")
+                    return False
+                else:
+                     logger.info("Token refresh successful.")
 
-        return True # Token exists and is likely valid (or was just refreshed)
+            return True # Token exists and is likely valid (or was just refreshed)
 
     def get_tenant_id(self) -> Optional[str]:
         """Get the active Xero Tenant ID using the connections endpoint."""
@@ -213,36 +223,40 @@ class XeroPythonService(XeroService):
         if self._tenant_id:
             return self._tenant_id
 
-        # Ensure token is valid before making API call
-        if not self._ensure_token_valid():
-            logger.error("Cannot fetch tenant ID: Invalid or missing token.")
-            return None
+        with self._token_lock:
+            if self._tenant_id: # Fetched by another thread while we waited
+                return self._tenant_id
 
-        # Use requests-oauthlib session to make the call
-        session = self._get_oauth_session(token=self._access_token_data)
-        try:
-            logger.info("Fetching Xero connections to get tenant ID...")
-            response = session.get(XERO_CONNECTIONS_URL)
-            response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-            connections = response.json()
-            logger.debug(f"Xero Connections Response: {connections}")
-            if connections and isinstance(connections, list) and len(connections) > 0:
-                # Assuming the first connection is the desired one
-                tenant_id = connections[0].get('tenantId')
-                if tenant_id:
-                    self._tenant_id = tenant_id
-                    logger.info(f"Fetched and cached Xero Tenant ID: {self._tenant_id}")
-                    # TODO: Persist the tenant ID if needed
-                    return self._tenant_id
+            # Ensure token is valid before making API call
+            if not self._ensure_token_valid():
+                logger.error("Cannot fetch tenant ID: Invalid or missing token.")
+                return None
+
+            # Use requests-oauthlib session to make the call
+            session = self._get_oauth_session(token=self._access_token_data)
+            try:
+                logger.info("Fetching Xero connections to get tenant ID...")
+                response = session.get(XERO_CONNECTIONS_URL)
+                response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
+                connections = response.json()
+                logger.debug("Xero Connections Response: %s", connections)
+                if connections and isinstance(connections, list) and len(connections) > 0:
+                    # Assuming the first connection is the desired one
+                    tenant_id = connections[0].get('tenantId')
+                    if tenant_id:
+                        self._tenant_id = tenant_id
+                        logger.info("Fetched and cached Xero Tenant ID: %s", self._tenant_id)
+                        # TODO: Persist the tenant ID if needed
+                        return self._tenant_id
+                    else:
+                        logger.warning("Tenant ID not found in the first connection.")
+                        return None
                 else:
-                    logger.warning("Tenant ID not found in the first connection.")
+                    logger.warning("Could not determine Tenant ID from connections response: %s", connections)
                     return None
-            else:
-                logger.warning(f"Could not determine Tenant ID from connections response: {connections}")
+            except Exception as e:
+                logger.exception("Error fetching Xero connections: %s", e)
                 return None
-        except Exception as e:
-            logger.exception(f"Error fetching Xero connections: {e}")
-            return None
 
     def _get_xero_api_client(self) -> Optional[AccountingApi]:
         """Initializes and returns the xero-python AccountingApi client."""
@@ -278,47 +292,48 @@ class XeroPythonService(XeroService):
             @api_client.oauth2_token_saver
             def save_token(token_dict):
                 logger.info("xero-python SDK internal token saver called.")
-                self._access_token_data = token_dict
-                self._refresh_token = token_dict.get('refresh_token')
+                with self._token_lock:
+                    self._access_token_data = token_dict
+                    self._refresh_token = token_dict.get('refresh_token')
                 # TODO: Persist the token securely immediately!
-                logger.debug(f"SDK Saved Token: {self._access_token_data}")
+                logger.debug("SDK Saved Token: %s", self._access_token_data)
 
             # Return the specific API we need (Accounting)
             return AccountingApi(api_client)
         except Exception as e:
-            logger.exception(f"Failed to initialize Xero API client: {e}")
+            logger.exception("Failed to initialize Xero API client: %s", e)
             return None
 
     def _find_contact(self, accounting_api: AccountingApi, tenant_id: str, name: str) -> Optional[str]:
         """Finds a Xero contact by name using xero-python, returns ContactID."""
         try:
-            logger.info(f"Searching for Xero contact with name: '{name}'")
+            logger.info("Searching for Xero contact with name: '%s'", name)
             # Use where clause for filtering
             where_filter = f'Name=="{name}"'
             contacts_response = accounting_api.get_contacts(tenant_id, where=where_filter)
             
             if contacts_response and contacts_response.contacts and len(contacts_response.contacts) > 0:
                 contact_id = contacts_response.contacts[0].contact_id
-                logger.info(f"Found existing Xero contact '{name}' with ID: {contact_id}")
+                logger.info("Found existing Xero contact '%s' with ID: %s", name, contact_id)
                 return str(contact_id) # Return as string
             else:
-                logger.info(f"No existing Xero contact found for '{name}'.")
+                logger.info("No existing Xero contact found for '%s'.", name)
                 return None
         except ApiException as e:
              # Handle specific API errors, e.g., 404 Not Found might be expected if contact doesn't exist
             if e.status == 404:
-                 logger.info(f"No existing Xero contact found for '{name}' (API 404).")
+                 logger.info("No existing Xero contact found for '%s' (API 404).", name)
                  return None
-            logger.exception(f"API Error searching for Xero contact '{name}': Status {e.status}, Body: {e.body}")
+            logger.exception("API Error searching for Xero contact '%s': Status %s, Body: %s", name, e.status, e.body)
             return None
         except Exception as e:
-            logger.exception(f"Unexpected error searching for Xero contact '{name}': {e}")
+            logger.exception("Unexpected error searching for Xero contact '%s': %s", name, e)
             return None
 
     def _create_contact(self, accounting_api: AccountingApi, tenant_id: str, name: str) -> Optional[str]:
         """Creates a new Xero contact using xero-python, returns ContactID."""
         try:
-            logger.info(f"Creating new Xero contact with name: '{name}'")
+            logger.info("Creating new Xero contact with name: '%s'", name)
             new_contact = Contact(name=name)
             contacts_to_create = Contacts(contacts=[new_contact])
             created_contacts_response = accounting_api.create_contacts(tenant_id, contacts=contacts_to_create)
@@ -327,57 +342,52 @@ class XeroPythonService(XeroService):
                 # Check for errors within the contact response items if needed
                 contact_id = created_contacts_response.contacts[0].contact_id
                 if contact_id:
-                    logger.info(f"Successfully created new Xero contact '{name}' with ID: {contact_id}")
+                    logger.info("Successfully created new Xero contact '%s' with ID: %s", name, contact_id)
                     return str(contact_id)
                 else:
-                    logger.error(f"Failed to create Xero contact '{name}'. Response item lacked ID: {created_contacts_response.contacts[0]}")
+                    logger.error("Failed to create Xero contact '%s'. Response item lacked ID: %s", name, created_contacts_response.contacts[0])
                     return None
             else:
-                logger.error(f"Failed to create Xero contact '{name}'. Response: {created_contacts_response}")
+                logger.error("Failed to create Xero contact '%s'. Response: %s", name, created_contacts_response)
                 return None
         except AccountingBadRequestException as e:
-            logger.exception(f"Bad Request Error creating Xero contact '{name}': Status {e.status}, Body: {e.body}")
+            logger.exception("Bad Request Error creating Xero contact '%s': Status %s, Body: %s", name, e.status, e.body)
             # Parse e.body which might contain specific validation errors
             return None
         except ApiException as e:
-            logger.exception(f"API Error creating Xero contact '{name}': Status {e.status}, Body: {e.body}")
+            logger.exception("API Error creating Xero contact '%s': Status %s, Body: %s", name, e.status, e.body)
             return None
         except Exception as e:
-            logger.exception(f"Unexpected error creating Xero contact '{name}': {e}")
+            logger.exception("Unexpected error creating Xero contact '%s': %s", name, e)
             return None
 
     def _get_account_code(self, accounting_api: AccountingApi, tenant_id: str, category_name: str) -> Optional[str]:
         """Maps internal category name to Xero Account Code using config or Xero data."""
         # Option 1: Simple mapping from config (less flexible, requires maintenance)
-        account_map_str = settings.XERO_ACCOUNT_CODE_MAP
-        account_map = {}
-        if account_map_str:
-            try:
-                account_map = json.loads(account_map_str)
-            except json.JSONDecodeError:
-                logger.error("Failed to parse XERO_ACCOUNT_CODE_MAP from settings. Ensure it's valid JSON.")
-        
+        # Settings already parses XERO_ACCOUNT_CODE_MAP into a dict
+        account_map = settings.XERO_ACCOUNT_CODE_MAP or {}
+
         code = account_map.get(category_name)
         if code:
-            logger.info(f"Mapped category '{category_name}' to Xero Account Code: {code} using config map.")
+            logger.info("Mapped category '%s' to Xero Account Code: %s using config map.", category_name, code)
             return str(code)
         else:
-            logger.warning(f"Category '{category_name}' not found in XERO_ACCOUNT_CODE_MAP.")
+            logger.warning("Category '%s' not found in XERO_ACCOUNT_CODE_MAP.", category_name)
             # Option 2: Fallback - Query Xero Chart of Accounts (more robust, slower)
             # try:
-            #     logger.info(f"Querying Xero Chart of Accounts for category '{category_name}'...")
+            #     logger.info("Querying Xero Chart of Accounts for category '%s'...", category_name)
             #     # Search for an EXPENSE account matching the category name
             #     where_filter = f'Type=="EXPENSE" AND Name=="{category_name}"'
             #     accounts_response = accounting_api.get_accounts(tenant_id, where=where_filter)
             #     if accounts_response and accounts_response.accounts and len(accounts_response.accounts) > 0:
             #         account_code = accounts_response.accounts[0].code
-            #         logger.info(f"Found matching Xero Account Code: {account_code} via API lookup.")
+            #         logger.info("Found matching Xero Account Code: %s via API lookup.", account_code)
             #         return str(account_code)
             #     else:
-            #         logger.warning(f"No Xero EXPENSE account found matching name '{category_name}'.")
+            #         logger.warning("No Xero EXPENSE account found matching name '%s'.", category_name)
             #         return None
             # except Exception as e:
-            #     logger.exception(f"Error querying Xero accounts for category '{category_name}': {e}")
+            #     logger.exception("Error querying Xero accounts for category '%s': %s", category_name, e)
             #     return None
             return None # Return None if not found in map (and API lookup is disabled/failed)
 
@@ -399,10 +409,10 @@ class XeroPythonService(XeroService):
             if parsed_date:
                 return parsed_date.strftime("%Y-%m-%d")
             else:
-                 logger.warning(f"Could not parse date string: {date_input}")
+                 logger.warning("Could not parse date string: %s", date_input)
                  return None # Or return original string if Xero might handle it?
         except Exception as e:
-            logger.exception(f"Error formatting date '{date_input}': {e}")
+            logger.exception("Error formatting date '%s': %s", date_input, e)
             return None
 
     def create_draft_bill(self, invoice_data: ExtractedInvoiceData, category: str) -> Optional[Dict[str, Any]]:
@@ -425,13 +435,13 @@ class XeroPythonService(XeroService):
                 contact_id = self._create_contact(accounting_api, tenant_id, invoice_data.vendor_name)
             
             if not contact_id:
-                logger.error(f"Failed to find or create Xero contact for '{invoice_data.vendor_name}'. Cannot create bill.")
+                logger.error("Failed to find or create Xero contact for '%s'. Cannot create bill.", invoice_data.vendor_name)
                 return None # Cannot proceed without a contact
 
             # 2. Map Category to Account Code
             account_code = self._get_account_code(accounting_api, tenant_id, category)
             if not account_code:
-                 logger.warning(f"Proceeding without account code for category '{category}'. Bill line item will need manual coding.")
+                 logger.warning("Proceeding without account code for category '%s'. Bill line item will need manual coding.", category)
 
             # 3. Prepare Line Items using xero-python models
             line_items_payload = []
@@ -466,7 +476,7 @@ class XeroPythonService(XeroService):
                 
             # Check if extracted total matches sum of lines (if both exist)
             if invoice_data.total_amount is not None and abs(invoice_data.total_amount - total_from_lines) > 0.01:
-                 logger.warning(f"Extracted total ({invoice_data.total_amount}) does not match sum of lines ({total_from_lines}). Using extracted total if available.")
+                 logger.warning("Extracted total (%s) does not match sum of lines (%s). Using extracted total if available.", invoice_data.total_amount, total_from_lines)
 
             # 4. Construct Invoice Payload using xero-python models
             invoice_payload = {
@@ -489,8 +499,8 @@ class XeroPythonService(XeroService):
             invoice_object = Invoice(**cleaned_payload)
             invoices_to_create = Invoices(invoices=[invoice_object])
 
-            logger.info(f"Submitting draft bill to Xero...")
-            logger.debug(f"Xero Invoice Payload: {invoices_to_create.to_dict()}")
+            logger.info("Submitting draft bill to Xero...")
+            logger.debug("Xero Invoice Payload: %s", invoices_to_create.to_dict())
 
             # 5. Create the Bill using the API
             created_invoices_response = accounting_api.create_invoices(tenant_id, invoices=invoices_to_create)
@@ -500,38 +510,38 @@ class XeroPythonService(XeroService):
                 created_invoice = created_invoices_response.invoices[0]
                 if created_invoice.invoice_id and not created_invoice.has_errors:
                     bill_id = str(created_invoice.invoice_id)
-                    logger.info(f"Successfully created draft bill in Xero with ID: {bill_id}")
+                    logger.info("Successfully created draft bill in Xero with ID: %s", bill_id)
                     # TODO: Attach the original PDF to the bill
                     return created_invoice.to_dict() # Return the created invoice details
                 else:
-                    logger.error(f"Failed to create draft bill in Xero. Response indicates errors: {created_invoice.validation_errors}")
+                    logger.error("Failed to create draft bill in Xero. Response indicates errors: %s", created_invoice.validation_errors)
                     return None
             else:
-                logger.error(f"Failed to create draft bill in Xero. Unexpected response: {created_invoices_response}")
+                logger.error("Failed to create draft bill in Xero. Unexpected response: %s", created_invoices_response)
                 return None
 
         except AccountingBadRequestException as e:
-             logger.exception(f"Bad Request Error creating Xero bill: Status {e.status}, Body: {e.body}")
+             logger.exception("Bad Request Error creating Xero bill: Status %s, Body: %s", e.status, e.body)
              # Try to log specific validation errors if possible
              try:
                  error_details = json.loads(e.body)
-                 logger.error(f"Xero Validation Errors: {error_details.get('Elements', [])}")
+                 logger.error("Xero Validation Errors: %s", error_details.get('Elements', []))
              except:
                  pass
              return None
         except ApiException as e:
             # Handle potential token expiry error not caught by pre-check/refresh
             if e.status == 401: # Unauthorized
-                 logger.warning(f"Xero API returned 401 Unauthorized. Token might be invalid or expired despite checks. Status: {e.status}")
+                 logger.warning("Xero API returned 401 Unauthorized. Token might be invalid or expired despite checks. Status: %s", e.status)
                  # Optionally attempt one more refresh? Or just fail.
             else:
-                 logger.exception(f"API Error creating Xero bill: Status {e.status}, Body: {e.body}")
+                 logger.exception("API Error creating Xero bill: Status %s, Body: %s", e.status, e.body)
             return None
         except TokenExpiredError: # Should be caught by _ensure_token_valid ideally
              logger.warning("Xero token expired during operation (TokenExpiredError caught).")
              return None # Rely on the next call to trigger refresh
         except Exception as e:
-            logger.exception(f"An unexpected error occurred creating Xero draft bill: {e}")
+            logger.exception("An unexpected error occurred creating Xero draft bill: %s", e)
             return None
 
 # --- Service Factory (similar to other services) ---
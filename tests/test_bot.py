@@ -1 +1,101 @@
+import importlib
+import sys
+from contextlib import ExitStack
+import pytest
+from unittest.mock import patch, MagicMock
 
+import config
+
+# main.py builds the GCF adapter at import time, which needs Flask (provided by the Functions runtime)
+pytest.importorskip("flask")
+
+# --- Test Data ---
+DUMMY_FILE_ID = "F123"
+DUMMY_USER_ID = "U123"
+DUMMY_CHANNEL_ID = "C123"
+DUMMY_BUCKET = "dummy-bucket"
+DUMMY_PDF_BYTES = b"%PDF-1.4 dummy"
+
+BOT_ENV = {
+    "SECRET_MANAGER_ENABLED": "false",
+    "TEST_SKIP_GCP": "true",
+    "SLACK_BOT_TOKEN": "xoxb-dummy",
+    "SLACK_SIGNING_SECRET": "dummy-signing-secret",
+    "MISTRAL_API_KEY": "dummy-mistral-key", # Core config; main.py refuses to start without it
+    "OPENAI_API_KEY": "dummy-openai-key",
+    "TEMP_STORAGE_BUCKET_NAME": DUMMY_BUCKET,
+    "KEEP_INVOICE_COPY": "true",
+}
+
+# --- Fixtures ---
+@pytest.fixture
+def main_module(monkeypatch):
+    """Imports main.py against env-based settings, with the startup Slack auth.test call mocked out."""
+    for name, value in BOT_ENV.items():
+        monkeypatch.setenv(name, value)
+    config.get_settings.cache_clear()
+    sys.modules.pop("main", None)
+    with patch("slack_sdk.WebClient.auth_test", return_value={"ok": True, "user_id": "UBOT", "bot_id": "BBOT", "team_id": "T1"}):
+        main = importlib.import_module("main")
+    yield main
+    sys.modules.pop("main", None)
+    config.get_settings.cache_clear()
+
+def _file_shared_body(file_id=DUMMY_FILE_ID):
+    return {"event": {"file_id": file_id, "user_id": DUMMY_USER_ID, "channel_id": DUMMY_CHANNEL_ID}}
+
+def _slack_client():
+    client = MagicMock()
+    client.token = "xoxb-dummy"
+    client.files_info.return_value = {"ok": True, "file": {"filetype": "pdf", "name": "invoice.pdf", "url_private_download": "https://files.slack.com/x"}}
+    return client
+
+def _services(main):
+    """Patches the OCR/categorization/Xero factories with mocks that succeed."""
+    categorized = MagicMock(vendor_name="Test Vendor", total_amount=10.0, currency="USD", category="Travel")
+    xero = MagicMock()
+    xero.create_draft_expense.return_value = "BILL-1"
+    return [
+        patch.object(main, "_ocr", return_value=MagicMock()),
+        patch.object(main, "_cat", return_value=MagicMock(**{"categorize.return_value": categorized})),
+        patch.object(main, "_xero", return_value=xero),
+        patch.object(main, "download_file_from_slack", return_value=bytearray(DUMMY_PDF_BYTES)),
+    ]
+
+# --- Test Cases ---
+
+def test_handle_file_shared_keeps_invoice_copy(main_module):
+    """Test that KEEP_INVOICE_COPY=true uploads the invoice to the temp bucket and cleans it up after success."""
+    say = MagicMock()
+    patches = _services(main_module) + [
+        patch.object(main_module, "_gcs", return_value=MagicMock()),
+        patch.object(main_module, "upload_to_gcs", return_value=f"gs://{DUMMY_BUCKET}/x"),
+        patch.object(main_module, "delete_from_gcs"),
+    ]
+    with ExitStack() as stack:
+        for p in patches:
+            stack.enter_context(p)
+        main_module.handle_file_shared(body=_file_shared_body(), client=_slack_client(), ack=MagicMock(), say=say)
+        blob_name = f"invoices/{DUMMY_USER_ID}/{DUMMY_FILE_ID}-invoice.pdf"
+        main_module.upload_to_gcs.assert_called_once_with(DUMMY_BUCKET, bytearray(DUMMY_PDF_BYTES), blob_name)
+        assert main_module.delete_from_gcs.call_args.args == (DUMMY_BUCKET, blob_name)
+
+    assert "Success!" in say.call_args.kwargs["text"]
+
+def test_failed_file_can_be_reshared(main_module):
+    """Test that a failed attempt drops the file's seen-claim, so sharing it again reprocesses it."""
+    say = MagicMock()
+    with ExitStack() as stack:
+        for p in _services(main_module) + [patch.object(main_module, "_gcs", return_value=None)]:
+            stack.enter_context(p)
+        extract = main_module._ocr.return_value.extract
+        extract.side_effect = [None, MagicMock(vendor_name="Test Vendor")]
+
+        main_module.handle_file_shared(body=_file_shared_body(), client=_slack_client(), ack=MagicMock(), say=say)
+        assert "OCR process failed" in say.call_args.kwargs["text"]
+        main_module.handle_file_shared(body=_file_shared_body(), client=_slack_client(), ack=MagicMock(), say=say)
+        assert "Success!" in say.call_args.kwargs["text"]
+        # Once processed, the file is claimed for good
+        main_module.handle_file_shared(body=_file_shared_body(), client=_slack_client(), ack=MagicMock(), say=say)
+
+    assert extract.call_count == 2
@@ -2,26 +2,37 @@
 Unit tests for the LLM-based Invoice Categorization service.
 """
 
+import asyncio
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 import json
+import httpx
 import openai # Import the openai library itself for error types
 
 # Import the class and models to test
-from services.categorization import InvoiceCategorizer, CategorizationResult
-from services.ocr import ExtractedInvoiceData
+import services.categorization
+import services.categorize
+from services.categorization import InvoiceCategorizer, CategorizationResult, compact_line_items
+from services.ocr import ExtractedInvoiceData, LineItem
 
 # Dummy data for tests
 ALLOWED_CATEGORIES = ["Software & Subscriptions", "Office Supplies", "Travel", "Marketing & Advertising"]
 COMPANY_CONTEXT = "Test Company Context"
 DUMMY_INVOICE_DATA = ExtractedInvoiceData.model_validate({
-    "vendor": "Test Vendor",
-    "total": 100.00,
-    "date": "2024-01-01"
+    "vendor_name": "Test Vendor",
+    "total_amount": 100.00,
+    "issue_date": "2024-01-01",
+    "line_items": []
 })
 
 class TestInvoiceCategorizerLLM(unittest.TestCase):
 
+    def setUp(self):
+        # Clients are process-wide singletons; drop them so each test's patched OpenAI class is used
+        services.categorization._openai_clients.clear()
+        services.categorization._async_openai_clients.clear()
+        services.categorization._result_cache.clear()
+
     def _create_mock_openai_response(self, response_json: dict):
         """Helper to create a mock OpenAI completion object."""
         mock_completion = MagicMock()
@@ -32,12 +43,16 @@ class TestInvoiceCategorizerLLM(unittest.TestCase):
         mock_completion.choices = [mock_choice]
         return mock_completion
 
+    def _create_mock_openai_body(self, response_json: dict) -> dict:
+        """Helper to build a chat completion body as it appears in Batch API output."""
+        return {"choices": [{"message": {"role": "assistant", "content": json.dumps(response_json)}}]}
+
     @patch('services.categorization.openai.OpenAI')
     @patch('services.categorization.settings')
     def test_categorize_successful_match(self, mock_settings, mock_openai_cls):
         """Test successful categorization with a matched category."""
         # Configure the mock_settings object BEFORE InvoiceCategorizer uses it
-        mock_settings.CATEGORIZATION_PROVIDER = 'openai'
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
         mock_settings.OPENAI_API_KEY = 'fake-key'
         mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
         mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
@@ -69,7 +84,7 @@ class TestInvoiceCategorizerLLM(unittest.TestCase):
     def test_categorize_not_matched_no_suggestion(self, mock_settings, mock_openai_cls):
         """Test categorization when LLM cannot match and provides no suggestion."""
         # Configure the mock_settings object
-        mock_settings.CATEGORIZATION_PROVIDER = 'openai'
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
         mock_settings.OPENAI_API_KEY = 'fake-key'
         mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
         mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
@@ -97,7 +112,7 @@ class TestInvoiceCategorizerLLM(unittest.TestCase):
     def test_categorize_not_matched_with_suggestion(self, mock_settings, mock_openai_cls):
         """Test categorization when LLM cannot match but suggests a new category."""
         # Configure the mock_settings object
-        mock_settings.CATEGORIZATION_PROVIDER = 'openai'
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
         mock_settings.OPENAI_API_KEY = 'fake-key'
         mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
         mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
@@ -125,7 +140,7 @@ class TestInvoiceCategorizerLLM(unittest.TestCase):
     def test_categorize_llm_suggests_invalid_category(self, mock_settings, mock_openai_cls):
         """Test when LLM returns status 'matched' but with a category not in the allowed list."""
         # Configure the mock_settings object
-        mock_settings.CATEGORIZATION_PROVIDER = 'openai'
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
         mock_settings.OPENAI_API_KEY = 'fake-key'
         mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
         mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
@@ -156,7 +171,7 @@ class TestInvoiceCategorizerLLM(unittest.TestCase):
     def test_categorize_openai_api_error(self, mock_settings, mock_openai_cls):
         """Test handling of an OpenAI APIError."""
         # Configure the mock_settings object
-        mock_settings.CATEGORIZATION_PROVIDER = 'openai'
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
         mock_settings.OPENAI_API_KEY = 'fake-key'
         mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
         mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
@@ -178,7 +193,7 @@ class TestInvoiceCategorizerLLM(unittest.TestCase):
     def test_categorize_invalid_json_response(self, mock_settings, mock_openai_cls):
         """Test handling when OpenAI returns non-JSON content."""
         # Configure the mock_settings object
-        mock_settings.CATEGORIZATION_PROVIDER = 'openai'
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
         mock_settings.OPENAI_API_KEY = 'fake-key'
         mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
         mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
@@ -204,7 +219,7 @@ class TestInvoiceCategorizerLLM(unittest.TestCase):
     def test_categorize_pydantic_validation_error(self, mock_settings, mock_openai_cls):
         """Test handling when OpenAI returns JSON with incorrect structure/types."""
         # Configure the mock_settings object
-        mock_settings.CATEGORIZATION_PROVIDER = 'openai'
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
         mock_settings.OPENAI_API_KEY = 'fake-key'
         mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
         mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
@@ -228,7 +243,7 @@ class TestInvoiceCategorizerLLM(unittest.TestCase):
     def test_categorize_initialization_failure_no_key(self, mock_settings):
         """Test categorization fails if OpenAI key is missing."""
         # Configure the mock_settings object
-        mock_settings.CATEGORIZATION_PROVIDER = 'openai'
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
         mock_settings.OPENAI_API_KEY = None # No API Key
         # We also need ALLOWED_CATEGORIES and COMPANY_CONTEXT, even if API key is missing, 
         # because __init__ reads them before checking the key.
@@ -246,7 +261,7 @@ class TestInvoiceCategorizerLLM(unittest.TestCase):
     def test_categorize_unsupported_provider(self, mock_settings):
         """Test categorization fails gracefully if provider is not 'openai'."""
         # Configure the mock_settings object
-        mock_settings.CATEGORIZATION_PROVIDER = 'mistral' # Unsupported
+        mock_settings.CATEGORIZATION_SERVICE = 'mistral' # Unsupported
         mock_settings.OPENAI_API_KEY = 'fake-key'
         mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
         mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
@@ -257,5 +272,333 @@ class TestInvoiceCategorizerLLM(unittest.TestCase):
         self.assertEqual(result.status, 'error')
         self.assertIn("provider 'mistral' not supported or not initialized", result.notes)
 
+    @patch('services.categorization.openai.AsyncOpenAI')
+    @patch('services.categorization.openai.OpenAI')
+    @patch('services.categorization.settings')
+    def test_categorize_many_async_runs_concurrently(self, mock_settings, mock_openai_cls, mock_async_openai_cls):
+        """Test the async path awaits AsyncOpenAI (not the sync client) and keeps input order."""
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
+        mock_settings.OPENAI_API_KEY = 'fake-key'
+        mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
+        mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
+        mock_settings.OPENAI_MAX_CONCURRENCY = 2
+
+        mock_async_instance = MagicMock()
+        mock_async_instance.chat.completions.create = AsyncMock(side_effect=[
+            self._create_mock_openai_response({"status": "matched", "assigned_category": "Travel"}),
+            self._create_mock_openai_response({"status": "not_matched", "assigned_category": None}),
+        ])
+        mock_async_openai_cls.return_value = mock_async_instance
+
+        categorizer = InvoiceCategorizer()
+        other = DUMMY_INVOICE_DATA.model_copy(update={"vendor_name": "Other Vendor"}) # Distinct, so not a cache hit
+        results = asyncio.run(categorizer.categorize_many_async([DUMMY_INVOICE_DATA, other]))
+
+        self.assertEqual(mock_async_instance.chat.completions.create.await_count, 2)
+        mock_openai_cls.return_value.chat.completions.create.assert_not_called()
+        self.assertEqual([r.status for r in results], ['matched', 'not_matched'])
+
+    @patch('services.categorization.openai.OpenAI')
+    @patch('services.categorization.settings')
+    def test_categorize_batch_in_one_call_groups_invoices(self, mock_settings, mock_openai_cls):
+        """Test that k invoices share one completion and results are dispatched by id."""
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
+        mock_settings.OPENAI_API_KEY = 'fake-key'
+        mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
+        mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
+
+        mock_openai_instance = MagicMock()
+        mock_openai_instance.chat.completions.create.side_effect = [
+            # First group of two: answered out of order
+            self._create_mock_openai_response({"results": [
+                {"id": "1", "status": "not_matched", "assigned_category": None},
+                {"id": "0", "status": "matched", "assigned_category": "Office Supplies"},
+            ]}),
+            # Second group of one: the model left the invoice out
+            self._create_mock_openai_response({"results": []}),
+        ]
+        mock_openai_cls.return_value = mock_openai_instance
+
+        categorizer = InvoiceCategorizer()
+        results = categorizer.categorize_batch_in_one_call([DUMMY_INVOICE_DATA] * 3, k=2)
+
+        self.assertEqual(mock_openai_instance.chat.completions.create.call_count, 2)
+        self.assertEqual([r.status for r in results], ['matched', 'not_matched', 'error'])
+        self.assertEqual(results[0].assigned_category, 'Office Supplies')
+
+    @patch('services.categorization.time.sleep')
+    @patch('services.categorization.openai.OpenAI')
+    @patch('services.categorization.settings')
+    def test_categorize_many_uses_batch_api(self, mock_settings, mock_openai_cls, mock_sleep):
+        """Test that categorize_many submits one batch job and maps results back by custom_id."""
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
+        mock_settings.OPENAI_API_KEY = 'fake-key'
+        mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
+        mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
+        mock_settings.CATEGORIZATION_MODEL = 'gpt-4o-mini' # Serialized into the batch JSONL
+
+        mock_openai_instance = MagicMock()
+        mock_openai_instance.batches.create.return_value = MagicMock(id="batch_1", status="in_progress")
+        mock_openai_instance.batches.retrieve.return_value = MagicMock(id="batch_1", status="completed", output_file_id="file_out")
+        # Results come back out of order; the second invoice's request failed
+        output_lines = [
+            {"custom_id": "1", "response": {"status_code": 500, "body": {}}, "error": None},
+            {"custom_id": "0", "response": {"status_code": 200, "body": self._create_mock_openai_body({
+                "status": "matched", "assigned_category": "Travel", "suggested_new_category": None, "notes": None})}, "error": None},
+        ]
+        mock_openai_instance.files.content.return_value.text = "\n".join(json.dumps(line) for line in output_lines)
+        mock_openai_cls.return_value = mock_openai_instance
+
+        categorizer = InvoiceCategorizer()
+        results = categorizer.categorize_many([DUMMY_INVOICE_DATA, DUMMY_INVOICE_DATA])
+
+        mock_openai_instance.files.create.assert_called_once()
+        mock_openai_instance.batches.create.assert_called_once()
+        mock_openai_instance.chat.completions.create.assert_not_called()
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0].status, 'matched')
+        self.assertEqual(results[0].assigned_category, 'Travel')
+        self.assertEqual(results[1].status, 'error')
+
+    @patch('services.categorization.time.sleep')
+    @patch('services.categorization.openai.OpenAI')
+    @patch('services.categorization.settings')
+    def test_categorize_many_tolerates_bad_lines_and_caches_results(self, mock_settings, mock_openai_cls, mock_sleep):
+        """Test that a malformed batch output line only fails its own invoice, and good results are cached."""
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
+        mock_settings.OPENAI_API_KEY = 'fake-key'
+        mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
+        mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
+        mock_settings.CATEGORIZATION_MODEL = 'gpt-4o-mini'
+
+        mock_openai_instance = MagicMock()
+        mock_openai_instance.batches.create.return_value = MagicMock(id="batch_1", status="completed", output_file_id="file_out")
+        output_lines = [
+            json.dumps({"custom_id": "0", "response": {"status_code": 200, "body": self._create_mock_openai_body({
+                "status": "matched", "assigned_category": "Travel"})}, "error": None}),
+            json.dumps({"custom_id": "1", "response": {"status_code": 200, "body": {"choices": []}}, "error": None}),
+            '{"custom_id": "2", "respo', # Truncated line
+        ]
+        mock_openai_instance.files.content.return_value.text = "\n".join(output_lines)
+        mock_openai_cls.return_value = mock_openai_instance
+
+        categorizer = InvoiceCategorizer()
+        invoices = [DUMMY_INVOICE_DATA.model_copy(update={"vendor_name": name}) for name in ("Vendor A", "Vendor B", "Vendor C")]
+        results = categorizer.categorize_many(invoices)
+
+        self.assertEqual([r.status for r in results], ['matched', 'error', 'error'])
+        self.assertEqual(results[0].assigned_category, 'Travel')
+        # The matched invoice is now answered from the cache without another job
+        self.assertEqual(categorizer.categorize_many(invoices[:1])[0].assigned_category, 'Travel')
+        mock_openai_instance.batches.create.assert_called_once()
+
+    @patch('services.categorization.time.sleep')
+    @patch('services.categorization.openai.OpenAI')
+    @patch('services.categorization.settings')
+    def test_categorize_many_cancels_timed_out_batch(self, mock_settings, mock_openai_cls, mock_sleep):
+        """Test that a batch still running at the timeout is cancelled and its invoices marked as errors."""
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
+        mock_settings.OPENAI_API_KEY = 'fake-key'
+        mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
+        mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
+        mock_settings.CATEGORIZATION_MODEL = 'gpt-4o-mini'
+
+        mock_openai_instance = MagicMock()
+        mock_openai_instance.batches.create.return_value = MagicMock(id="batch_1", status="in_progress")
+        mock_openai_cls.return_value = mock_openai_instance
+
+        categorizer = InvoiceCategorizer()
+        results = categorizer.categorize_many([DUMMY_INVOICE_DATA], timeout=0)
+
+        mock_openai_instance.batches.cancel.assert_called_once_with("batch_1")
+        mock_openai_instance.files.content.assert_not_called()
+        self.assertEqual(results[0].status, 'error')
+
+    @patch('services.categorization.openai.OpenAI')
+    @patch('services.categorization.settings')
+    def test_categorize_streaming_stops_after_matched_category(self, mock_settings, mock_openai_cls):
+        """Test that early-exit streaming closes the stream once a matched category has arrived."""
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
+        mock_settings.OPENAI_API_KEY = 'fake-key'
+        mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
+        mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
+        mock_settings.CATEGORIZATION_EARLY_EXIT = True
+
+        pieces = ['{"status": "mat', 'ched", "assigned_', 'category": "Travel"', ', "notes": "long', ' explanation"}']
+        chunks = []
+        for piece in pieces:
+            chunk = MagicMock()
+            chunk.choices[0].delta.content = piece
+            chunks.append(chunk)
+        mock_stream = MagicMock()
+        mock_stream.__iter__.return_value = iter(chunks)
+        mock_openai_instance = MagicMock()
+        mock_openai_instance.chat.completions.create.return_value = mock_stream
+        mock_openai_cls.return_value = mock_openai_instance
+
+        categorizer = InvoiceCategorizer()
+        result = categorizer.categorize(DUMMY_INVOICE_DATA)
+
+        self.assertTrue(mock_openai_instance.chat.completions.create.call_args.kwargs["stream"])
+        mock_stream.close.assert_called_once()
+        self.assertEqual(result.status, 'matched')
+        self.assertEqual(result.assigned_category, 'Travel')
+        self.assertIsNone(result.notes) # Stream was abandoned before the notes
+
+    def test_compact_line_items_merges_truncates_and_caps(self):
+        """Test the shared prompt formatter drops noise, merges duplicates and caps the item count."""
+        items = [
+            LineItem(description="Hosting", amount=10.0),
+            LineItem(description="Hosting", amount=15.0),
+            LineItem(description="Discount", amount=0.0),
+            LineItem(description=None, amount=99.0),
+            LineItem(description="X" * 200, amount=5.0),
+            LineItem(description="Support", amount=-40.0),
+        ]
+
+        compact = compact_line_items(items, max_items=2, desc_chars=20)
+
+        self.assertEqual(compact, ["Support (-40.0)", "Hosting (25.0)", "... +1 more"])
+        self.assertEqual(compact_line_items(items[4:5], desc_chars=20), ["X" * 20 + " (5.0)"])
+
+    @patch('services.categorization.time.sleep')
+    @patch('services.categorization.openai.OpenAI')
+    @patch('services.categorization.settings')
+    def test_categorize_retries_rate_limit_honoring_retry_after(self, mock_settings, mock_openai_cls, mock_sleep):
+        """Test that a 429 is retried after the server's retry-after delay."""
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
+        mock_settings.OPENAI_API_KEY = 'fake-key'
+        mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
+        mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
+
+        rate_limited = httpx.Response(429, headers={"retry-after": "2"}, request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+        mock_openai_instance = MagicMock()
+        mock_openai_instance.chat.completions.create.side_effect = [
+            openai.RateLimitError("Rate limit reached", response=rate_limited, body=None),
+            self._create_mock_openai_response({"status": "matched", "assigned_category": "Travel"}),
+        ]
+        mock_openai_cls.return_value = mock_openai_instance
+
+        categorizer = InvoiceCategorizer()
+        result = categorizer.categorize(DUMMY_INVOICE_DATA)
+
+        self.assertEqual(mock_openai_instance.chat.completions.create.call_count, 2)
+        mock_sleep.assert_called_once_with(2.0)
+        self.assertEqual(result.status, 'matched')
+
+    @patch('services.categorization.openai.OpenAI')
+    @patch('services.categorization.settings')
+    def test_vendor_rule_skips_llm(self, mock_settings, mock_openai_cls):
+        """Test that a vendor rule answers locally and only unmatched invoices reach OpenAI."""
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
+        mock_settings.OPENAI_API_KEY = 'fake-key'
+        mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
+        mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
+        mock_settings.VENDOR_CATEGORY_RULES = {"Test Vendor": "Travel", "Other": "Not An Allowed Category"}
+
+        mock_openai_instance = MagicMock()
+        mock_openai_instance.chat.completions.create.return_value = self._create_mock_openai_response({
+            "results": [{"id": "0", "status": "matched", "assigned_category": "Office Supplies"}]})
+        mock_openai_cls.return_value = mock_openai_instance
+
+        categorizer = InvoiceCategorizer()
+        result = categorizer.categorize(DUMMY_INVOICE_DATA.model_copy(update={"vendor_name": "TEST VENDOR Ltd"}))
+        mock_openai_instance.chat.completions.create.assert_not_called()
+        self.assertEqual(result.status, 'matched')
+        self.assertEqual(result.assigned_category, 'Travel')
+
+        other = DUMMY_INVOICE_DATA.model_copy(update={"vendor_name": "Other Co"}) # Rule ignored: category not allowed
+        results = categorizer.categorize_batch_in_one_call([DUMMY_INVOICE_DATA, other])
+        mock_openai_instance.chat.completions.create.assert_called_once()
+        self.assertEqual([r.assigned_category for r in results], ['Travel', 'Office Supplies'])
+
+    @patch('services.categorization.openai.OpenAI')
+    @patch('services.categorization.settings')
+    def test_vendor_rule_matches_whole_words_only(self, mock_settings, mock_openai_cls):
+        """Test that a rule pattern inside a longer word ("uber" in "Huber") doesn't skip the LLM."""
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
+        mock_settings.OPENAI_API_KEY = 'fake-key'
+        mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
+        mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
+        mock_settings.VENDOR_CATEGORY_RULES = {"uber": "Travel", "aws": "Software & Subscriptions"}
+
+        mock_openai_instance = MagicMock()
+        mock_openai_instance.chat.completions.create.return_value = self._create_mock_openai_response(
+            {"status": "matched", "assigned_category": "Office Supplies"})
+        mock_openai_cls.return_value = mock_openai_instance
+
+        categorizer = InvoiceCategorizer()
+        for vendor in ("Huber Consulting", "Shaws Ltd"):
+            result = categorizer.categorize(DUMMY_INVOICE_DATA.model_copy(update={"vendor_name": vendor}))
+            self.assertEqual(result.assigned_category, 'Office Supplies')
+        self.assertEqual(mock_openai_instance.chat.completions.create.call_count, 2)
+
+        result = categorizer.categorize(DUMMY_INVOICE_DATA.model_copy(update={"vendor_name": "Uber B.V."}))
+        self.assertEqual(result.assigned_category, 'Travel')
+        self.assertEqual(mock_openai_instance.chat.completions.create.call_count, 2)
+
+    @patch('services.categorization.openai.OpenAI')
+    @patch('services.categorization.settings')
+    def test_repeat_invoice_served_from_cache(self, mock_settings, mock_openai_cls):
+        """Test that a repeat invoice (same vendor/items, similar total) reuses the cached result."""
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
+        mock_settings.OPENAI_API_KEY = 'fake-key'
+        mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
+        mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
+
+        mock_openai_instance = MagicMock()
+        mock_openai_instance.chat.completions.create.return_value = self._create_mock_openai_response(
+            {"status": "matched", "assigned_category": "Travel"})
+        mock_openai_cls.return_value = mock_openai_instance
+
+        categorizer = InvoiceCategorizer()
+        first = categorizer.categorize(DUMMY_INVOICE_DATA)
+        repeat = categorizer.categorize(DUMMY_INVOICE_DATA.model_copy(update={"vendor_name": " test vendor ", "total_amount": 101.0, "invoice_number": "INV-2"}))
+        categorizer.categorize(DUMMY_INVOICE_DATA.model_copy(update={"total_amount": 250.0})) # Different bucket
+
+        self.assertEqual(mock_openai_instance.chat.completions.create.call_count, 2)
+        self.assertEqual(repeat, first)
+        self.assertIsNot(repeat, first)
+
+    @patch('services.categorization.openai.OpenAI')
+    @patch('services.categorization.settings')
+    def test_categorize_many_threaded_keeps_input_order(self, mock_settings, mock_openai_cls):
+        """Test the thread-pool path returns one result per invoice in input order."""
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
+        mock_settings.OPENAI_API_KEY = 'fake-key'
+        mock_settings.ALLOWED_CATEGORIES = ALLOWED_CATEGORIES
+        mock_settings.COMPANY_CONTEXT = COMPANY_CONTEXT
+
+        def _reply(**request):
+            category = "Travel" if "Vendor A" in request["messages"][1]["content"] else "Office Supplies"
+            return self._create_mock_openai_response({"status": "matched", "assigned_category": category})
+        mock_openai_instance = MagicMock()
+        mock_openai_instance.chat.completions.create.side_effect = _reply
+        mock_openai_cls.return_value = mock_openai_instance
+
+        categorizer = InvoiceCategorizer()
+        invoices = [DUMMY_INVOICE_DATA.model_copy(update={"vendor_name": name}) for name in ("Vendor A", "Vendor B", "Vendor A2")]
+        results = categorizer.categorize_many_threaded(invoices, max_workers=3)
+
+        self.assertEqual([r.assigned_category for r in results], ['Travel', 'Office Supplies', 'Travel'])
+
+    @patch('services.categorization.openai.OpenAI')
+    @patch('services.categorize.settings')
+    def test_get_categorization_service_retries_failed_init(self, mock_settings, mock_openai_cls):
+        """Test that a failed init isn't memoized, while a successful service is built once and shared."""
+        mock_settings.CATEGORIZATION_SERVICE = 'openai'
+        mock_settings.CATEGORIZATION_MODEL = 'gpt-4o-mini'
+        mock_settings.XERO_ACCOUNT_CODE_MAP = {"Travel": "493", "Office Supplies": "461"}
+        mock_settings.OPENAI_API_KEY = None
+
+        with patch.object(services.categorize, '_categorization_service', None):
+            self.assertIsNone(services.categorize.get_categorization_service())
+            mock_settings.OPENAI_API_KEY = 'fake-key'
+            service = services.categorize.get_categorization_service()
+
+            self.assertIsNotNone(service)
+            self.assertEqual(service.allowed_categories, ["Travel", "Office Supplies"])
+            self.assertIs(services.categorize.get_categorization_service(), service)
+
 if __name__ == '__main__':
     unittest.main()
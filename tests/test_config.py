@@ -166,6 +166,58 @@ def test_load_config_from_secret_manager(mocker, caplog): # Use caplog
             assert "WARNING: Secret/Environment variable" not in caplog.text
             assert "CRITICAL: Missing required configuration(s)" not in caplog.text
 
+def test_get_secret_caches_secret_manager_values():
+    """Tests that a secret is fetched from Secret Manager once and then served from the cache."""
+    env_vars = {
+        "SECRET_MANAGER_ENABLED": "true",
+        "TEST_SKIP_GCP": "False",
+        "GCP_PROJECT_ID": OTHER_DUMMY_VALUES["GCP_PROJECT_ID"],
+    }
+
+    with patch.dict(os.environ, env_vars, clear=True), \
+         patch('google.cloud.secretmanager.SecretManagerServiceClient') as mock_client_cls:
+        mock_access = mock_client_cls.return_value.access_secret_version
+        mock_access.return_value.payload.data = DUMMY_SECRET_VALUES["SLACK_BOT_TOKEN"].encode("UTF-8")
+        import config
+        importlib.reload(config)
+        config._secret_cache.clear()
+        mock_access.reset_mock()
+
+        assert config.get_secret(config.SLACK_BOT_TOKEN_SECRET_NAME) == DUMMY_SECRET_VALUES["SLACK_BOT_TOKEN"]
+        assert config.get_secret(config.SLACK_BOT_TOKEN_SECRET_NAME) == DUMMY_SECRET_VALUES["SLACK_BOT_TOKEN"]
+        assert mock_access.call_count == 1
+
+        # A second secret reuses the same client instead of constructing a new one
+        config.get_secret(config.OPENAI_API_KEY_SECRET_NAME)
+        assert mock_access.call_count == 2
+        assert mock_client_cls.call_count == 1
+
+def test_get_secret_retries_on_unavailable_with_new_client():
+    """Tests that an Unavailable error drops the shared client and retries once."""
+    from google.api_core import exceptions as gcp_exceptions
+    env_vars = {
+        "SECRET_MANAGER_ENABLED": "true",
+        "TEST_SKIP_GCP": "False",
+        "GCP_PROJECT_ID": OTHER_DUMMY_VALUES["GCP_PROJECT_ID"],
+    }
+
+    with patch.dict(os.environ, env_vars, clear=True), \
+         patch('google.cloud.secretmanager.SecretManagerServiceClient') as mock_client_cls:
+        import config
+        importlib.reload(config)
+        config._secret_cache.clear()
+        config._SM_CLIENT = None
+        mock_client_cls.reset_mock()
+
+        good_response = MagicMock()
+        good_response.payload.data = DUMMY_SECRET_VALUES["SLACK_BOT_TOKEN"].encode("UTF-8")
+        mock_access = mock_client_cls.return_value.access_secret_version
+        mock_access.side_effect = [gcp_exceptions.ServiceUnavailable("channel closed"), good_response]
+
+        assert config.get_secret(config.SLACK_BOT_TOKEN_SECRET_NAME) == DUMMY_SECRET_VALUES["SLACK_BOT_TOKEN"]
+        assert mock_access.call_count == 2
+        assert mock_client_cls.call_count == 2
+
 def test_missing_required_secret_name(mocker, caplog): # Use caplog
     """Tests that missing a required secret when SM is enabled logs correctly."""
     caplog.set_level(logging.WARNING) # Ensure WARNING level logs are captured
@@ -230,6 +282,7 @@ def test_missing_required_secret_name(mocker, caplog): # Use caplog
                 for record in caplog.records
             )
             assert critical_log_found, f"Expected CRITICAL log containing '{core_critical_message}' not found in logs:\n{caplog.text}"
+            assert missing_secret_key in test_settings.MISSING_CONFIGS
 
             mock_get_secret.assert_called()
 
@@ -264,3 +317,33 @@ def test_invalid_xero_account_codes_json(caplog): # Use caplog
         expected_warning_substring = f"Failed to parse XERO_ACCOUNT_CODES JSON: {invalid_json_string}. Using empty map."
         assert expected_warning_substring in caplog.text
         assert any(record.levelno == logging.WARNING and expected_warning_substring in record.message for record in caplog.records)
+
+def test_app_refuses_to_start_without_core_config():
+    """Tests that importing app fails fast on a missing core key, but still boots without Xero."""
+    import sys
+    env_vars = {
+        "SECRET_MANAGER_ENABLED": "false",
+        "TEST_SKIP_GCP": "False",
+        "SLACK_BOT_TOKEN": DUMMY_SECRET_VALUES["SLACK_BOT_TOKEN"],
+        "SLACK_SIGNING_SECRET": DUMMY_SECRET_VALUES["SLACK_SIGNING_SECRET"],
+        "OPENAI_API_KEY": DUMMY_SECRET_VALUES["OPENAI_API_KEY"],
+        # No MISTRAL_API_KEY, and no Xero config at all
+    }
+    import config
+    try:
+        with patch.dict(os.environ, env_vars, clear=True):
+            importlib.reload(config) # Re-reads TEST_SKIP_GCP, and starts with a fresh get_settings cache
+            sys.modules.pop("app", None)
+            with pytest.raises(RuntimeError, match="Missing required config: MISTRAL_API_KEY"):
+                importlib.import_module("app")
+
+            os.environ["MISTRAL_API_KEY"] = DUMMY_SECRET_VALUES["MISTRAL_API_KEY"]
+            config.get_settings.cache_clear()
+            sys.modules.pop("app", None)
+            app = importlib.import_module("app")
+
+            assert app.xero_service is None
+            assert app.bolt_app is not None
+    finally:
+        sys.modules.pop("app", None)
+        importlib.reload(config)
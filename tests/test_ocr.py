@@ -1,10 +1,16 @@
+import asyncio
+import os
+import stat
+import time
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 import json
 
 from pydantic import ValidationError
 
-from services.ocr import MistralOCR, ExtractedInvoiceData, LineItem
+from services.ocr import MistralOCR, ExtractedInvoiceData, LineItem, MAX_PDF_TEXT_TOKENS, _mistral_clients, _text_tokenizer
+from services.ocr_cache import OCRCache
+import services.ocr
 import config
 
 # --- Test Data --- 
@@ -40,6 +46,13 @@ EXPECTED_INVOICE_DATA = ExtractedInvoiceData(
 )
 
 # --- Fixtures --- 
+@pytest.fixture(autouse=True)
+def fresh_mistral_clients():
+    """Drops the process-wide Mistral clients so each test builds (and mocks) its own."""
+    _mistral_clients.clear()
+    yield
+    _mistral_clients.clear()
+
 @pytest.fixture
 def mistral_ocr_instance():
     """Provides a MistralOCR instance, mocking config loading to provide a dummy API key."""
@@ -75,6 +88,7 @@ def test_mistral_ocr_initialization_missing_key():
 @patch('config.Settings') # Also mock Settings here for consistency inside extract if needed
 def test_extract_happy_path(mock_settings_cls, mock_mistral_cls, mock_pdf_reader_cls):
     """Test the full extract process with successful text extraction and API call."""
+    mock_settings_cls.return_value.PDF_BACKEND = "pypdf2" # Exercises the PyPDF2 backend mocked above
     # --- Mock PdfReader --- 
     mock_pdf_page = MagicMock()
     mock_pdf_page.extract_text.return_value = SAMPLE_EXTRACTED_TEXT
@@ -122,6 +136,7 @@ def test_extract_happy_path(mock_settings_cls, mock_mistral_cls, mock_pdf_reader
 @patch('config.Settings')
 def test_extract_pdf_text_extraction_failure(mock_settings_cls, mock_mistral_cls, mock_pdf_reader_cls):
     """Test extract when PdfReader fails to extract text."""
+    mock_settings_cls.return_value.PDF_BACKEND = "pypdf2" # Exercises the PyPDF2 backend mocked above
     # --- Mock PdfReader to return no text --- 
     mock_pdf_page = MagicMock()
     mock_pdf_page.extract_text.return_value = "" # Simulate no text extracted
@@ -151,6 +166,7 @@ def test_extract_pdf_text_extraction_failure(mock_settings_cls, mock_mistral_cls
 @patch('config.Settings')
 def test_extract_mistral_api_error(mock_settings_cls, mock_mistral_cls, mock_pdf_reader_cls):
     """Test extract when the Mistral API call raises an exception."""
+    mock_settings_cls.return_value.PDF_BACKEND = "pypdf2" # Exercises the PyPDF2 backend mocked above
     # --- Mock PdfReader --- 
     mock_pdf_page = MagicMock()
     mock_pdf_page.extract_text.return_value = SAMPLE_EXTRACTED_TEXT
@@ -180,6 +196,7 @@ def test_extract_mistral_api_error(mock_settings_cls, mock_mistral_cls, mock_pdf
 @patch('config.Settings')
 def test_extract_mistral_empty_response(mock_settings_cls, mock_mistral_cls, mock_pdf_reader_cls):
     """Test extract when the Mistral API returns an empty or non-standard response."""
+    mock_settings_cls.return_value.PDF_BACKEND = "pypdf2" # Exercises the PyPDF2 backend mocked above
     # --- Mock PdfReader --- 
     mock_pdf_page = MagicMock()
     mock_pdf_page.extract_text.return_value = SAMPLE_EXTRACTED_TEXT
@@ -206,11 +223,13 @@ def test_extract_mistral_empty_response(mock_settings_cls, mock_mistral_cls, moc
     mock_pdf_reader_cls.assert_called_once()
     mock_mistral_instance.chat.complete.assert_called_once() 
 
+@patch('services.ocr.time.sleep') # Retry backoff between re-prompts
 @patch('services.ocr.PdfReader') # Mock PyPDF2 PdfReader
 @patch('services.ocr.Mistral') # Mock Mistral class
 @patch('config.Settings')
-def test_extract_mistral_invalid_json_response(mock_settings_cls, mock_mistral_cls, mock_pdf_reader_cls):
+def test_extract_mistral_invalid_json_response(mock_settings_cls, mock_mistral_cls, mock_pdf_reader_cls, mock_sleep):
     """Test extract when the Mistral API returns invalid JSON."""
+    mock_settings_cls.return_value.PDF_BACKEND = "pypdf2" # Exercises the PyPDF2 backend mocked above
     # --- Mock PdfReader --- 
     mock_pdf_page = MagicMock()
     mock_pdf_page.extract_text.return_value = SAMPLE_EXTRACTED_TEXT
@@ -235,15 +254,19 @@ def test_extract_mistral_invalid_json_response(mock_settings_cls, mock_mistral_c
     result = ocr_service.extract(DUMMY_PDF_CONTENT, DUMMY_FILENAME)
 
     # --- Assertions --- 
-    assert result is None # Should fail parsing
+    assert result is None # Should fail parsing, even after re-prompting
     mock_pdf_reader_cls.assert_called_once()
-    mock_mistral_instance.chat.complete.assert_called_once() 
+    # Re-prompted with the validation error until the retries ran out
+    assert mock_mistral_instance.chat.complete.call_count == 3
+
 
+@patch('services.ocr.time.sleep') # Retry backoff between re-prompts
 @patch('services.ocr.PdfReader') # Mock PyPDF2 PdfReader
 @patch('services.ocr.Mistral') # Mock Mistral class
 @patch('config.Settings')
-def test_extract_mistral_validation_error(mock_settings_cls, mock_mistral_cls, mock_pdf_reader_cls):
+def test_extract_mistral_validation_error(mock_settings_cls, mock_mistral_cls, mock_pdf_reader_cls, mock_sleep):
     """Test extract when Mistral response is JSON but fails Pydantic validation."""
+    mock_settings_cls.return_value.PDF_BACKEND = "pypdf2" # Exercises the PyPDF2 backend mocked above
     # --- Mock PdfReader --- 
     mock_pdf_page = MagicMock()
     mock_pdf_page.extract_text.return_value = SAMPLE_EXTRACTED_TEXT
@@ -277,7 +300,265 @@ def test_extract_mistral_validation_error(mock_settings_cls, mock_mistral_cls, m
     # --- Assertions --- 
     assert result is None
     mock_pdf_reader_cls.assert_called_once()
-    mock_mistral_instance.chat.complete.assert_called_once()
+    # Re-prompted with the validation error until the retries ran out
+    assert mock_mistral_instance.chat.complete.call_count == 3
 
 # TODO: Add tests for _extract_text_from_pdf specifically (e.g., multiple pages, empty PDF)
 # TODO: Add tests for _parse_response specifically (e.g., null values in JSON)
+
+def test_extract_text_with_pymupdf_backend():
+    """Test the default PyMuPDF backend on a real (in-memory) two-page PDF."""
+    pymupdf = pytest.importorskip("pymupdf")
+    doc = pymupdf.open()
+    for line in ("Vendor: Test Vendor", "Total: 150.75"):
+        doc.new_page().insert_text((72, 72), line)
+    pdf_bytes = doc.tobytes()
+    doc.close()
+
+    ocr_service = MistralOCR(api_key=DUMMY_API_KEY, pdf_backend="pymupdf")
+    text = ocr_service._extract_text_from_pdf(pdf_bytes, DUMMY_FILENAME)
+
+    assert "Vendor: Test Vendor" in text
+    assert "Total: 150.75" in text
+
+@patch('services.ocr._text_tokenizer', return_value=None) # Character fallback
+@patch('services.ocr.PDF_EXTRACT_CHAR_LIMIT', 15000)
+@patch('services.ocr.MAX_PDF_TEXT_CHARS', 15000)
+@patch('services.ocr.PdfReader')
+def test_extract_text_stops_at_max_chars(mock_pdf_reader_cls, mock_tokenizer):
+    """Test that page extraction stops once the text budget is full instead of parsing every page."""
+    pages = [MagicMock() for _ in range(5)]
+    for page in pages:
+        page.extract_text.return_value = "x" * 6000
+    mock_pdf_reader_cls.return_value.pages = pages
+
+    ocr_service = MistralOCR(api_key=DUMMY_API_KEY, pdf_backend="pypdf2")
+    text = ocr_service._extract_text_from_pdf(DUMMY_PDF_CONTENT, DUMMY_FILENAME)
+
+    assert len(text) == 15000
+    assert [page.extract_text.call_count for page in pages] == [1, 1, 1, 0, 0]
+
+@patch('services.ocr.PdfReader')
+@patch('services.ocr.Mistral')
+def test_extract_served_from_cache_on_resubmission(mock_mistral_cls, mock_pdf_reader_cls, tmp_path):
+    """Test that re-submitting the same file skips both the PDF parse and the Mistral call."""
+    mock_pdf_page = MagicMock()
+    mock_pdf_page.extract_text.return_value = SAMPLE_EXTRACTED_TEXT
+    mock_pdf_reader_cls.return_value.pages = [mock_pdf_page]
+    mock_chat_message = MagicMock()
+    mock_chat_message.message.content = SAMPLE_MISTRAL_RESPONSE_JSON
+    mock_mistral_cls.return_value.chat.complete.return_value.choices = [mock_chat_message]
+
+    ocr_service = MistralOCR(api_key=DUMMY_API_KEY, pdf_backend="pypdf2", cache_dir=str(tmp_path))
+    first = ocr_service.extract(DUMMY_PDF_CONTENT, DUMMY_FILENAME)
+    # A fresh instance shares the on-disk cache
+    second = MistralOCR(api_key=DUMMY_API_KEY, pdf_backend="pypdf2", cache_dir=str(tmp_path)).extract(DUMMY_PDF_CONTENT, "copy.pdf")
+
+    assert first == second == EXPECTED_INVOICE_DATA
+    assert mock_mistral_cls.return_value.chat.complete.call_count == 1
+    assert mock_pdf_reader_cls.call_count == 1
+    assert len(list(tmp_path.glob("*.json"))) == 1
+
+@patch('services.ocr.PdfReader')
+def test_extract_text_reuses_parsed_text_for_same_bytes(mock_pdf_reader_cls):
+    """Test that identical PDF bytes are parsed once and served from the in-memory text cache after."""
+    mock_pdf_page = MagicMock()
+    mock_pdf_page.extract_text.return_value = SAMPLE_EXTRACTED_TEXT
+    mock_pdf_reader_cls.return_value.pages = [mock_pdf_page]
+
+    ocr_service = MistralOCR(api_key=DUMMY_API_KEY, pdf_backend="pypdf2")
+    first = ocr_service._extract_text_from_pdf(DUMMY_PDF_CONTENT, DUMMY_FILENAME)
+    second = ocr_service._extract_text_from_pdf(DUMMY_PDF_CONTENT, DUMMY_FILENAME)
+    ocr_service._extract_text_from_pdf(b"other pdf bytes", DUMMY_FILENAME)
+
+    assert first == second == SAMPLE_EXTRACTED_TEXT
+    assert mock_pdf_reader_cls.call_count == 2
+
+@patch('services.ocr.time.sleep')
+@patch('services.ocr.PdfReader')
+@patch('services.ocr.Mistral')
+def test_extract_recovers_after_validation_feedback(mock_mistral_cls, mock_pdf_reader_cls, mock_sleep):
+    """Test that a reply failing validation is re-prompted with the error and the corrected reply is used."""
+    mock_pdf_page = MagicMock()
+    mock_pdf_page.extract_text.return_value = SAMPLE_EXTRACTED_TEXT
+    mock_pdf_reader_cls.return_value.pages = [mock_pdf_page]
+    bad_reply, good_reply = MagicMock(), MagicMock()
+    bad_reply.choices[0].message.content = json.dumps({"vendor_name": "Test Vendor"}) # Missing required fields
+    good_reply.choices[0].message.content = SAMPLE_MISTRAL_RESPONSE_JSON
+    mock_mistral_cls.return_value.chat.complete.side_effect = [bad_reply, good_reply]
+
+    ocr_service = MistralOCR(api_key=DUMMY_API_KEY, pdf_backend="pypdf2")
+    result = ocr_service.extract(DUMMY_PDF_CONTENT, DUMMY_FILENAME)
+
+    assert result == EXPECTED_INVOICE_DATA
+    retry_messages = mock_mistral_cls.return_value.chat.complete.call_args.kwargs["messages"]
+    assert [m["role"] for m in retry_messages] == ["user", "assistant", "user"]
+    assert "failed validation" in retry_messages[-1]["content"]
+    mock_sleep.assert_called_once_with(1.0)
+
+@patch('services.ocr.PdfReader')
+@patch('services.ocr.Mistral')
+def test_extract_async_awaits_mistral(mock_mistral_cls, mock_pdf_reader_cls):
+    """Test that extract_async uses the awaitable complete_async call instead of the blocking one."""
+    mock_pdf_page = MagicMock()
+    mock_pdf_page.extract_text.return_value = SAMPLE_EXTRACTED_TEXT
+    mock_pdf_reader_cls.return_value.pages = [mock_pdf_page]
+    mock_chat_response = MagicMock()
+    mock_chat_response.choices[0].message.content = SAMPLE_MISTRAL_RESPONSE_JSON
+    mock_mistral_cls.return_value.chat.complete_async = AsyncMock(return_value=mock_chat_response)
+
+    ocr_service = MistralOCR(api_key=DUMMY_API_KEY, pdf_backend="pypdf2")
+
+    async def extract_both():
+        return await asyncio.gather(
+            ocr_service.extract_async(DUMMY_PDF_CONTENT, DUMMY_FILENAME),
+            ocr_service.extract_async(b"other pdf bytes", "other.pdf"),
+        )
+    results = asyncio.run(extract_both())
+
+    assert results == [EXPECTED_INVOICE_DATA, EXPECTED_INVOICE_DATA]
+    assert mock_mistral_cls.return_value.chat.complete_async.await_count == 2
+    mock_mistral_cls.return_value.chat.complete.assert_not_called()
+
+def test_truncate_to_token_budget_counts_tokens():
+    """Test that number-heavy text is trimmed to the token budget, not a character count."""
+    tokenizer = _text_tokenizer()
+    if tokenizer is None:
+        pytest.skip("mistral-common tokenizer not installed")
+    text = "Item 4711 | qty 3 | 12.34 EUR | 37.02 EUR\n" * 2000
+
+    truncated = MistralOCR._truncate_to_token_budget(text, DUMMY_FILENAME)
+
+    assert len(tokenizer.encode(truncated, bos=False, eos=False)) <= MAX_PDF_TEXT_TOKENS
+    assert text.startswith(truncated)
+    # Short texts pass through untouched
+    assert MistralOCR._truncate_to_token_budget(SAMPLE_EXTRACTED_TEXT, DUMMY_FILENAME) == SAMPLE_EXTRACTED_TEXT
+
+@patch('services.ocr.Mistral')
+def test_prompt_prefix_suffix_match_template(mock_mistral_cls):
+    """Test that the precomputed prompt halves rebuild exactly what the template would format to."""
+    ocr_service = MistralOCR(api_key=DUMMY_API_KEY)
+    invoice_text = "Item {A}: 10.00 {{braces}}"
+
+    prompt = ocr_service._prompt_prefix + invoice_text + ocr_service._prompt_suffix
+
+    assert prompt == ocr_service.extraction_prompt_template.format(invoice_text=invoice_text)
+
+def _stream_events(*deltas):
+    """Mock chat.stream events carrying the given text deltas."""
+    events = []
+    for delta in deltas:
+        event = MagicMock()
+        event.data.choices[0].delta.content = delta
+        events.append(event)
+    return events
+
+@patch('services.ocr.time.sleep')
+@patch('services.ocr.PdfReader')
+@patch('services.ocr.Mistral')
+def test_extract_streamed_abandons_prose_reply(mock_mistral_cls, mock_pdf_reader_cls, mock_sleep):
+    """Test that a streamed reply opening with prose is cut off and re-prompted, and a JSON reply is assembled."""
+    mock_pdf_page = MagicMock()
+    mock_pdf_page.extract_text.return_value = SAMPLE_EXTRACTED_TEXT
+    mock_pdf_reader_cls.return_value.pages = [mock_pdf_page]
+    prose_events = _stream_events("Sure", "! Here is the invoice data", " you asked for:")
+    half = len(SAMPLE_MISTRAL_RESPONSE_JSON) // 2
+    json_events = _stream_events("\n", SAMPLE_MISTRAL_RESPONSE_JSON[:half], SAMPLE_MISTRAL_RESPONSE_JSON[half:])
+    streams = [MagicMock(), MagicMock()]
+    for stream, events in zip(streams, (prose_events, json_events)):
+        stream.__enter__.return_value = iter(events)
+    mock_mistral_cls.return_value.chat.stream.side_effect = streams
+
+    ocr_service = MistralOCR(api_key=DUMMY_API_KEY, pdf_backend="pypdf2", stream_responses=True)
+    result = ocr_service.extract(DUMMY_PDF_CONTENT, DUMMY_FILENAME)
+
+    assert result == EXPECTED_INVOICE_DATA
+    retry_messages = mock_mistral_cls.return_value.chat.stream.call_args.kwargs["messages"]
+    assert retry_messages[1] == {"role": "assistant", "content": "Sure"} # Nothing read past the first delta
+    streams[0].__exit__.assert_called_once() # Connection dropped
+    mock_mistral_cls.return_value.chat.complete.assert_not_called()
+
+@patch('services.ocr.Mistral')
+def test_parse_response_strips_control_characters(mock_mistral_cls):
+    """Test that stray control characters in a fenced reply are dropped before validation."""
+    ocr_service = MistralOCR(api_key=DUMMY_API_KEY)
+    reply = "```json\n" + SAMPLE_MISTRAL_RESPONSE_JSON.replace("Test Vendor", "Test\x00 Vendor\x1b") + "\n```"
+
+    data, error = ocr_service._parse_response(reply, DUMMY_FILENAME)
+
+    assert error is None
+    assert data == EXPECTED_INVOICE_DATA
+
+@patch('services.ocr.Mistral')
+def test_parse_response_strips_untagged_fence(mock_mistral_cls):
+    """Test that a bare ``` fence (no json tag) is removed as well."""
+    ocr_service = MistralOCR(api_key=DUMMY_API_KEY)
+
+    data, error = ocr_service._parse_response("  ```\n" + SAMPLE_MISTRAL_RESPONSE_JSON + "\n```  ", DUMMY_FILENAME)
+
+    assert error is None
+    assert data == EXPECTED_INVOICE_DATA
+
+@patch('services.ocr.PdfReader')
+@patch('services.ocr.Mistral')
+def test_extract_batch_one_request_with_per_item_fallback(mock_mistral_cls, mock_pdf_reader_cls):
+    """Test that a batch goes out as one request and an invoice missing from the reply is retried alone."""
+    mock_pdf_page = MagicMock()
+    mock_pdf_page.extract_text.return_value = SAMPLE_EXTRACTED_TEXT
+    mock_pdf_reader_cls.return_value.pages = [mock_pdf_page]
+    entry = json.loads(SAMPLE_MISTRAL_RESPONSE_JSON)
+    batch_reply, single_reply = MagicMock(), MagicMock()
+    batch_reply.choices[0].message.content = json.dumps({"results": [{"id": "0", **entry}, {"id": "2", **entry}]})
+    single_reply.choices[0].message.content = SAMPLE_MISTRAL_RESPONSE_JSON
+    mock_mistral_cls.return_value.chat.complete.side_effect = [batch_reply, single_reply]
+
+    ocr_service = MistralOCR(api_key=DUMMY_API_KEY, pdf_backend="pypdf2")
+    items = [(b"pdf 0", "a.pdf"), (b"pdf 1", "b.pdf"), (b"pdf 2", "c.pdf")]
+    results = ocr_service.extract_batch(items)
+
+    assert results == [EXPECTED_INVOICE_DATA] * 3
+    calls = mock_mistral_cls.return_value.chat.complete.call_args_list
+    assert len(calls) == 2 # One batched request + the retry for invoice 1
+    batched_prompt = calls[0].kwargs["messages"][0]["content"]
+    assert "Invoice 0:" in batched_prompt and "Invoice 2:" in batched_prompt
+    assert mock_pdf_reader_cls.call_count == 3 # The retry reused the already-parsed text
+
+@patch('services.ocr.MistralOCR')
+def test_get_ocr_service_retries_failed_init(mock_ocr_cls):
+    """Test that a failed OCR init isn't memoized, while a built service is shared by later calls."""
+    mock_ocr_cls.side_effect = [RuntimeError("Mistral unreachable"), MagicMock()]
+    with patch('services.ocr._ocr_service', None), patch('services.ocr.config') as mock_config:
+        mock_config.settings.OCR_SERVICE = "mistral"
+        assert services.ocr.get_ocr_service() is None
+        service = services.ocr.get_ocr_service()
+
+        assert service is not None
+        assert services.ocr.get_ocr_service() is service
+    assert mock_ocr_cls.call_count == 2
+
+@patch('services.ocr.Mistral')
+def test_instances_share_one_mistral_client(mock_mistral_cls):
+    """Test that OCR instances with the same key reuse one Mistral client (and its connection pool)."""
+    first = MistralOCR(api_key=DUMMY_API_KEY)
+    second = MistralOCR(api_key=DUMMY_API_KEY)
+
+    assert first.client is second.client
+    mock_mistral_cls.assert_called_once()
+
+def test_ocr_cache_is_owner_only_and_bounded(tmp_path):
+    """Test that cache entries are private to the owner, expire by age and are capped in number."""
+    cache_dir = tmp_path / "ocr-cache"
+    cache = OCRCache(str(cache_dir), max_entries=2, max_age=60)
+    for key in ("a", "b", "c"):
+        cache.set(key, EXPECTED_INVOICE_DATA)
+        os.utime(cache_dir / f"{key}.json", (time.time(), time.time() - {"a": 30, "b": 20, "c": 10}[key]))
+
+    assert stat.S_IMODE(os.stat(cache_dir).st_mode) == 0o700
+    assert stat.S_IMODE(os.stat(cache_dir / "a.json").st_mode) == 0o600
+
+    cache.prune()
+    assert sorted(p.name for p in cache_dir.iterdir()) == ["b.json", "c.json"] # Oldest dropped past max_entries
+
+    os.utime(cache_dir / "b.json", (time.time(), time.time() - 120))
+    assert cache.get("b") is None # Expired
+    assert ExtractedInvoiceData.model_validate_json(cache.get("c")) == EXPECTED_INVOICE_DATA